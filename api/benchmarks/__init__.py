@@ -0,0 +1,5 @@
+"""
+Микробенчмарки отдельных механизмов. Запускаются из каталога api:
+
+    python -m benchmarks.<имя модуля>
+"""
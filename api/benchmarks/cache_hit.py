@@ -0,0 +1,53 @@
+"""
+Стоимость попадания в CacheLRU и память на одну запись, в сравнении с исходной реализацией.
+
+- ns/hit - среднее время get() по ключу, который уже лежит в кэше;
+- bytes/entry - прирост памяти на одну запись при заполнении кэша (контейнер + запись).
+
+    python -m benchmarks.cache_hit [размер]
+"""
+
+import gc
+import sys
+import time
+import tracemalloc
+from typing import Dict
+
+from src.cache import CacheLRU
+from benchmarks.cache_lru import LegacyCacheLRU
+
+DEFAULT_SIZE = 100_000
+HITS = 1_000_000
+ORIGIN = 'https://example.com/'
+
+
+def load(key: int) -> str:
+    return ORIGIN
+
+
+def measure(factory, size: int) -> Dict[str, float]:
+    keys = list(range(size))
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    cache = factory(maxsize=size * 2)
+    for key in keys:
+        cache.get(key, load, key)
+    bytes_per_entry = (tracemalloc.get_traced_memory()[0] - before) / size
+    tracemalloc.stop()
+
+    hit_keys = [keys[i % size] for i in range(HITS)]
+    get = cache.get
+    started = time.perf_counter()
+    for key in hit_keys:
+        get(key, load, key)
+    ns_per_hit = (time.perf_counter() - started) / HITS * 1e9
+    return {'ns_per_hit': ns_per_hit, 'bytes_per_entry': bytes_per_entry}
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_SIZE
+    print(f"{'cache':>10} {'ns/hit':>10} {'bytes/entry':>12}")
+    for name, factory in (('legacy', LegacyCacheLRU), ('lru', CacheLRU)):
+        result = measure(factory, size)
+        print(f"{name:>10} {result['ns_per_hit']:>10.0f} {result['bytes_per_entry']:>12.0f}")
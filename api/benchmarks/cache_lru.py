@@ -0,0 +1,121 @@
+"""
+Сравнение CacheLRU с прежней реализацией, которая сортировала весь контейнер при каждой чистке.
+
+Нагрузка: кэш заполняется до предела, затем идет поток обращений, из которых
+часть попадает в кэш, а часть - промахи с вытеснением. Меряется среднее время обращения
+и самое долгое обращение (тот самый всплеск на запросе, который запускает чистку).
+
+    python -m benchmarks.cache_lru [размер ...]
+"""
+
+import random
+import sys
+import time
+from typing import Any, Callable, Dict, List
+
+from src.cache import CacheLRU
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+HIT_RATIO = 0.8
+OPERATIONS_PER_ENTRY = 2
+
+
+class LegacyCacheLRU:
+    """
+    Прежняя реализация CacheLRU: эпоха на записи и сортировка контейнера на каждой чистке.
+    """
+    _DEFAULT_MAXSIZE_HYSTERESIS = 1.2
+
+    def __init__(self, maxsize: int, hysteresis: float = None):
+        self._hysteresis = hysteresis or self._DEFAULT_MAXSIZE_HYSTERESIS
+        self._container: Dict[int, LegacyEntry] = {}
+        self._epoch = 0
+        self._maxsize_soft = maxsize
+        self._maxsize_hard = int(self._maxsize_soft * self._hysteresis)
+
+    def get(self, key: Any, func: Callable[..., Any], *args, **kwargs) -> Any:
+        def functor():
+            return func(*args, **kwargs)
+        cached = LegacyEntry(key, functor)
+        try:
+            cached = self._container[hash(cached)]
+        except KeyError:
+            cached.load_data()
+            self._container[hash(cached)] = cached
+            if len(self._container) >= self._maxsize_hard:
+                self.clean()
+        self._epoch += 1
+        cached.epoch = self._epoch
+        return cached.value
+
+    def clean(self):
+        truncated = sorted(self._container.values(), key=lambda cached: cached.epoch)[-self._maxsize_soft:]
+        self._container = {hash(cached): cached for cached in truncated}
+
+
+class LegacyEntry:
+    def __init__(self, key: Any, func: Callable[..., Any]):
+        self._key = key
+        self._func = func
+        self.value = None
+        self.epoch = 0
+
+    def load_data(self):
+        self.value = self._func()
+
+    def __hash__(self):
+        return hash(self._key)
+
+
+def load(key: int) -> str:
+    return 'https://example.com/'
+
+
+def workload(size: int) -> List[int]:
+    """
+    Ключи обращений: HIT_RATIO из уже загруженных, остальные - новые.
+    """
+    rnd = random.Random(size)
+    keys = []
+    next_new = size
+    for _ in range(size * OPERATIONS_PER_ENTRY):
+        if rnd.random() < HIT_RATIO:
+            keys.append(rnd.randrange(next_new - size, next_new))
+        else:
+            keys.append(next_new)
+            next_new += 1
+    return keys
+
+
+def measure(cache, keys: List[int]) -> Dict[str, float]:
+    clock = time.perf_counter
+    worst = 0.0
+    started = clock()
+    for key in keys:
+        op_started = clock()
+        cache.get(key, load, key)
+        elapsed = clock() - op_started
+        if elapsed > worst:
+            worst = elapsed
+    total = clock() - started
+    return {'mean_us': total / len(keys) * 1e6, 'max_ms': worst * 1e3}
+
+
+def run(size: int):
+    keys = workload(size)
+    for name, factory, hysteresis in (
+            ('legacy', LegacyCacheLRU, 1.2),
+            ('lru', CacheLRU, None),
+            ('lru+hysteresis', CacheLRU, 1.2)):
+        cache = factory(maxsize=size, hysteresis=hysteresis)
+        for key in range(size):
+            cache.get(key, load, key)
+        result = measure(cache, keys)
+        print(f"{size:>10} {name:>15} {result['mean_us']:>10.2f} {result['max_ms']:>10.2f}")
+
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+    print(f"{'size':>10} {'cache':>15} {'mean, us':>10} {'max, ms':>10}")
+    for size in sizes:
+        run(size)
@@ -0,0 +1,320 @@
+"""
+Подмена DBShortlinks и AsyncDBShortlinks в памяти процесса для нагрузочных замеров без Postgres.
+
+Таблица ссылок ведет себя как shortlinks.link: статусы, резерв свободных ссылок, устаревание по date_access.
+Каждый метод слоя БД - один запрос: он считается в round_trips и, если задана latency,
+ждет столько секунд (синхронный - time.sleep, асинхронный - asyncio.sleep), изображая сеть и БД.
+"""
+
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+from config import config
+from src.db import ShortlinkNotFound
+from src.reservoir import Reservoir
+
+
+class FakeLinkTable:
+    """
+    Строки (id -> [short, origin, date_access, status]) и индекс по short, счетчики переходов - отдельно по id.
+    Свободные строки лежат в отдельном упорядоченном словаре, чтобы занять свободную можно было за O(1).
+    Обходы для постраничного чтения и устаревания идут по всей таблице, на размерах замеров этого хватает.
+    """
+    def __init__(self):
+        self._rows: Dict[int, list] = {}
+        self._ids: Dict[str, int] = {}
+        self._free: Dict[int, None] = {}
+        self._hits: Dict[int, int] = {}
+        self._sequence = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def seed(self, shorts: List[str], origins: List[str], ages: List[float]):
+        """
+        Заливает активные ссылки с временем доступа ages секунд назад
+        """
+        now = datetime.now()
+        with self._lock:
+            for short, origin, age in zip(shorts, origins, ages):
+                link_id = next(self._sequence)
+                self._rows[link_id] = [short, origin, now - timedelta(seconds=age), 'active']
+                self._ids[short] = link_id
+
+    def link_ids_reserve(self, count: int) -> List[int]:
+        with self._lock:
+            return [next(self._sequence) for _ in range(count)]
+
+    def link_create(self, link_id: int, short: str, origin: str) -> str:
+        return self.links_create([link_id], [short], [origin])[0]
+
+    def links_create(self, link_ids: List[int], shorts: List[str], origins: List[str]) -> List[str]:
+        now = datetime.now()
+        created = []
+        with self._lock:
+            for link_id, short, origin in zip(link_ids, shorts, origins):
+                if self._free:
+                    free_id = next(iter(self._free))
+                    del self._free[free_id]
+                    row = self._rows[free_id]
+                    row[1:] = [origin, now, 'active']
+                    created.append(row[0])
+                else:
+                    self._rows[link_id] = [short, origin, now, 'active']
+                    self._ids[short] = link_id
+                    created.append(short)
+        return created
+
+    def links_reserve_free(self, count: int) -> List[Tuple[int, str, datetime]]:
+        now = datetime.now()
+        reserved = []
+        with self._lock:
+            for link_id in list(itertools.islice(self._free, count)):
+                del self._free[link_id]
+                row = self._rows[link_id]
+                row[2:] = [now, 'reserved']
+                reserved.append((link_id, row[0], now))
+        return reserved
+
+    def link_reuse_reserved(self, link_id: int, reserved_at: datetime, origin: str) -> bool:
+        with self._lock:
+            row = self._rows.get(link_id)
+            if row is None or row[3] != 'reserved' or row[2] != reserved_at:
+                return False
+            row[1:] = [origin, datetime.now(), 'active']
+            return True
+
+    def links_release_reserved(self, reservations: List[Tuple[int, datetime]]):
+        with self._lock:
+            for link_id, reserved_at in reservations:
+                row = self._rows.get(link_id)
+                if row is not None and row[3] == 'reserved' and row[2] == reserved_at:
+                    self._set_free(link_id, row, keep_origin=True)
+
+    def links_release_stale_reserved(self, age: int):
+        cutoff = datetime.now() - timedelta(seconds=age)
+        with self._lock:
+            for link_id, row in self._rows.items():
+                if row[3] == 'reserved' and row[2] < cutoff:
+                    self._set_free(link_id, row, keep_origin=True)
+
+    def link_select(self, short: str) -> str:
+        row = self._active_row(short)
+        if row is None:
+            raise ShortlinkNotFound(f"Ссылка '{short}' не найдена")
+        return row[1]
+
+    def links_select_origins(self, shorts: List[str]) -> Dict[str, str]:
+        origins = {}
+        for short in shorts:
+            row = self._active_row(short)
+            if row is not None:
+                origins[short] = row[1]
+        return origins
+
+    def links_select_recent(self, limit: int) -> List[Tuple[str, str]]:
+        with self._lock:
+            rows = heapq.nlargest(limit, (
+                (row[2], link_id, row[0], row[1]) for link_id, row in self._rows.items()
+                if row[3] in ('active', 'inactive')
+            ))
+        return [(short, origin) for _, _, short, origin in reversed(rows)]
+
+    def links_select(self, limit: int, offset: int) -> List[tuple]:
+        limit = min(limit, config.SELECT_HARD_LIMIT)
+        with self._lock:
+            ids = sorted(self._rows)[offset:offset + limit]
+            return [tuple(self._rows[link_id]) for link_id in ids]
+
+    def links_select_after(self, after_id: int, limit: int) -> List[tuple]:
+        limit = min(limit, config.SELECT_HARD_LIMIT)
+        with self._lock:
+            ids = heapq.nsmallest(limit, (link_id for link_id in self._rows if link_id > after_id))
+            return [(link_id, *self._rows[link_id]) for link_id in ids]
+
+    def links_stream(self, after_id: int = 0) -> Iterator[tuple]:
+        with self._lock:
+            ids = sorted(link_id for link_id in self._rows if link_id > after_id)
+        for link_id in ids:
+            row = self._rows.get(link_id)
+            if row is not None:
+                yield (link_id, *row)
+
+    def link_actualize(self, short: str):
+        self.links_actualize([short])
+
+    def links_actualize(self, shorts: List[str]):
+        now = datetime.now()
+        with self._lock:
+            for short in shorts:
+                row = self._active_row(short)
+                if row is not None:
+                    row[2:] = [now, 'active']
+
+    def links_hit(self, hits: List[Tuple[str, int, float]]):
+        now = time.monotonic()
+        moment = datetime.now()
+        with self._lock:
+            for short, count, last in hits:
+                row = self._active_row(short)
+                if row is not None:
+                    link_id = self._ids[short]
+                    self._hits[link_id] = self._hits.get(link_id, 0) + count
+                    row[2:] = [max(row[2], moment - timedelta(seconds=now - last)), 'active']
+
+    def link_delete(self, short: str):
+        with self._lock:
+            link_id = self._ids.get(short)
+            if link_id is not None:
+                self._set_free(link_id, self._rows[link_id])
+
+    def links_deactivate_chunk(self, age: int, after: Optional[Tuple[datetime, int]], limit: int) -> List[tuple]:
+        with self._lock:
+            chunk = self._chunk('active', age, after, limit)
+            for date_access, link_id in chunk:
+                self._rows[link_id][3] = 'inactive'
+            return chunk
+
+    def links_expire_chunk(self, age: int, after: Optional[Tuple[datetime, int]], limit: int) -> List[tuple]:
+        with self._lock:
+            chunk = self._chunk('inactive', age, after, limit)
+            expired = []
+            for date_access, link_id in chunk:
+                row = self._rows[link_id]
+                self._set_free(link_id, row)
+                expired.append((date_access, link_id, row[0]))
+            return expired
+
+    def _chunk(self, status: str, age: int, after: Optional[Tuple[datetime, int]], limit: int) -> List[tuple]:
+        cutoff = datetime.now() - timedelta(seconds=age)
+        after = after or (datetime.min, 0)
+        return heapq.nsmallest(limit, (
+            (row[2], link_id) for link_id, row in self._rows.items()
+            if row[3] == status and row[2] < cutoff and (row[2], link_id) > after
+        ))
+
+    def _active_row(self, short: str) -> Optional[list]:
+        link_id = self._ids.get(short)
+        if link_id is None:
+            return None
+        row = self._rows[link_id]
+        if row[3] not in ('active', 'inactive'):
+            return None
+        return row
+
+    def _set_free(self, link_id: int, row: list, keep_origin: bool = False):
+        if not keep_origin:
+            row[1] = None
+            self._hits.pop(link_id, None)
+        row[3] = 'free'
+        self._free[link_id] = None
+
+
+# Методы слоя БД, каждый из которых - один запрос
+_QUERIES = (
+    'link_ids_reserve', 'link_create', 'links_create', 'links_reserve_free', 'link_reuse_reserved',
+    'links_release_reserved', 'links_release_stale_reserved', 'link_select', 'links_select_origins',
+    'links_select_recent', 'links_select', 'links_select_after', 'link_actualize', 'links_actualize', 'links_hit',
+    'link_delete', 'links_deactivate_chunk', 'links_expire_chunk',
+)
+
+
+class FakeDBShortlinks:
+    """
+    Синхронная подмена DBShortlinks поверх FakeLinkTable
+    """
+    def __init__(self, table: FakeLinkTable = None, latency: float = 0.0):
+        self.table = table if table is not None else FakeLinkTable()
+        self.latency = latency
+        self.round_trips = 0
+        self._link_ids = Reservoir(self.link_ids_reserve, config.DB_ID_RESERVE_SIZE)
+
+    def link_id_take(self) -> int:
+        return self._link_ids.take()
+
+    def link_id_put_back(self, link_id: int):
+        self._link_ids.put_back(link_id)
+
+    def links_stream(self, after_id: int = 0) -> Iterator[tuple]:
+        self._round_trip()
+        return self.table.links_stream(after_id)
+
+    def connector_stats(self) -> Dict[str, float]:
+        return {'round_trips': self.round_trips}
+
+    def replica_stats(self) -> Dict[str, Dict[str, float]]:
+        return {}
+
+    def close(self):
+        pass
+
+    def _round_trip(self):
+        self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class AsyncFakeDBShortlinks:
+    """
+    Асинхронная подмена AsyncDBShortlinks поверх той же FakeLinkTable
+    """
+    def __init__(self, table: FakeLinkTable = None, latency: float = 0.0):
+        self.table = table if table is not None else FakeLinkTable()
+        self.latency = latency
+        self.round_trips = 0
+        self._link_ids = Reservoir(self.link_ids_reserve, config.DB_ID_RESERVE_SIZE)
+
+    async def pool_fill(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def link_id_take(self) -> int:
+        return await self._link_ids.take_async()
+
+    def link_id_put_back(self, link_id: int):
+        self._link_ids.put_back(link_id)
+
+    async def links_stream(self, after_id: int = 0) -> AsyncIterator[tuple]:
+        await self._round_trip()
+        for row in self.table.links_stream(after_id):
+            yield row
+
+    def connector_stats(self) -> Dict[str, float]:
+        return {'round_trips': self.round_trips}
+
+    def replica_stats(self) -> Dict[str, Dict[str, float]]:
+        return {}
+
+    async def _round_trip(self):
+        self.round_trips += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+
+def _sync_query(name: str):
+    def query(self, *args) -> Any:
+        self._round_trip()
+        return getattr(self.table, name)(*args)
+    query.__name__ = name
+    return query
+
+
+def _async_query(name: str):
+    async def query(self, *args) -> Any:
+        await self._round_trip()
+        return getattr(self.table, name)(*args)
+    query.__name__ = name
+    return query
+
+
+for _name in _QUERIES:
+    setattr(FakeDBShortlinks, _name, _sync_query(_name))
+    setattr(AsyncFakeDBShortlinks, _name, _async_query(_name))
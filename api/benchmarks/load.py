@@ -0,0 +1,291 @@
+"""
+Нагрузочный замер: воспроизводимая смесь запросов к сервису, результат - JSON для сравнения между версиями.
+
+Смесь задается долями операций (--mix): resolve - одна ссылка, resolve_batch - пачка из BATCH ссылок,
+create, delete и expiry - тик обслуживания БД (деактивация и освобождение устаревших).
+Какие ссылки читаются, выбирается по закону Ципфа (--zipf): немногие ссылки популярны, у остальных длинный хвост.
+Порядок операций и выбор ссылок определяются только --seed, так что два прогона дают одну и ту же нагрузку.
+
+Цели (--target):
+- fake - таблица ссылок в памяти (benchmarks.fake_db) с задержкой --latency секунд на запрос;
+  устаревать ей есть чему, время доступа у залитых ссылок разбросано до 1.5 * SHORTLINK_TTL_HARD назад;
+- postgres - настоящая БД, как ее видит сервис (хост из SHORTLINKS_DB_HOST или config). Замер пишет в БД:
+  заливает --links новых ссылок, создает и удаляет ссылки по смеси.
+
+Режимы (--mode):
+- datamanager - вызовы синхронного DataManager подряд в одном потоке;
+- app - HTTP-запросы к приложению FastAPI в процессе (через httpx), --concurrency одновременных клиентов.
+  Тик обслуживания в этом режиме вызывается у AsyncDataManager напрямую, HTTP-метода для него нет.
+
+Размеры кэшей в config рассчитаны на демонстрацию, поэтому замер ставит свои (BENCH_CONFIG),
+любой параметр config можно переопределить через --set ИМЯ=значение.
+
+    python -m benchmarks.load [--target fake|postgres] [--mode datamanager|app] [--requests N] [--links N]
+        [--mix resolve=90,resolve_batch=2,create=5,delete=2,expiry=1] [--zipf 1.1] [--latency 0.0005]
+        [--concurrency 32] [--seed 1] [--set ИМЯ=значение ...] [--output файл.json]
+
+В результате: req/s, p50/p99 задержки в целом и по операциям, запросов к БД на операцию
+(для fake - вызовов слоя БД, для postgres - выполненных запросов по метрике shortlinks_db_query_seconds)
+и доля попаданий кэша чтения.
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy
+
+from config import config
+
+DEFAULT_MIX = 'resolve=90,resolve_batch=2,create=5,delete=2,expiry=1'
+OPERATIONS = ('resolve', 'resolve_batch', 'create', 'delete', 'expiry')
+BATCH = 20
+
+BENCH_CONFIG = {
+    'CACHE_READ_MAXSIZE': 100_000,
+    'CACHE_WRITE_MAXSIZE': 10_000,
+    'MAINTENANCE_MODE': 'external',  # тики обслуживания задает смесь, а не фоновая задача
+}
+
+Operation = Tuple[str, Any]
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Нагрузочный замер shortlinks')
+    parser.add_argument('--target', choices=('fake', 'postgres'), default='fake')
+    parser.add_argument('--mode', choices=('datamanager', 'app'), default='datamanager')
+    parser.add_argument('--requests', type=int, default=50_000)
+    parser.add_argument('--links', type=int, default=100_000, help='сколько ссылок залить перед замером')
+    parser.add_argument('--mix', default=DEFAULT_MIX)
+    parser.add_argument('--zipf', type=float, default=1.1, help='показатель закона Ципфа для выбора ссылок')
+    parser.add_argument('--latency', type=float, default=0.0, help='секунд на запрос к fake-БД')
+    parser.add_argument('--concurrency', type=int, default=32, help='одновременных клиентов в режиме app')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--set', action='append', default=[], metavar='ИМЯ=значение', help='переопределить config')
+    parser.add_argument('--output', help='куда записать JSON, по умолчанию stdout')
+    return parser.parse_args(argv)
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        if name not in OPERATIONS:
+            raise SystemExit(f'Неизвестная операция в смеси: {name}, допустимы: {", ".join(OPERATIONS)}')
+        weights[name] = float(weight)
+    return weights
+
+
+def apply_config(overrides: List[str]) -> Dict[str, Any]:
+    """
+    Кэши строятся при импорте src.data_manager, так что config надо поправить до него
+    """
+    settings = dict(BENCH_CONFIG)
+    for override in overrides:
+        name, _, value = override.partition('=')
+        if not hasattr(config, name):
+            raise SystemExit(f'Нет такого параметра config: {name}')
+        settings[name] = type(getattr(config, name))(value) if getattr(config, name) is not None else value
+    for name, value in settings.items():
+        setattr(config, name, value)
+    return settings
+
+
+def build_workload(args: argparse.Namespace, rng: 'numpy.random.Generator') -> List[Operation]:
+    """
+    Ссылки задаются номерами в заливке. Популярность по Ципфу раздается номерам в случайном порядке,
+    чтобы популярные ссылки не шли подряд по id.
+    """
+    weights = parse_mix(args.mix)
+    names = list(weights)
+    probabilities = numpy.array([weights[name] for name in names])
+    kinds = rng.choice(len(names), size=args.requests, p=probabilities / probabilities.sum())
+    ranks = 1.0 / numpy.arange(1, args.links + 1) ** args.zipf
+    popularity = rng.permutation(args.links)
+
+    def popular(size: int) -> List[int]:
+        return popularity[rng.choice(args.links, size=size, p=ranks / ranks.sum())].tolist()
+
+    resolves = iter(popular(args.requests))
+    workload = []
+    for number, kind in enumerate(kinds):
+        name = names[kind]
+        if name == 'resolve':
+            workload.append((name, next(resolves)))
+        elif name == 'resolve_batch':
+            workload.append((name, popular(BATCH)))
+        elif name == 'create':
+            workload.append((name, f'https://example.com/bench/{args.seed}/{number}'))
+        elif name == 'delete':
+            workload.append((name, int(rng.integers(args.links))))
+        else:
+            workload.append((name, None))
+    return workload
+
+
+def percentiles(latencies: List[float]) -> Dict[str, float]:
+    if not latencies:
+        return {'count': 0}
+    p50, p99 = numpy.percentile(latencies, [50, 99]) * 1000
+    return {'count': len(latencies), 'p50_ms': round(float(p50), 4), 'p99_ms': round(float(p99), 4)}
+
+
+def seed_fake(table, count: int, rng: 'numpy.random.Generator') -> List[str]:
+    from src.shortlink_generator import build_shortlink_encoder
+    encoder = build_shortlink_encoder(config.SHORTLINK_SCHEME, config.SHORTLINK_KEY)
+    link_ids = list(range(1, count + 1))
+    shorts = encoder.encode_many(link_ids)
+    ages = rng.uniform(0, config.SHORTLINK_TTL_HARD * 1.5, size=count).tolist()
+    table.seed(shorts, [f'https://example.com/seed/{link_id}' for link_id in link_ids], ages)
+    return shorts
+
+
+class Counters:
+    """
+    Снимок счетчиков до и после замера: запросы к БД и обращения к кэшу чтения
+    """
+    def __init__(self, round_trips: Callable[[], int]):
+        from src.data_manager import DataManager
+        self._round_trips = round_trips
+        self._cache = DataManager._cache_lru
+        self._start = self._snapshot()
+
+    def delta(self) -> Dict[str, float]:
+        round_trips, hits, misses = (end - start for start, end in zip(self._start, self._snapshot()))
+        return {'round_trips': round_trips, 'hits': hits, 'misses': misses}
+
+    def _snapshot(self) -> Tuple[int, int, int]:
+        stats = self._cache.stats()
+        return self._round_trips(), stats['hits'], stats['misses']
+
+
+def run_datamanager(data_manager, workload: List[Operation], shorts: List[str]) -> Dict[str, List[float]]:
+    from src.db import ShortlinkNotFound
+    actions = {
+        'resolve': lambda index: data_manager.shortlink_get(shorts[index]),
+        'resolve_batch': lambda indexes: data_manager.shortlinks_resolve([shorts[index] for index in indexes]),
+        'create': data_manager.shortlink_create,
+        'delete': lambda index: data_manager.shortlink_delete(shorts[index]),
+        'expiry': lambda _: (data_manager.shortlink_deactivate_all_expired(), data_manager.shortlink_delete_all_expired()),
+    }
+    latencies = {name: [] for name in OPERATIONS}
+    for name, argument in workload:
+        started = time.perf_counter()
+        try:
+            actions[name](argument)
+        except ShortlinkNotFound:
+            pass
+        latencies[name].append(time.perf_counter() - started)
+    return latencies
+
+
+async def run_app(app, data_manager, workload: List[Operation], shorts: List[str], concurrency: int) -> Dict[str, List[float]]:
+    import httpx
+    latencies = {name: [] for name in OPERATIONS}
+    operations = iter(workload)
+
+    async def expiry():
+        await data_manager.shortlink_deactivate_all_expired()
+        await data_manager.shortlink_delete_all_expired()
+
+    async def client_loop(client: 'httpx.AsyncClient'):
+        actions = {
+            'resolve': lambda index: client.get(f'/link/{shorts[index]}'),
+            'resolve_batch': lambda indexes: client.post('/links/resolve', json=[shorts[index] for index in indexes]),
+            'create': lambda origin: client.put('/link/', params={'origin': origin}),
+            'delete': lambda index: client.delete('/link/', params={'short': shorts[index]}),
+            'expiry': lambda _: expiry(),
+        }
+        for name, argument in operations:
+            started = time.perf_counter()
+            await actions[name](argument)
+            latencies[name].append(time.perf_counter() - started)
+
+    for handler in app.router.on_startup:
+        await handler()
+    try:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+            await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+    finally:
+        for handler in app.router.on_shutdown:
+            await handler()
+    return latencies
+
+
+def main(argv: List[str]):
+    args = parse_args(argv)
+    settings = apply_config(args.set)
+    rng = numpy.random.default_rng(args.seed)
+    workload = build_workload(args, rng)
+
+    import launcher
+    from src import db as db_module
+    from src.data_manager import DataManager, AsyncDataManager
+
+    if args.target == 'fake':
+        from benchmarks.fake_db import FakeLinkTable, FakeDBShortlinks, AsyncFakeDBShortlinks
+        table = FakeLinkTable()
+        shorts = seed_fake(table, args.links, rng)
+        db = FakeDBShortlinks(table, latency=args.latency)
+        db_async = AsyncFakeDBShortlinks(table, latency=args.latency)
+        launcher._db_shared = lru_cache(maxsize=None)(lambda: db)
+        launcher._db_shared_async = lru_cache(maxsize=None)(lambda: db_async)
+        launcher.database_check_or_init = lambda: None
+        round_trips = lambda: db.round_trips + db_async.round_trips
+    else:
+        launcher.database_check_or_init()
+        shorts = launcher.get_datamanager().shortlinks_create(
+            [f'https://example.com/seed/{args.seed}/{number}' for number in range(args.links)])
+        round_trips = db_module.QUERY_SECONDS.total_count
+
+    counters = Counters(round_trips)
+    started = time.perf_counter()
+    if args.mode == 'datamanager':
+        data_manager = DataManager(launcher._db_shared())
+        data_manager.writeback_start()
+        data_manager.free_reserve_start()
+        try:
+            latencies = run_datamanager(data_manager, workload, shorts)
+        finally:
+            data_manager.writeback_stop()
+            data_manager.free_reserve_stop()
+    else:
+        data_manager = AsyncDataManager(launcher._db_shared_async())
+        latencies = asyncio.run(run_app(launcher.app, data_manager, workload, shorts, args.concurrency))
+    duration = time.perf_counter() - started
+    delta = counters.delta()
+
+    lookups = delta['hits'] + delta['misses']
+    result = {
+        'target': args.target,
+        'mode': args.mode,
+        'seed': args.seed,
+        'requests': args.requests,
+        'links': args.links,
+        'mix': parse_mix(args.mix),
+        'zipf': args.zipf,
+        'latency': args.latency,
+        'concurrency': args.concurrency if args.mode == 'app' else 1,
+        'config': settings,
+        'duration_s': round(duration, 4),
+        'rps': round(args.requests / duration, 1),
+        'latency_ms': percentiles([value for values in latencies.values() for value in values]),
+        'operations': {name: percentiles(values) for name, values in latencies.items() if values},
+        'db_round_trips_per_request': round(delta['round_trips'] / args.requests, 4),
+        'cache_hit_ratio': round(delta['hits'] / lookups, 4) if lookups else None,
+    }
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
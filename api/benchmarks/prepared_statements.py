@@ -0,0 +1,63 @@
+"""
+Задержка запросов пути чтения ссылок: текст запроса каждый раз заново против подготовленного (PREPARE/EXECUTE).
+
+Нужна живая БД с заполненной таблицей ссылок (хост берется так же, как в сервисе).
+Запросы идут по одному подключению, чтобы в замер не попадал пул.
+
+    python -m benchmarks.prepared_statements [количество запросов]
+"""
+
+import sys
+import time
+from typing import Callable, List
+
+from config import config
+from launcher import _get_db_host
+from src.db import DBShortlinks
+
+DEFAULT_COUNT = 20_000
+BATCH = 100
+
+
+def measure(run: Callable[[int], None], count: int) -> float:
+    """
+    Микросекунды на запрос
+    """
+    run(0)  # прогрев: подготовка запроса и кэш страниц
+    started = time.perf_counter()
+    for number in range(count):
+        run(number)
+    return (time.perf_counter() - started) / count * 1_000_000
+
+
+def main(count: int):
+    db = DBShortlinks(dbname=config.DB_NAME, user=config.DB_USER, password=config.DB_PASSWORD, host=_get_db_host())
+    db._connector.autocommit_enable()
+    shorts: List[str] = [row[0] for row in db.links_select(config.SELECT_HARD_LIMIT, 0)]
+    if len(shorts) < BATCH:
+        raise SystemExit('В БД слишком мало ссылок для замера')
+    connector = db._connector
+    queries = {
+        'link_select': (
+            """SELECT origin
+            FROM shortlinks.link
+            WHERE short=%s AND status IN ('active', 'inactive')""",
+            lambda number: (shorts[number % len(shorts)],),
+        ),
+        'links_select_origins': (
+            """SELECT short, origin
+            FROM shortlinks.link
+            WHERE short = ANY(%s) AND status IN ('active', 'inactive')""",
+            lambda number: (shorts[number % (len(shorts) - BATCH):][:BATCH],),
+        ),
+    }
+    print(f"{'query':>22} {'text, us':>10} {'prepared, us':>13} {'speedup':>8}")
+    for name, (query, args) in queries.items():
+        text = measure(lambda number: connector.execute(name, query, args(number)).fetchall(), count)
+        prepared = measure(lambda number: connector.execute_prepared(name, query, args(number)).fetchall(), count)
+        print(f'{name:>22} {text:>10.1f} {prepared:>13.1f} {text / prepared:>7.2f}x')
+    db.close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_COUNT)
@@ -0,0 +1,76 @@
+"""
+Проверка схем коротких ссылок на коллизии перебором всего диапазона id, параллельно на всех ядрах.
+
+- crc32: все id от 1 до 10 млн. Процессы считают CRC32 своих кусков, и все значения целиком
+  проверяются на уникальность и на то, что код выходит ровно 6 символов.
+- feistel: каждый процесс проверяет свой кусок через обратную перестановку, decode(permute(id)) == id.
+  Если каждое значение однозначно возвращается в свой id, два разных id не могут дать одно значение.
+  Памяти на это не нужно, так что можно пройти все 2^36 id (на одном ядре это часы).
+
+    python -m benchmarks.shortlink_collisions crc32 [процессов]
+    python -m benchmarks.shortlink_collisions feistel [процессов] [до id]
+"""
+
+import os
+import sys
+import time
+from multiprocessing import Pool
+from typing import List, Tuple
+
+import numpy as np
+
+from config import config
+from src.shortlink_generator import (
+    CRC32_PADDING_SIZE, Crc32Encoder, FeistelEncoder, crc32_many,
+)
+
+CHUNK_SIZE = 1 << 22
+
+
+def chunks(stop: int) -> List[Tuple[int, int]]:
+    return [(start, min(start + CHUNK_SIZE, stop + 1)) for start in range(1, stop + 1, CHUNK_SIZE)]
+
+
+def crc32_chunk(bounds: Tuple[int, int]) -> np.ndarray:
+    return crc32_many(np.arange(*bounds, dtype=np.uint32))
+
+
+def feistel_chunk(bounds: Tuple[int, int]) -> int:
+    """
+    Возвращает количество id куска, которые не вернулись обратно или вышли за разрядность
+    """
+    encoder = FeistelEncoder(config.SHORTLINK_KEY)
+    numbers = np.arange(*bounds, dtype=np.uint64)
+    values = encoder.permute_many(numbers)
+    broken = (encoder.decode_many(values) != numbers) | (values > np.uint64(encoder.max_number))
+    return int(broken.sum())
+
+
+def check_crc32(processes: int) -> bool:
+    with Pool(processes) as pool:
+        values = np.concatenate(pool.map(crc32_chunk, chunks(Crc32Encoder.max_number)))
+    padded = values.astype(np.uint64) + np.uint64(10 ** CRC32_PADDING_SIZE)
+    unique = np.unique(values).size
+    fixed_length = bool(padded.min() >= 64 ** 5 and padded.max() < 64 ** 6)
+    print(f'ids: {values.size}, unique: {unique}, 6 chars: {fixed_length}')
+    return unique == values.size and fixed_length
+
+
+def check_feistel(processes: int, stop: int) -> bool:
+    with Pool(processes) as pool:
+        broken = sum(pool.imap_unordered(feistel_chunk, chunks(stop)))
+    print(f'ids: {stop}, broken: {broken}')
+    return broken == 0
+
+
+if __name__ == '__main__':
+    scheme = sys.argv[1] if len(sys.argv) > 1 else 'crc32'
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    started = time.perf_counter()
+    if scheme == 'crc32':
+        ok = check_crc32(processes)
+    else:
+        stop = int(sys.argv[3]) if len(sys.argv) > 3 else FeistelEncoder(config.SHORTLINK_KEY).max_number
+        ok = check_feistel(processes, stop)
+    print(f"{'OK' if ok else 'COLLISIONS'} in {time.perf_counter() - started:.1f} s on {processes} processes")
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,33 @@
+"""
+Скорость получения коротких ссылок: поштучно в цикле против пакетного encode_many.
+
+    python -m benchmarks.shortlink_hash [количество]
+"""
+
+import sys
+import time
+
+from config import config
+from src.shortlink_generator import Crc32Encoder, FeistelEncoder
+
+DEFAULT_COUNT = 1_000_000
+
+
+def measure(encoder, count: int):
+    numbers = list(range(1, count + 1))
+    started = time.perf_counter()
+    single = [encoder.encode(number) for number in numbers]
+    single_rate = count / (time.perf_counter() - started)
+    started = time.perf_counter()
+    batch = encoder.encode_many(numbers)
+    batch_rate = count / (time.perf_counter() - started)
+    assert single == batch
+    return single_rate, batch_rate
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_COUNT
+    print(f"{'scheme':>10} {'single, 1/s':>14} {'batch, 1/s':>14}")
+    for name, encoder in (('crc32', Crc32Encoder()), ('feistel', FeistelEncoder(config.SHORTLINK_KEY))):
+        single_rate, batch_rate = measure(encoder, count)
+        print(f'{name:>10} {single_rate:>14.0f} {batch_rate:>14.0f}')
@@ -8,18 +8,88 @@ class config:
     SHORTLINK_TTL_SOFT = 60 * 60 * 24 * 3
     SHORTLINK_TTL_HARD = 60 * 60 * 24 * 7
 
+    # Схема получения короткой ссылки из id, выбирается один раз на всю БД.
+    # 'crc32' - исходная, до 10 млн. ссылок; 'feistel' - ключевая перестановка 36-битного пространства id.
+    SHORTLINK_SCHEME = 'crc32'
+    SHORTLINK_KEY = 0x5EED_1D5 # ключ перестановки для 'feistel', в проде задать свой и не менять
+
     # Каленькие размеры кэшей стоят для удобства демонстрации.
     # В проде можно ставить десятки/сотни тысяч, в зависимости от оперативки.
     CACHE_READ_MAXSIZE = 5
+    # Сколько секунд ссылка живет в кэше чтения с момента чтения из БД. Без обращений ссылка освобождается
+    # в БД не раньше SHORTLINK_TTL_HARD, срок кэша короче, с запасом на отложенное обновление времени доступа,
+    # так что ссылку, освобожденную и занятую заново в БД, воркер из кэша уже не отдаст.
+    CACHE_READ_TTL = SHORTLINK_TTL_HARD - SHORTLINK_TTL_SOFT
     CACHE_WRITE_MAXSIZE = 3
+    CACHE_WRITE_BATCHSIZE = 1000 # сколько ссылок обновлять в БД одним запросом при сбросе кэша
+    CACHE_WRITE_MAXAGE = 5 # seconds, не дольше скольки секунд обновление ждет в кэше фонового сброса
+    CACHE_WRITE_MAXPENDING = 100_000 # больше скольки ссылок не копить, если БД не успевает
+
+    # Кэш несуществующих ссылок, чтобы перебор случайных кодов не долбил БД.
+    # Ссылка, созданная другим воркером, может отдавать 404 в этом воркере не дольше TTL.
+    CACHE_NEGATIVE_MAXSIZE = 10_000
+    CACHE_NEGATIVE_TTL = 60 # seconds
+
+    # Общий для всех воркеров уровень кэша чтения за локальным LRU.
+    # None - выключен, 'mmap' - файл в общей памяти, 'local' - заглушка в памяти процесса для разработки.
+    CACHE_SHARED_BACKEND = None
+    CACHE_SHARED_PATH = '/dev/shm/shortlinks.cache'
+    CACHE_SHARED_SLOTS = 4096 # каждый слот ~2 КБ
+    CACHE_SHARED_JOURNAL_SIZE = 1024 # сколько последних удалений помнить для сброса локальных кэшей
+
+    # Снимок кэша чтения для теплого перезапуска: при остановке воркер пишет в файл самые свежие записи,
+    # при старте кэш заполняется из него, а без снимка - ссылками, к которым последними обращались в БД.
+    # None - выключено, кэш стартует пустым.
+    CACHE_SNAPSHOT_PATH = '/var/lib/shortlinks/cache.snapshot'
+    CACHE_SNAPSHOT_SIZE = CACHE_READ_MAXSIZE
 
     # Короткий интервал выбран тоже для отладки. На деле можно обслуживать сервис раз в несколько минут.
     BACKGROUND_WORKER_INTERVAL = 10 # seconds
+    # Устаревание ссылок идет кусками по EXPIRY_CHUNK_SIZE строк, не дольше EXPIRY_TIME_BUDGET секунд за тик воркера,
+    # следующий тик продолжает с того же места.
+    EXPIRY_CHUNK_SIZE = 1000
+    EXPIRY_TIME_BUDGET = 2 # seconds
+
+    # Обслуживанием БД занимается один процесс на всю БД, тот, кто держит advisory-блокировку с этим ключом.
+    # 'workers' - один из воркеров сервиса, 'external' - отдельный процесс maintainer.py, воркеры им не занимаются.
+    MAINTENANCE_MODE = 'workers'
+    MAINTENANCE_LOCK_KEY = 7_240_001
+
+    # Хранилище ссылок. 'postgres' - общая БД для всех узлов, 'sqlite' - встроенный файл DB_SQLITE_PATH
+    # на один узел (журнал WAL, все процессы узла работают с одним файлом), снимок переносится через snapshot.py.
+    DB_BACKEND = 'postgres'
+    DB_SQLITE_PATH = '/var/lib/shortlinks/shortlinks.sqlite'
 
     DB_NAME     = 'shortlinks'
     DB_USER     = 'postgres'
     DB_PASSWORD = '123123'
     DB_HOST     = '127.0.0.1'
 
+    # Пул подключений общий на процесс воркера, так что в сумме подключений будет maxsize * число воркеров.
+    DB_POOL_MINSIZE = 1
+    DB_POOL_MAXSIZE = 10
+    DB_POOL_TIMEOUT = 5 # seconds, сколько ждать свободное подключение
+    DB_POOL_IDLE_TIMEOUT = 300 # seconds, после скольки секунд простоя закрывать лишние подключения
+    DB_POOL_HEALTHCHECK_INTERVAL = 30 # seconds, после скольки секунд простоя проверять подключение перед выдачей
+    DB_CONNECT_TIMEOUT = 5 # seconds, сколько ждать установки подключения к серверу
+
+    # Реплики только для чтения (хосты, или переменная окружения SHORTLINKS_DB_REPLICA_HOSTS через запятую).
+    # На них идет чтение ссылок и страниц, запись и обслуживание - на DB_HOST. Без реплик все идет на DB_HOST.
+    DB_REPLICA_HOSTS = ()
+    DB_REPLICA_POLICY = 'latency' # 'latency' - самая быстрая по среднему времени запроса, 'round_robin' - по очереди
+    DB_REPLICA_MAX_LAG = 5 # seconds, реплика, которая отстает больше, не используется до следующей проверки
+    DB_REPLICA_CHECK_INTERVAL = 5 # seconds, как часто проверять отставание реплики, и сколько не трогать упавшую
+
     SELECT_HARD_LIMIT = 1000
+    DB_STREAM_BATCHSIZE = 10_000 # сколько строк за раз подтягивать из серверного курсора при выгрузке
+
+    DB_ID_RESERVE_SIZE = 100 # сколько id новых ссылок резервировать в БД за раз
+    DB_CREATE_BATCHSIZE = 10_000 # сколько ссылок создавать одним запросом при пакетном создании
+
+    # Запас свободных ссылок, заранее зарезервированных за процессом, чтобы создание ссылки
+    # не искало свободную строку в БД. Пополняется в фоне, при остановке возвращается.
+    FREE_RESERVE_SIZE = 100
+    FREE_RESERVE_LOW = 20 # ниже скольки пополнять
+    FREE_RESERVE_INTERVAL = 10 # seconds, как часто проверять, не появились ли свободные ссылки
+    FREE_RESERVE_MAXAGE = 60 * 60 # seconds, через сколько резерв упавшего процесса снова становится свободным
 
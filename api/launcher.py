@@ -13,16 +13,25 @@
 """
 
 
-from typing import Dict, Any
+from typing import Dict, Any, List
+from functools import lru_cache
 import os
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Body
+from fastapi.responses import Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from fastapi_utils.tasks import repeat_every
 from config import config
 
-from src.data_manager import DataManager
-from src.db import DBShortlinks, LazyDBShortlinks, ShortlinkNotFound, Installer
+from src.data_manager import DataManager, AsyncDataManager
+from src.db import DBShortlinks, LazyDBShortlinks, PooledDBShortlinks, ShortlinkNotFound, Installer, LeaderLock
+from src.db_async import AsyncDBShortlinks
+from src.db_sqlite import SQLiteDBShortlinks, AsyncSQLiteDBShortlinks, FileLeaderLock
+from src.export import MEDIA_TYPES
+from src.maintenance import Maintenance
+from src import metrics
 
 app = FastAPI()
+app.add_middleware(metrics.MetricsMiddleware)
 
 def _get_db_host() -> str:
     """
@@ -35,30 +44,130 @@ def _get_db_host() -> str:
         host = config.DB_HOST
     return host
 
-def _db_connect(lazy: bool=False) -> DBShortlinks:
-    db_factory = LazyDBShortlinks if lazy else DBShortlinks
+def _get_db_replica_hosts() -> List[str]:
+    """
+    Хосты реплик для чтения, так же: из переменной окружения (через запятую), иначе из конфига
+    """
+    try:
+        hosts = [host.strip() for host in os.environ['SHORTLINKS_DB_REPLICA_HOSTS'].split(',')]
+    except KeyError:
+        hosts = list(config.DB_REPLICA_HOSTS)
+    return [host for host in hosts if host]
+
+def _db_connect(lazy: bool=False, pooled: bool=False, replicated: bool=False) -> DBShortlinks:
+    if pooled:
+        db_factory = PooledDBShortlinks
+    elif lazy:
+        db_factory = LazyDBShortlinks
+    else:
+        db_factory = DBShortlinks
     host = _get_db_host()
     db = db_factory(
         dbname=config.DB_NAME,
         user=config.DB_USER,
         password=config.DB_PASSWORD,
         host=host,
+        replica_hosts=_get_db_replica_hosts() if replicated else (),
     )
     return db
 
+@lru_cache(maxsize=None)
+def _db_shared() -> PooledDBShortlinks:
+    """
+    Общий на процесс экземпляр БД. Подключения берутся из пула на время запроса,
+    так что рукопожатие с БД не повторяется на каждый HTTP-запрос.
+    При DB_BACKEND = 'sqlite' - встроенный файл БД узла.
+    """
+    if config.DB_BACKEND == 'sqlite':
+        return SQLiteDBShortlinks(config.DB_SQLITE_PATH)
+    return _db_connect(pooled=True, replicated=True)
+
+@lru_cache(maxsize=None)
+def _db_shared_async() -> AsyncDBShortlinks:
+    """
+    То же, что и _db_shared, только для асинхронной БД
+    """
+    if config.DB_BACKEND == 'sqlite':
+        return AsyncSQLiteDBShortlinks(_db_shared())
+    return AsyncDBShortlinks(
+        dbname=config.DB_NAME,
+        user=config.DB_USER,
+        password=config.DB_PASSWORD,
+        host=_get_db_host(),
+        replica_hosts=_get_db_replica_hosts(),
+    )
+
 def get_datamanager() -> DataManager:
+    """
+    Синхронный датаменеджер, для кода вне event loop
+    """
+    data_manager = DataManager(_db_shared())
+    return data_manager
+
+def get_async_datamanager() -> AsyncDataManager:
     """
     Используется как зависимость FastAPI
     """
-    db = _db_connect(lazy=True)
-    data_manager = DataManager(db)
+    data_manager = AsyncDataManager(_db_shared_async())
     return data_manager
 
+@lru_cache(maxsize=None)
+def get_maintenance() -> Maintenance:
+    """
+    Обслуживание БД процесса. Работает, только пока процесс - лидер (держит advisory-блокировку,
+    а для встроенной БД - блокировку файла рядом с ней)
+    """
+    if config.DB_BACKEND == 'sqlite':
+        return Maintenance(get_datamanager(), FileLeaderLock(config.DB_SQLITE_PATH + '.leader'))
+    leader = LeaderLock(
+        dbname=config.DB_NAME,
+        user=config.DB_USER,
+        password=config.DB_PASSWORD,
+        host=_get_db_host(),
+        key=config.MAINTENANCE_LOCK_KEY,
+    )
+    return Maintenance(get_datamanager(), leader)
+
+def _db_pool_stats() -> Dict[str, Dict[str, float]]:
+    """
+    Пулы подключений процесса: асинхронный обслуживает запросы, синхронный - обслуживание БД.
+    Еще не созданные пулы не создаются ради метрик.
+    """
+    stats = {}
+    if _db_shared_async.cache_info().currsize:
+        stats['async'] = _db_shared_async().connector_stats()
+    if _db_shared.cache_info().currsize:
+        stats['sync'] = _db_shared().connector_stats()
+    return stats
+
+
+def _db_replica_stats() -> Dict[str, Dict[str, float]]:
+    """
+    Реплики для чтения по пулам, метка - пул:хост реплики
+    """
+    stats = {}
+    if _db_shared_async.cache_info().currsize:
+        stats.update({f'async:{name}': values for name, values in _db_shared_async().replica_stats().items()})
+    if _db_shared.cache_info().currsize:
+        stats.update({f'sync:{name}': values for name, values in _db_shared().replica_stats().items()})
+    return stats
+
+
+metrics.REGISTRY.register_stats(
+    'shortlinks_db_replica', 'Реплики БД для чтения', _db_replica_stats,
+    counters=('reads', 'errors', 'fallbacks'), label='replica')
+metrics.REGISTRY.register_stats(
+    'shortlinks_db_pool', 'Пул подключений к БД', _db_pool_stats,
+    counters=('wait_count', 'wait_time_total', 'timeouts'), label='pool')
+
 
 def database_check_or_init():
     """
     Проверяет наличие БД и схемы, и создает всё нужное при необходимости
     """
+    if config.DB_BACKEND == 'sqlite':
+        _db_shared().init_database()
+        return
     host = _get_db_host()
     installer = Installer(
         dbname='postgres', user=config.DB_USER, password=config.DB_PASSWORD, host=host)
@@ -68,10 +177,15 @@ def database_check_or_init():
 @app.on_event('startup')
 async def init():
     """
-    При старте сервиса проверяем БД
+    При старте сервиса проверяем БД и прогреваем кэш чтения (из снимка прошлого запуска или из БД),
+    чтобы первые запросы после перезапуска не уходили в БД разом
     """
     try:
         database_check_or_init()
+        await _db_shared_async().pool_fill()
+        await get_async_datamanager().cache_warm()
+        get_async_datamanager().writeback_start()
+        get_async_datamanager().free_reserve_start()
     except Exception as e:
         raise Exception(f'Failed to connect to datamanager: {e}')
 
@@ -81,55 +195,140 @@ async def init():
 async def background_worker():
     """
     При желании можно сделать воркеры с разными периодами.
-    Для флуша кэша короткий, для обслуживания - длинный.
+    Кэш обновления доступа сбрасывается отдельной фоновой задачей, здесь только обслуживание.
+
+    Обслуживание выполняет только один воркер на всю БД (лидер), и в пуле потоков, чтобы не занимать event loop.
+    При MAINTENANCE_MODE = 'external' им занимается отдельный процесс maintainer.py.
+    Истекшие записи кэша чтения у каждого воркера свои, их выкидывает каждый.
+    """
+    get_async_datamanager().cache_sweep()
+    if config.MAINTENANCE_MODE != 'workers':
+        return
+    await run_in_threadpool(get_maintenance().tick)
+
+
+@app.on_event('startup')
+@repeat_every(seconds=config.DB_REPLICA_CHECK_INTERVAL)
+async def replica_checker():
+    """
+    Проверяет отставание реплик для чтения, чтобы запросы только выбирали реплику и ничего не ждали.
+    Синхронный слой блокирует поток при проверке, поэтому его проверка - в пуле потоков, и только если он уже создан.
     """
-    data_manager = get_datamanager()
-    data_manager.flush_writeback_cache()
-    data_manager.shortlink_deactivate_all_expired()
-    data_manager.shortlink_delete_all_expired()
+    await _db_shared_async().replicas_check()
+    if _db_shared.cache_info().currsize:
+        await run_in_threadpool(_db_shared().replicas_check)
+
 
 @app.on_event('shutdown')
 async def shutdown():
-    data_manager = get_datamanager()
-    data_manager.flush_writeback_cache()
+    data_manager = get_async_datamanager()
+    await data_manager.writeback_stop()
+    await data_manager.free_reserve_stop()
+    try:
+        data_manager.cache_snapshot_save()
+    except OSError:
+        pass  # без снимка следующий запуск прогреется из БД
+    await _db_shared_async().close()
+    if get_maintenance.cache_info().currsize:
+        await run_in_threadpool(get_maintenance().close)
 
 
 # ----------------------------------- API методы -------------------------------------
 
 @app.get("/link/{short}")
-async def get_shortlink(short: str, data_manager: DataManager = Depends(get_datamanager)) -> Dict[str, str]:
+async def get_shortlink(short: str, data_manager: AsyncDataManager = Depends(get_async_datamanager)) -> Dict[str, str]:
     """
     Получить полную ссылку
     """
     try:
-        link = data_manager.shortlink_get(short)
+        link = await data_manager.shortlink_get(short)
     except ShortlinkNotFound as e:
         raise HTTPException(status_code=404, detail=str(e))
     return {short: link}
 
 @app.get('/link/')
-async def get_shortlinks(limit: int = 1000, offset: int = 0, datamanager: DataManager = Depends(get_datamanager)) -> Dict[str, Any]:
+async def get_shortlinks(limit: int = 1000, offset: int = 0, datamanager: AsyncDataManager = Depends(get_async_datamanager)) -> Dict[str, Any]:
     """
     Получить список всех ссылок (метод не для прода)
     """
-    shortlinks = datamanager.shortlinks_get(limit, offset)
+    shortlinks = await datamanager.shortlinks_get(limit, offset)
     return shortlinks
 
+@app.get('/links/')
+async def get_shortlinks_page(after: int = 0, limit: int = 1000, data_manager: AsyncDataManager = Depends(get_async_datamanager)) -> Dict[str, Any]:
+    """
+    Постраничный список ссылок. Курсор следующей страницы приходит в поле next, его передают в after
+    """
+    page = await data_manager.shortlinks_page(after, limit)
+    return page
+
+@app.get('/links/export')
+async def export_shortlinks(format: str = 'ndjson', after: int = 0, data_manager: AsyncDataManager = Depends(get_async_datamanager)):
+    """
+    Выгрузка всех ссылок потоком (ndjson или csv), без ограничения количества
+    """
+    if format not in MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f'Формат выгрузки должен быть одним из: {", ".join(MEDIA_TYPES)}')
+    chunks = data_manager.shortlinks_export(format, after)
+    return StreamingResponse(chunks, media_type=MEDIA_TYPES[format])
+
 @app.put("/link/")
-async def create_shortlink(origin: str, data_manager: DataManager = Depends(get_datamanager)) -> str:
+async def create_shortlink(origin: str, data_manager: AsyncDataManager = Depends(get_async_datamanager)) -> str:
     """
     Создать короткую ссылку
     """
-    short = data_manager.shortlink_create(origin)
+    short = await data_manager.shortlink_create(origin)
     return short
 
 
+@app.put("/links/")
+async def create_shortlinks(origins: List[str] = Body(...), data_manager: AsyncDataManager = Depends(get_async_datamanager)) -> List[str]:
+    """
+    Создать пачку коротких ссылок (список полных ссылок в теле запроса), порядок ответа совпадает с порядком в запросе
+    """
+    shorts = await data_manager.shortlinks_create(origins)
+    return shorts
+
+@app.post("/links/resolve")
+async def resolve_shortlinks(shorts: List[str] = Body(...), data_manager: AsyncDataManager = Depends(get_async_datamanager)) -> Dict[str, str]:
+    """
+    Получить полные ссылки для пачки коротких (список в теле запроса), ненайденных в ответе нет
+    """
+    origins = await data_manager.shortlinks_resolve(shorts)
+    return origins
+
 @app.delete("/link/")
-async def delete_shortlink(short: str, data_manager: DataManager = Depends(get_datamanager)):
+async def delete_shortlink(short: str, data_manager: AsyncDataManager = Depends(get_async_datamanager)):
     """
     Удалить короткую ссылку (удаляет упреждающе, без проверки на наличие)
     """
-    data_manager.shortlink_delete(short)
+    await data_manager.shortlink_delete(short)
+
+
+@app.get('/stats/db')
+async def get_db_stats(data_manager: AsyncDataManager = Depends(get_async_datamanager)) -> Dict[str, float]:
+    """
+    Статистика пула подключений к БД
+    """
+    return data_manager.db_stats()
 
+@app.get('/stats/expiry')
+async def get_expiry_stats() -> Dict[str, Any]:
+    """
+    Статистика обслуживания БД в этом воркере: лидер ли он, и статистика устаревания ссылок
+    """
+    return get_maintenance().stats()
 
+@app.get('/stats/cache')
+async def get_cache_stats(data_manager: AsyncDataManager = Depends(get_async_datamanager)) -> Dict[str, Dict[str, float]]:
+    """
+    Статистика кэшей
+    """
+    return data_manager.cache_stats()
 
+@app.get('/metrics')
+async def get_metrics() -> Response:
+    """
+    Метрики воркера в текстовом формате Prometheus
+    """
+    return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
@@ -0,0 +1,45 @@
+"""
+Отдельный процесс обслуживания БД (устаревание ссылок), чтобы им не занимались воркеры сервиса.
+Включается через MAINTENANCE_MODE = 'external'. Процессов можно запустить несколько:
+работает только тот, кто держит advisory-блокировку, остальные ждут на подхвате.
+
+    python maintainer.py [--once] [--interval секунд]
+"""
+
+import argparse
+import signal
+import threading
+
+from config import config
+from launcher import database_check_or_init, get_maintenance
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Обслуживание БД shortlinks')
+    parser.add_argument('--once', action='store_true', help='один тик и выход')
+    parser.add_argument('--interval', type=float, default=config.BACKGROUND_WORKER_INTERVAL,
+                        help='секунд между тиками')
+    args = parser.parse_args()
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    signal.signal(signal.SIGINT, lambda *_: stopping.set())
+
+    database_check_or_init()
+    maintenance = get_maintenance()
+    try:
+        while not stopping.is_set():
+            result = maintenance.tick()
+            if result is None:
+                print('Не лидер, обслуживанием занят другой процесс', flush=True)
+            else:
+                print(f"Деактивировано: {result['deactivated']}, освобождено: {result['freed']}", flush=True)
+            if args.once:
+                break
+            stopping.wait(args.interval)
+    finally:
+        maintenance.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Перенос снимка таблицы ссылок между Postgres и встроенной БД узла (DB_BACKEND = 'sqlite').
+
+pull - заменяет содержимое файла DB_SQLITE_PATH таблицей из Postgres, для запуска узла;
+push - записывает строки из файла обратно в Postgres поверх строк с теми же id.
+Сервис узла на время переноса лучше остановить, иначе снимок не увидит записи, сделанные во время выгрузки.
+
+    python snapshot.py pull|push [--path файл]
+"""
+
+import argparse
+import itertools
+
+from config import config
+from launcher import _db_connect
+from src.db_sqlite import SQLiteDBShortlinks
+
+
+def pull(path: str):
+    source = _db_connect()
+    target = SQLiteDBShortlinks(path)
+    target.init_database()
+    try:
+        count = target.snapshot_import(source.links_snapshot())
+    finally:
+        source.close()
+        target.close()
+    print(f'Загружено ссылок: {count}', flush=True)
+
+
+def push(path: str):
+    source = SQLiteDBShortlinks(path)
+    target = _db_connect()
+    count = 0
+    try:
+        rows = source.links_snapshot()
+        while True:
+            batch = list(itertools.islice(rows, config.DB_CREATE_BATCHSIZE))
+            if not batch:
+                break
+            target.links_upsert(batch)
+            count += len(batch)
+    finally:
+        source.close()
+        target.close()
+    print(f'Выгружено ссылок: {count}', flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Снимок таблицы ссылок: Postgres <-> встроенная БД')
+    parser.add_argument('direction', choices=('pull', 'push'), help='pull - из Postgres в файл, push - обратно')
+    parser.add_argument('--path', default=config.DB_SQLITE_PATH, help='файл встроенной БД')
+    args = parser.parse_args()
+    if args.direction == 'pull':
+        pull(args.path)
+    else:
+        push(args.path)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,11 @@
-from typing import Dict, Any, Callable
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Dict, List, Tuple, Any, Awaitable, Callable, Iterable, Iterator, Optional
+
+_now = time.monotonic
+_NEVER = float('inf') # срок записи кэша без ttl
 
 
 class Cache:
@@ -17,11 +24,13 @@ class Cache:
     необходимо выполнить при прямом доступе к данным.
 
     Для отладки доступа к данным, минуя кэш, создан холостой кэш CacheDisabled.
+
+    Ключ потребителя используется как ключ контейнера напрямую, так что он должен быть хэшируемым.
     """
-    _container: Dict[int, Any]
+    _container: Dict[Any, Any]
 
     def key_exists(self, key):
-        if _CacheEntry.hash(key) in self._container:
+        if key in self._container:
             return True
         return False
 
@@ -30,46 +39,430 @@ class Cache:
         return self._container
 
     def delete(self, key: Any):
-        self._container.pop(_CacheEntry.hash(key), None)
+        self._container.pop(key, None)
+
+    def delete_many(self, keys: Iterable[Any]):
+        for key in keys:
+            self.delete(key)
+
+    def clear(self):
+        self._container.clear()
 
 
 class CacheLRU(Cache):
     """
     LRU-кэш, работает по принципу вытеснения самых старых данных.
 
-    Гистерезис добавлен для оптимизации механизма чистки.
-    Чтобы при максимальном размере очереди = 100, чистка запускалась на 120, и чистила сразу 20 записей.
-    Без гистерезиса, полная чистка кэша запускалась бы на каждый запрос.
-    """
-    _DEFAULT_MAXSIZE_HYSTERESIS = 1.2
+    Записи лежат в OrderedDict в порядке обращения к ним: при попадании запись переносится в конец,
+    вытесняются записи из начала. Чтение, добавление и вытеснение стоят O(1).
 
-    def __init__(self, maxsize: int, hysteresis: float = None):
-        self._hysteresis = hysteresis or self._DEFAULT_MAXSIZE_HYSTERESIS
-        self._container: Dict[int, _CacheLRU_Entry] = {}
-        self._epoch = 0
+    Гистерезис оставлен как необязательный пакетный режим вытеснения.
+    При максимальном размере очереди = 100 и гистерезисе 1.2 чистка запускается на 120, и чистит сразу 20 записей.
+    Без гистерезиса самая старая запись вытесняется сразу, как только размер превышен.
+
+    Попадание в кэш - один поиск в словаре и перенос записи в конец, без создания новых объектов.
+    Запись и вызов функции чтения создаются только при промахе.
+
+    get_many читает пачку ключей: попадания отдаются за один проход, а все промахи
+    читаются одним вызовом func(missing_keys), который возвращает словарь найденного.
+
+    Попадания, промахи и вытеснения считаются простыми полями (см. stats).
+
+    Одновременные промахи по одному ключу схлопываются (single-flight): источник читает только первый,
+    остальные ждут его результата (или его исключения), потоки - на событии, корутины - на future.
+    Сколько запросов так дождались чужого чтения - coalesced в stats. Путь попадания это не удлиняет.
+
+    С ttl запись живет не дольше ttl секунд от чтения из источника, обращения ее не продлевают.
+    Просроченная запись при обращении считается промахом (ленивое истечение), а память из-под записей,
+    к которым больше не обращаются, освобождает sweep. Срок у всех записей одинаковый, так что порядок
+    истечения совпадает с порядком добавления, и колесо таймеров вырождается в очередь: sweep снимает
+    с ее начала всё, что уже истекло. Записи, которые вытеснили или перечитали раньше, в очереди остаются
+    до своего срока: вставка снимает такие записи с начала очереди, а остальные за один проход выкидывает sweep.
+    """
+    def __init__(self, maxsize: int, hysteresis: float = None, ttl: float = None):
+        self._container: 'OrderedDict[Any, _CacheLRU_Entry]' = OrderedDict()
+        self._ttl = ttl
+        self._expiry: 'deque[Tuple[_CacheLRU_Entry, Any]]' = deque()
+        self._expired = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._coalesced = 0
+        self._flights: Dict[Any, _CacheLRU_Flight] = {}
+        self._flights_lock = threading.Lock()
+        self._flights_async: Dict[Any, asyncio.Future] = {}
         self._maxsize_soft = maxsize
-        self._maxsize_hard = int(self._maxsize_soft * self._hysteresis)
+        if hysteresis:
+            self._maxsize_hard = int(self._maxsize_soft * hysteresis)
+        else:
+            self._maxsize_hard = self._maxsize_soft + 1
 
     def get(self, key: Any, func: Callable[..., Any], *args, **kwargs) -> Any:
-        def functor():
-            return func(*args, **kwargs)
-        cached = _CacheLRU_Entry(key, functor)
         try:
-            cached = self._container[hash(cached)]
+            cached = self._container[key]
+        except KeyError:
+            self._misses += 1
+            return self._load(key, func, args, kwargs)
+        if self._ttl is not None and cached.expires <= _now():
+            self._misses += 1
+            self._expire(key, cached)
+            return self._load(key, func, args, kwargs)
+        self._hits += 1
+        try:
+            self._container.move_to_end(key)
         except KeyError:
-            cached.load_data()
-            self._container[hash(cached)] = cached
-            if len(self._container) >= self._maxsize_hard:
-                self.clean()
-        self._epoch += 1
-        cached.epoch = self._epoch
+            pass  # запись удалили из другого потока, см. _touch
         return cached.value
 
+    async def get_async(self, key: Any, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """
+        То же, что и get, только для асинхронного источника данных.
+        """
+        try:
+            cached = self._container[key]
+        except KeyError:
+            self._misses += 1
+            return await self._load_async(key, func, args, kwargs)
+        if self._ttl is not None and cached.expires <= _now():
+            self._misses += 1
+            self._expire(key, cached)
+            return await self._load_async(key, func, args, kwargs)
+        self._hits += 1
+        try:
+            self._container.move_to_end(key)
+        except KeyError:
+            pass  # запись удалили из другого потока, см. _touch
+        return cached.value
+
+    def _load(self, key: Any, func: Callable[..., Any], args: tuple, kwargs: dict) -> Any:
+        """
+        Под блокировкой ключ проверяется еще раз: чтение могло закончиться между промахом и блокировкой.
+        Значение кладется в кэш до снятия полета, так что опоздавшие попадают уже в кэш.
+        """
+        with self._flights_lock:
+            cached = self._container.get(key)
+            if cached is not None and cached.expires > _now():
+                return cached.value
+            flight = self._flights.get(key)
+            leading = flight is None
+            if leading:
+                flight = self._flights[key] = _CacheLRU_Flight()
+        if not leading:
+            self._coalesced += 1
+            return flight.wait()
+        try:
+            value = func(*args, **kwargs)
+            self._insert(key, value)
+        except BaseException as e:
+            flight.fail(e)
+            raise
+        else:
+            flight.done(value)
+        finally:
+            with self._flights_lock:
+                del self._flights[key]
+        return value
+
+    async def _load_async(self, key: Any, func: Callable[..., Awaitable[Any]], args: tuple, kwargs: dict) -> Any:
+        """
+        Если первого читающего отменили (клиент ушел), ждавшие не отменяются, а читают сами.
+        """
+        while True:
+            future = self._flights_async.get(key)
+            if future is None:
+                break
+            self._coalesced += 1
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+        future = asyncio.get_running_loop().create_future()
+        self._flights_async[key] = future
+        try:
+            value = await func(*args, **kwargs)
+            self._insert(key, value)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # ждавших могло не быть, иначе asyncio ругнется на непрочитанное исключение
+            raise
+        else:
+            future.set_result(value)
+        finally:
+            del self._flights_async[key]
+        return value
+
+    def get_many(self, keys: Iterable[Any], func: Callable[..., Dict[Any, Any]], *args, **kwargs) -> Dict[Any, Any]:
+        """
+        Возвращает словарь найденных значений, ключей, которых нет в источнике, в нем нет
+        """
+        found, missing = self._lookup_many(keys)
+        if missing:
+            loaded = func(missing, *args, **kwargs)
+            self._insert_many(loaded)
+            found.update(loaded)
+        return found
+
+    async def get_many_async(self, keys: Iterable[Any], func: Callable[..., Awaitable[Dict[Any, Any]]],
+                             *args, **kwargs) -> Dict[Any, Any]:
+        found, missing = self._lookup_many(keys)
+        if missing:
+            loaded = await func(missing, *args, **kwargs)
+            self._insert_many(loaded)
+            found.update(loaded)
+        return found
+
+    def _lookup_many(self, keys: Iterable[Any]) -> Tuple[Dict[Any, Any], List[Any]]:
+        container = self._container
+        found = {}
+        missing = []
+        now = _now()
+        for key in dict.fromkeys(keys):
+            cached = container.get(key)
+            if cached is None:
+                missing.append(key)
+            elif cached.expires <= now:
+                self._expire(key, cached)
+                missing.append(key)
+            else:
+                self._touch(key)
+                found[key] = cached.value
+        self._hits += len(found)
+        self._misses += len(missing)
+        return found, missing
+
+    def _expire(self, key: Any, cached: '_CacheLRU_Entry'):
+        """
+        Удаляет запись, только если это всё еще она: ее могли уже перечитать из другого потока
+        """
+        self._expired += 1
+        if self._container.get(key) is cached:
+            self._container.pop(key, None)
+
+    def _touch(self, key: Any):
+        """
+        Запись могли удалить из другого потока (обслуживание БД выкидывает освобожденные ссылки)
+        между поиском и переносом, тогда переносить нечего.
+        """
+        try:
+            self._container.move_to_end(key)
+        except KeyError:
+            pass
+
+    def _insert_many(self, values: Dict[Any, Any]):
+        container = self._container
+        expires = self._expires()
+        for key, value in values.items():
+            cached = container[key] = _CacheLRU_Entry(value, expires)
+            container.move_to_end(key)
+            if self._ttl is not None:
+                self._expiry.append((cached, key))
+        if len(container) >= self._maxsize_hard:
+            self.clean()
+        self._expiry_trim()
+
+    def _insert(self, key: Any, value: Any):
+        cached = self._container[key] = _CacheLRU_Entry(value, self._expires())
+        if self._ttl is not None:
+            self._expiry.append((cached, key))
+        if len(self._container) >= self._maxsize_hard:
+            self.clean()
+        self._expiry_trim()
+
+    def _expiry_trim(self):
+        """
+        Снимает с начала очереди истечения записи, которых в кэше уже нет. Вытесняются самые старые
+        по обращению, а они обычно и в очереди первые, так что очередь не разрастается, и это O(1) в среднем.
+        Мертвые записи из середины очереди выкидывает sweep.
+        """
+        expiry = self._expiry
+        container = self._container
+        while expiry and container.get(expiry[0][1]) is not expiry[0][0]:
+            expiry.popleft()
+
+    def _expires(self) -> float:
+        if self._ttl is None:
+            return _NEVER
+        return _now() + self._ttl
+
+    def key_exists(self, key):
+        cached = self._container.get(key)
+        return cached is not None and cached.expires > _now()
+
+    def sweep(self) -> int:
+        """
+        Выкидывает истекшие записи, возвращает их количество. Вызывается периодически (в фоне, не на пути запроса),
+        чтобы записи, к которым больше не обращаются, не занимали память до вытеснения.
+        Если в очереди истечения набралось вдвое больше записей, чем помещается в кэш, она заодно прореживается.
+        """
+        if self._ttl is None:
+            return 0
+        if len(self._expiry) > 2 * self._maxsize_hard:
+            # очередь уже в порядке истечения, так что достаточно выкинуть вытесненные и перечитанные записи
+            container = self._container
+            self._expiry = deque(item for item in list(self._expiry) if container.get(item[1]) is item[0])
+        swept = 0
+        now = _now()
+        expiry = self._expiry
+        while expiry and expiry[0][0].expires <= now:
+            cached, key = expiry.popleft()
+            if self._container.get(key) is cached:
+                self._container.pop(key, None)
+                swept += 1
+        self._expired += swept
+        return swept
 
     def clean(self):
-        truncated = sorted(self._container.values(), key=lambda cached: cached.epoch)[-self._maxsize_soft:]
-        actual_entries = {hash(cached): cached for cached in truncated}
-        self._container = actual_entries
+        while len(self._container) > self._maxsize_soft:
+            self._container.popitem(last=False)
+            self._evictions += 1
+
+    def items_recent(self, limit: int) -> List[Tuple[Any, Any, float]]:
+        """
+        Не больше limit самых свежих по обращению записей (ключ, значение, сколько секунд ей осталось жить),
+        от старых к новым, для снимка кэша. Истекшие пропускаются.
+        """
+        now = _now()
+        items = []
+        for key, cached in reversed(list(self._container.items())):
+            if len(items) >= limit:
+                break
+            if cached.expires > now:
+                items.append((key, cached.value, cached.expires - now))
+        items.reverse()
+        return items
+
+    def preload(self, items: Iterable[Tuple[Any, Any, Optional[float]]]) -> int:
+        """
+        Кладет записи (ключ, значение, сколько секунд ей осталось жить) так, как будто они только что прочитаны,
+        последняя - самая свежая. Срок не длиннее ttl, None - полный ttl, а без ttl записи бессрочные.
+        Возвращает количество записей.
+        """
+        now = _now()
+        count = 0
+        for key, value, remaining in items:
+            expires = self._expires()
+            if remaining is not None and self._ttl is not None:
+                expires = min(expires, now + remaining)
+            self._container[key] = _CacheLRU_Entry(value, expires)
+            self._container.move_to_end(key)
+            count += 1
+        if len(self._container) >= self._maxsize_hard:
+            self.clean()
+        if self._ttl is not None:
+            # сроки у записей снимка разные, так что очередь истечения собирается по ним заново;
+            # новые записи получают полный ttl и дальше встают в ее конец как обычно
+            self._expiry = deque(sorted(
+                ((cached, key) for key, cached in list(self._container.items())), key=lambda item: item[0].expires))
+        return count
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'size': len(self._container),
+            'hits': self._hits,
+            'misses': self._misses,
+            'evictions': self._evictions,
+            'coalesced': self._coalesced,
+            'expired': self._expired,
+        }
+
+
+class CacheNegative(Cache):
+    """
+    Кэш промахов: помнит ключи, которых нет в источнике, и на повторный запрос
+    сразу бросает то же исключение, не обращаясь к источнику.
+
+    Кэшируются только исключения класса error, остальные ошибки проходят как есть.
+    Размер ограничен (вытесняются самые старые), время жизни записи - ttl секунд:
+    ключ, которого нет сейчас, может позже появиться в источнике в обход этого кэша (например, в другом воркере).
+    Свои создания потребитель сбрасывает сам через delete.
+
+    Обычно ставится за LRU-кэшем, как его функция чтения, чтобы не удлинять путь попадания:
+    cache_lru.get(key, cache_negative.get, key, func, *args)
+    cache_lru.get_many(keys, cache_negative.get_many, func, *args)
+
+    При пакетном чтении источник не бросает исключение, а просто не возвращает отсутствующие ключи,
+    поэтому исключение для них создается самим кэшем, с текстом message.
+    """
+    def __init__(self, maxsize: int, ttl: float, error: type, message: str = "Ключ '{key}' не найден"):
+        self._container: 'OrderedDict[Any, _CacheNegative_Entry]' = OrderedDict()
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._error = error
+        self._message = message
+        self._hits = 0
+
+    def get(self, key: Any, func: Callable[..., Any], *args, **kwargs) -> Any:
+        self._check(key)
+        try:
+            return func(*args, **kwargs)
+        except self._error as e:
+            self._remember(key, e)
+            raise
+
+    async def get_async(self, key: Any, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        self._check(key)
+        try:
+            return await func(*args, **kwargs)
+        except self._error as e:
+            self._remember(key, e)
+            raise
+
+    def get_many(self, keys: List[Any], func: Callable[..., Dict[Any, Any]], *args, **kwargs) -> Dict[Any, Any]:
+        unknown = [key for key in keys if not self._known_missing(key)]
+        if not unknown:
+            return {}
+        loaded = func(unknown, *args, **kwargs)
+        self._remember_missing(unknown, loaded)
+        return loaded
+
+    async def get_many_async(self, keys: List[Any], func: Callable[..., Awaitable[Dict[Any, Any]]],
+                             *args, **kwargs) -> Dict[Any, Any]:
+        unknown = [key for key in keys if not self._known_missing(key)]
+        if not unknown:
+            return {}
+        loaded = await func(unknown, *args, **kwargs)
+        self._remember_missing(unknown, loaded)
+        return loaded
+
+    def _check(self, key: Any):
+        cached = self._container.get(key)
+        if cached is None:
+            return
+        if cached.expires > time.monotonic():
+            self._hits += 1
+            raise cached.error.with_traceback(None)
+        self._container.pop(key, None)
+
+    def _known_missing(self, key: Any) -> bool:
+        cached = self._container.get(key)
+        if cached is None:
+            return False
+        if cached.expires > time.monotonic():
+            self._hits += 1
+            return True
+        self._container.pop(key, None)
+        return False
+
+    def stats(self) -> Dict[str, float]:
+        """
+        hits - сколько раз отсутствующий ключ отдан из кэша без обращения к источнику
+        """
+        return {'size': len(self._container), 'hits': self._hits}
+
+    def _remember_missing(self, keys: List[Any], loaded: Dict[Any, Any]):
+        for key in keys:
+            if key not in loaded:
+                self._remember(key, self._error(self._message.format(key=key)))
+
+    def _remember(self, key: Any, error: Exception):
+        self._container[key] = _CacheNegative_Entry(time.monotonic() + self._ttl, error)
+        self._container.move_to_end(key)
+        if len(self._container) > self._maxsize:
+            self._container.popitem(last=False)
 
 
 class CacheWriteback(Cache):
@@ -77,14 +470,13 @@ class CacheWriteback(Cache):
     Writeback-кэш буфферизует данные, а потом сбрасывает их кучкой.
     """
     def __init__(self, maxsize: int):
-        self._container: Dict[int, _CacheWriteback_Entry] = {}
+        self._container: Dict[Any, _CacheWriteback_Entry] = {}
         self._maxsize = maxsize
 
     def put(self, key: Any, func: Callable[..., Any], *args, **kwargs):
         def functor():
             return func(*args, **kwargs)
-        deferred_task = _CacheWriteback_Entry(key, functor)
-        self._container[hash(deferred_task)] = deferred_task
+        self._container[key] = _CacheWriteback_Entry(functor)
         if len(self._container) >= self._maxsize:
             self.flush()
 
@@ -93,6 +485,313 @@ class CacheWriteback(Cache):
             deferred_task.execute()
         self._container.clear()
 
+    async def put_async(self, key: Any, func: Callable[..., Awaitable[Any]], *args, **kwargs):
+        """
+        То же, что и put, только для асинхронного приемника данных.
+        """
+        def functor():
+            return func(*args, **kwargs)
+        self._container[key] = _CacheWriteback_Entry(functor)
+        if len(self._container) >= self._maxsize:
+            await self.flush_async()
+
+    async def flush_async(self):
+        """
+        Контейнер подменяется до начала записи, т.к. пока идет запись,
+        другие корутины продолжают складывать в кэш новые задачи.
+        """
+        deferred_tasks = self._container
+        self._container = {}
+        for deferred_task in deferred_tasks.values():
+            await deferred_task.execute()
+
+
+class CacheWritebackBatch(CacheWriteback):
+    """
+    Writeback-кэш, который сбрасывает данные пачками, одним вызовом на пачку.
+
+    put(key, func, item) откладывает не вызов, а аргумент: при сбросе func вызывается
+    один раз на пачку накопленных аргументов, func([item1, item2, ...]).
+    Повторные put по одному ключу схлопываются: остается последний аргумент, а если задан merge -
+    merge(прежний, новый), так в буфере можно копить, например, счетчики. Размер пачки ограничен batch_size,
+    чтобы одна запись в БД не держала блокировки слишком долго.
+
+    Буфер двойной: сброс сразу подменяет контейнер пустым и пишет уже отложенное,
+    так что put никогда не ждет записи в БД. Если запись упала, несброшенное
+    возвращается в кэш и будет записано при следующем сбросе.
+
+    Без фонового сброса (см. WritebackFlusher) кэш сбрасывается сам при заполнении, как и CacheWriteback.
+    С фоновым сбросом put только будит сбрасывающего, а если БД не успевает и в буфере
+    набралось max_pending ключей, новые ключи отбрасываются (уже лежащие продолжают схлопываться).
+    Для времени доступа к ссылкам потеря части обновлений лучше, чем рост памяти без предела.
+    """
+    def __init__(self, maxsize: int, batch_size: int, max_pending: int = None,
+                 merge: Callable[[Any, Any], Any] = None):
+        super().__init__(maxsize)
+        self._container: Dict[Any, _CacheWriteback_BatchEntry] = {}
+        self._batch_size = batch_size
+        self._max_pending = max_pending
+        self._merge = merge
+        self._pending_since: Optional[float] = None
+        self._lock = threading.Lock()
+        self._notify: Optional[Callable[[], None]] = None
+        self._in_flight = 0
+        self._dropped = 0
+        self._errors = 0
+        self._flushes = 0
+        self._flushed_items = 0
+        self._flush_time_last = 0.0
+        self._flush_time_max = 0.0
+        self._flush_time_total = 0.0
+
+    def delete(self, key: Any):
+        with self._lock:
+            self._container.pop(key, None)
+
+    def delete_many(self, keys: Iterable[Any]):
+        with self._lock:
+            for key in keys:
+                self._container.pop(key, None)
+
+    def set_notify(self, notify: Optional[Callable[[], None]]):
+        """
+        Подключает фоновый сброс: notify вызывается, когда в пустой буфер пришел первый ключ
+        (пошел отсчет max_age) и когда буфер заполнился.
+        """
+        self._notify = notify
+
+    def put(self, key: Any, func: Callable[[List[Any]], Any], item: Any):
+        if self._enqueue(func, ((key, item),)):
+            self.flush()
+
+    def put_many(self, func: Callable[[List[Any]], Any], items: Dict[Any, Any]):
+        """
+        То же, что и put для каждой пары ключ-аргумент из items, но под одной блокировкой
+        """
+        if self._enqueue(func, items.items()):
+            self.flush()
+
+    def flush(self):
+        pending, since = self._swap()
+        if not pending:
+            return
+        started = time.monotonic()
+        try:
+            for func, batch in self._batches(pending):
+                func(batch)
+        except Exception:
+            self._restore(pending, since)
+            raise
+        finally:
+            self._account(len(pending), started)
+
+    async def put_async(self, key: Any, func: Callable[[List[Any]], Awaitable[Any]], item: Any):
+        if self._enqueue(func, ((key, item),)):
+            await self.flush_async()
+
+    async def put_many_async(self, func: Callable[[List[Any]], Awaitable[Any]], items: Dict[Any, Any]):
+        if self._enqueue(func, items.items()):
+            await self.flush_async()
+
+    async def flush_async(self):
+        pending, since = self._swap()
+        if not pending:
+            return
+        started = time.monotonic()
+        try:
+            for func, batch in self._batches(pending):
+                await func(batch)
+        except Exception:
+            self._restore(pending, since)
+            raise
+        finally:
+            self._account(len(pending), started)
+
+    def flush_delay(self, max_age: float) -> Optional[float]:
+        """
+        Через сколько секунд буфер надо сбросить по возрасту, None если он пуст.
+        При заполненном буфере - сразу.
+        """
+        since = self._pending_since
+        if since is None:
+            return None
+        if len(self._container) >= self._maxsize:
+            return 0.0
+        return max(since + max_age - time.monotonic(), 0.0)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'pending': len(self._container),
+            'in_flight': self._in_flight,
+            'dropped': self._dropped,
+            'errors': self._errors,
+            'flushes': self._flushes,
+            'flushed_items': self._flushed_items,
+            'flush_time_last': self._flush_time_last,
+            'flush_time_max': self._flush_time_max,
+            'flush_time_total': self._flush_time_total,
+        }
+
+    def _enqueue(self, func: Callable[[List[Any]], Any], items: Iterable[Tuple[Any, Any]]) -> bool:
+        """
+        Кладет ключи в буфер. Возвращает True, если буфер пора сбросить прямо сейчас, в текущем запросе
+        (это только когда фоновый сброс не подключен).
+        """
+        with self._lock:
+            container = self._container
+            was_empty = not container
+            limit = self._max_pending if self._notify is not None else None
+            merge = self._merge
+            for key, item in items:
+                entry = container.get(key)
+                if entry is not None and merge is not None:
+                    entry.item = merge(entry.item, item)
+                    continue
+                if limit and entry is None and len(container) >= limit:
+                    self._dropped += 1
+                    continue
+                container[key] = _CacheWriteback_BatchEntry(func, item)
+            size = len(container)
+            if was_empty and size:
+                self._pending_since = time.monotonic()
+        if self._notify is None:
+            return size >= self._maxsize
+        if (was_empty and size) or size >= self._maxsize:
+            self._notify()
+        return False
+
+    def _swap(self) -> Tuple[Dict[Any, '_CacheWriteback_BatchEntry'], Optional[float]]:
+        with self._lock:
+            pending, since = self._container, self._pending_since
+            self._container = {}
+            self._pending_since = None
+            self._in_flight = len(pending)
+        return pending, since
+
+    def _batches(self, pending: Dict[Any, '_CacheWriteback_BatchEntry']) -> Iterator[Tuple[Callable, List[Any]]]:
+        groups: Dict[Callable, List[Any]] = {}
+        for entry in pending.values():
+            groups.setdefault(entry.func, []).append(entry.item)
+        for func, items in groups.items():
+            for start in range(0, len(items), self._batch_size):
+                yield func, items[start:start + self._batch_size]
+
+    def _restore(self, pending: Dict[Any, '_CacheWriteback_BatchEntry'], since: Optional[float]):
+        with self._lock:
+            for key, entry in pending.items():
+                newer = self._container.get(key)
+                if newer is None:
+                    self._container[key] = entry
+                elif self._merge is not None:
+                    newer.item = self._merge(entry.item, newer.item)
+            if self._pending_since is None or (since is not None and since < self._pending_since):
+                self._pending_since = since
+            self._errors += 1
+
+    def _account(self, items: int, started: float):
+        elapsed = time.monotonic() - started
+        self._in_flight = 0
+        self._flushes += 1
+        self._flushed_items += items
+        self._flush_time_last = elapsed
+        self._flush_time_total += elapsed
+        self._flush_time_max = max(self._flush_time_max, elapsed)
+
+
+class WritebackFlusher:
+    """
+    Фоновый поток, который сбрасывает CacheWritebackBatch вне запросов пользователей.
+
+    Сброс запускается, когда буфер заполнился, когда самому старому ключу в нем исполнилось max_age секунд,
+    и при остановке. Если запись упала, следующая попытка будет не раньше чем через retry_interval.
+    """
+    def __init__(self, cache: CacheWritebackBatch, max_age: float, retry_interval: float = 1.0):
+        self._cache = cache
+        self._max_age = max_age
+        self._retry_interval = retry_interval
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._stopping = False
+        self._cache.set_notify(self._wakeup.set)
+        self._thread = threading.Thread(target=self._run, name='writeback-flusher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Останавливает поток и сбрасывает остатки буфера. Если поток не запускали, делать нечего.
+        """
+        if self._thread is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+        self._cache.set_notify(None)
+        self._cache.flush()
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self._cache.flush_delay(self._max_age))
+            self._wakeup.clear()
+            if self._stopping or self._cache.flush_delay(self._max_age) != 0.0:
+                continue
+            try:
+                self._cache.flush()
+            except Exception:
+                self._wakeup.wait(self._retry_interval)
+
+
+class AsyncWritebackFlusher:
+    """
+    То же, что и WritebackFlusher, только в виде задачи event loop и для асинхронного приемника данных.
+    """
+    def __init__(self, cache: CacheWritebackBatch, max_age: float, retry_interval: float = 1.0):
+        self._cache = cache
+        self._max_age = max_age
+        self._retry_interval = retry_interval
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """
+        Вызывается из уже запущенного event loop
+        """
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._cache.set_notify(self._wakeup.set)
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+        self._cache.set_notify(None)
+        await self._cache.flush_async()
+
+    async def _run(self):
+        while not self._stopping:
+            await self._sleep(self._cache.flush_delay(self._max_age))
+            if self._stopping or self._cache.flush_delay(self._max_age) != 0.0:
+                continue
+            try:
+                await self._cache.flush_async()
+            except Exception:
+                await self._sleep(self._retry_interval)
+
+    async def _sleep(self, timeout: Optional[float]):
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
 
 class CacheDisabled(Cache):
     def get(self, key: Any, func: Callable[..., Any], *args, **kwargs) -> Any:
@@ -102,45 +801,72 @@ class CacheDisabled(Cache):
     def put(self, key: Any, func: Callable[..., Any], *args, **kwargs):
         func(*args, **kwargs)
 
+    async def get_async(self, key: Any, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        result = await func(*args, **kwargs)
+        return result
 
+    async def put_async(self, key: Any, func: Callable[..., Awaitable[Any]], *args, **kwargs):
+        await func(*args, **kwargs)
 
 
-class _CacheEntry:
-    @staticmethod
-    def hash(key):
-        return hash(key)
 
-    def __init__(self, key: Any, func: Callable[..., Any]):
-        self._key: Any = key
-        self._func: Callable[..., Any] = func
 
-    def __hash__(self):
-        return self.hash(self._key)
+class _CacheLRU_Entry:
+    __slots__ = ('value', 'expires')
+
+    def __init__(self, value: Any, expires: float = _NEVER):
+        self.value: Any = value
+        self.expires: float = expires
+
 
+class _CacheLRU_Flight:
+    """
+    Чтение ключа, которое сейчас идет в другом потоке
+    """
+    __slots__ = ('_event', '_value', '_error')
 
-class _CacheLRU_Entry(_CacheEntry):
-    def __init__(self, key: Any, func: Callable[..., Any]):
-        super().__init__(key, func)
+    def __init__(self):
+        self._event = threading.Event()
         self._value: Any = None
-        self._epoch: int = 0
+        self._error: Optional[BaseException] = None
 
-    def load_data(self):
-        self._value = self._func()
+    def done(self, value: Any):
+        self._value = value
+        self._event.set()
 
-    @property
-    def value(self) -> Any:
+    def fail(self, error: BaseException):
+        self._error = error
+        self._event.set()
+
+    def wait(self) -> Any:
+        self._event.wait()
+        if self._error is not None:
+            raise self._error.with_traceback(None)
         return self._value
 
-    @property
-    def epoch(self) -> int:
-        return self._epoch
 
-    @epoch.setter
-    def epoch(self, epoch):
-        self._epoch = epoch
+class _CacheNegative_Entry:
+    __slots__ = ('expires', 'error')
 
+    def __init__(self, expires: float, error: Exception):
+        self.expires: float = expires
+        self.error: Exception = error
+
+
+class _CacheWriteback_Entry:
+    __slots__ = ('_func',)
+
+    def __init__(self, func: Callable[..., Any]):
+        self._func: Callable[..., Any] = func
 
-class _CacheWriteback_Entry(_CacheEntry):
     def execute(self):
         result = self._func()
-        return result
\ No newline at end of file
+        return result
+
+
+class _CacheWriteback_BatchEntry:
+    __slots__ = ('func', 'item')
+
+    def __init__(self, func: Callable[[List[Any]], Any], item: Any):
+        self.func: Callable[[List[Any]], Any] = func
+        self.item: Any = item
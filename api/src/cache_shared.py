@@ -0,0 +1,425 @@
+"""
+Общий для всех воркеров уровень кэша чтения.
+
+Каждый воркер uvicorn/gunicorn - отдельный процесс со своим CacheLRU, так что при N воркерах
+промахи и память умножаются на N. Здесь лежит хранилище, которое видят все процессы,
+и кэш CacheShared, который ставит его вторым уровнем за локальным CacheLRU.
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+from zlib import crc32
+
+from src.cache import Cache, CacheLRU
+
+
+class SharedStore(ABC):
+    """
+    Интерфейс общего хранилища строк по строковому ключу (по сути, Redis на минималках).
+
+    Помимо значений хранилище ведет журнал инвалидаций: каждое удаление получает порядковый номер,
+    по которому процессы узнают, какие ключи надо выкинуть из своих локальных кэшей.
+    Журнал ограничен, и кто отстал больше чем на его размер, получает None и чистит локальный кэш целиком.
+    """
+    @abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    def set(self, key: str, value: str, seq: int):
+        """
+        Сохраняет значение, прочитанное из источника после инвалидации номер seq.
+        Если ключ за это время инвалидировали, значение уже устарело и не сохраняется.
+        """
+
+    @abstractmethod
+    def delete(self, key: str):
+        ...
+
+    @abstractmethod
+    def delete_many(self, keys: Iterable[str]):
+        """
+        Удаляет пачку ключей за одну блокировку. В отличие от delete, ключи, которых в хранилище нет,
+        в журнал не пишутся, чтобы большая пачка не переполняла журнал и не сбрасывала локальные кэши целиком.
+        Годится для освобождения устаревших ссылок: в локальных кэшах они уже истекли по CACHE_READ_TTL.
+        """
+
+    @abstractmethod
+    def seq(self) -> int:
+        ...
+
+    @abstractmethod
+    def invalidations_since(self, seq: int) -> Tuple[int, Optional[List[str]]]:
+        ...
+
+
+class LocalSharedStore(SharedStore):
+    """
+    Хранилище в памяти процесса. Заглушка на место внешнего хранилища для разработки и тестов,
+    между процессами ничего не разделяет.
+    """
+    def __init__(self, maxsize: int, journal_size: int):
+        self._values: Dict[str, str] = {}
+        self._maxsize = maxsize
+        self._journal: deque = deque(maxlen=journal_size)
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        return self._values.get(key)
+
+    def set(self, key: str, value: str, seq: int):
+        with self._lock:
+            if self._invalidated_since(key, seq):
+                return
+            if len(self._values) >= self._maxsize and key not in self._values:
+                self._values.pop(next(iter(self._values)))
+            self._values[key] = value
+
+    def delete(self, key: str):
+        with self._lock:
+            self._values.pop(key, None)
+            self._journal.append(key)
+            self._seq += 1
+
+    def delete_many(self, keys: Iterable[str]):
+        with self._lock:
+            for key in keys:
+                if self._values.pop(key, None) is not None:
+                    self._journal.append(key)
+                    self._seq += 1
+
+    def seq(self) -> int:
+        return self._seq
+
+    def invalidations_since(self, seq: int) -> Tuple[int, Optional[List[str]]]:
+        with self._lock:
+            lag = self._seq - seq
+            if lag > len(self._journal):
+                return self._seq, None
+            return self._seq, list(self._journal)[len(self._journal) - lag:]
+
+    def _invalidated_since(self, key: str, seq: int) -> bool:
+        lag = self._seq - seq
+        if lag > len(self._journal):
+            return True
+        return lag > 0 and key in list(self._journal)[len(self._journal) - lag:]
+
+
+class MmapSharedStore(SharedStore):
+    """
+    Хранилище в файле, отображенном в память всех процессов (по умолчанию в /dev/shm).
+
+    Таблица прямого отображения: ключ по crc32 попадает ровно в один слот, и новый ключ
+    просто затирает старый. Для кэша это нормальная политика вытеснения, зато нет ни проб, ни надгробий.
+    Значения длиннее VALUE_MAXSIZE байт в общий уровень не попадают.
+
+    Запись идет под блокировкой файла (между процессами) и мьютексом (между потоками).
+    Чтение без блокировок, по seqlock: у слота есть счетчик версии, нечетный на время записи,
+    и если за время чтения он поменялся, чтение повторяется.
+
+    Раскладка файла: заголовок, кольцевой журнал инвалидаций, слоты.
+    """
+    MAGIC = b'SLCACHE1'
+    KEY_MAXSIZE = 32
+    VALUE_MAXSIZE = 2048
+    READ_ATTEMPTS = 3
+
+    _HEADER = struct.Struct('<8sIIQ')               # magic, слотов, размер журнала, номер инвалидации
+    _SEQ = struct.Struct('<Q')
+    _SEQ_OFFSET = 16
+    _JOURNAL_ENTRY = struct.Struct(f'<B{KEY_MAXSIZE}s')
+    _SLOT_HEADER = struct.Struct(f'<IBH{KEY_MAXSIZE}s')  # версия, длина ключа, длина значения, ключ
+    _VERSION = struct.Struct('<I')
+    _SLOT_SIZE = _SLOT_HEADER.size + VALUE_MAXSIZE
+
+    def __init__(self, path: str, slots: int, journal_size: int):
+        self._path = path
+        self._slots = slots
+        self._journal_size = journal_size
+        self._journal_offset = self._HEADER.size
+        self._slots_offset = self._journal_offset + journal_size * self._JOURNAL_ENTRY.size
+        self._lock = threading.Lock()
+        size = self._slots_offset + slots * self._SLOT_SIZE
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        with self._file_lock():
+            if os.fstat(self._fd).st_size != size or not self._header_matches():
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, self._HEADER.pack(self.MAGIC, slots, journal_size, 0), 0)
+        self._mm = mmap.mmap(self._fd, size)
+
+    def get(self, key: str) -> Optional[str]:
+        encoded = key.encode()
+        offset = self._slot_offset(encoded)
+        for _ in range(self.READ_ATTEMPTS):
+            version, key_size, value_size, slot_key = self._SLOT_HEADER.unpack_from(self._mm, offset)
+            if version & 1:
+                continue
+            if key_size != len(encoded) or slot_key[:key_size] != encoded:
+                return None
+            value_offset = offset + self._SLOT_HEADER.size
+            value = self._mm[value_offset:value_offset + value_size]
+            if self._VERSION.unpack_from(self._mm, offset)[0] == version:
+                return value.decode()
+        return None
+
+    def set(self, key: str, value: str, seq: int):
+        encoded_key = key.encode()
+        encoded_value = value.encode()
+        if len(encoded_key) > self.KEY_MAXSIZE or len(encoded_value) > self.VALUE_MAXSIZE:
+            return
+        offset = self._slot_offset(encoded_key)
+        with self._lock, self._file_lock():
+            if self._invalidated_since(encoded_key, seq):
+                return
+            self._slot_write(offset, encoded_key, encoded_value)
+
+    def delete(self, key: str):
+        encoded = key.encode()
+        if len(encoded) > self.KEY_MAXSIZE:
+            return
+        with self._lock, self._file_lock():
+            self._slot_clear(encoded)
+            self._journal_append(encoded)
+
+    def delete_many(self, keys: Iterable[str]):
+        encoded_keys = [key.encode() for key in keys]
+        with self._lock, self._file_lock():
+            for encoded in encoded_keys:
+                if len(encoded) <= self.KEY_MAXSIZE and self._slot_clear(encoded):
+                    self._journal_append(encoded)
+
+    def seq(self) -> int:
+        return self._SEQ.unpack_from(self._mm, self._SEQ_OFFSET)[0]
+
+    def invalidations_since(self, seq: int) -> Tuple[int, Optional[List[str]]]:
+        current = self.seq()
+        if current - seq > self._journal_size:
+            return current, None
+        keys = [self._journal_read(position).decode() for position in range(seq, current)]
+        if self.seq() - seq > self._journal_size:
+            return current, None  # журнал перезаписали, пока читали
+        return current, keys
+
+    def close(self):
+        self._mm.close()
+        os.close(self._fd)
+
+    def _header_matches(self) -> bool:
+        header = os.pread(self._fd, self._HEADER.size, 0)
+        magic, slots, journal_size, _ = self._HEADER.unpack(header)
+        return magic == self.MAGIC and slots == self._slots and journal_size == self._journal_size
+
+    def _file_lock(self) -> '_FileLock':
+        return _FileLock(self._fd)
+
+    def _slot_offset(self, encoded_key: bytes) -> int:
+        return self._slots_offset + (crc32(encoded_key) % self._slots) * self._SLOT_SIZE
+
+    def _slot_write(self, offset: int, encoded_key: bytes, encoded_value: bytes):
+        """
+        Версия становится четной только после того, как записаны и ключ, и значение
+        """
+        version = self._VERSION.unpack_from(self._mm, offset)[0]
+        writing = (version + 1) & 0xFFFFFFFF
+        self._VERSION.pack_into(self._mm, offset, writing)
+        value_offset = offset + self._SLOT_HEADER.size
+        self._mm[value_offset:value_offset + len(encoded_value)] = encoded_value
+        self._SLOT_HEADER.pack_into(self._mm, offset, writing, len(encoded_key), len(encoded_value), encoded_key)
+        self._VERSION.pack_into(self._mm, offset, (writing + 1) & 0xFFFFFFFF)
+
+    def _slot_clear(self, encoded_key: bytes) -> bool:
+        """
+        Освобождает слот, если в нем лежит этот ключ. Возвращает, лежал ли.
+        """
+        offset = self._slot_offset(encoded_key)
+        _, key_size, _, slot_key = self._SLOT_HEADER.unpack_from(self._mm, offset)
+        if key_size != len(encoded_key) or slot_key[:key_size] != encoded_key:
+            return False
+        self._slot_write(offset, b'', b'')
+        return True
+
+    def _journal_append(self, encoded_key: bytes):
+        seq = self.seq()
+        self._JOURNAL_ENTRY.pack_into(self._mm, self._journal_entry_offset(seq), len(encoded_key), encoded_key)
+        self._SEQ.pack_into(self._mm, self._SEQ_OFFSET, seq + 1)
+
+    def _journal_entry_offset(self, position: int) -> int:
+        return self._journal_offset + (position % self._journal_size) * self._JOURNAL_ENTRY.size
+
+    def _journal_read(self, position: int) -> bytes:
+        key_size, key = self._JOURNAL_ENTRY.unpack_from(self._mm, self._journal_entry_offset(position))
+        return key[:key_size]
+
+    def _invalidated_since(self, encoded_key: bytes, seq: int) -> bool:
+        current = self.seq()
+        if current - seq > self._journal_size:
+            return True
+        return any(self._journal_read(position) == encoded_key for position in range(seq, current))
+
+
+class _FileLock:
+    def __init__(self, fd: int):
+        self._fd = fd
+
+    def __enter__(self):
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+class CacheShared(Cache):
+    """
+    Двухуровневый кэш чтения: локальный CacheLRU процесса поверх общего для всех воркеров SharedStore.
+    Снаружи работает так же, как CacheLRU.
+
+    Промах локального уровня сначала ищется в общем хранилище, и только потом идет в источник.
+    Удаление ключа удаляет его из общего хранилища и пишет в журнал инвалидаций,
+    а каждый get сверяется с журналом и выкидывает из локального уровня то, что удалили другие процессы.
+    Значение, прочитанное из источника, не попадает в общее хранилище, если ключ удалили,
+    пока шло чтение, чтобы параллельный промах не вернул туда устаревшие данные.
+    """
+    def __init__(self, local: CacheLRU, store: SharedStore):
+        self._local = local
+        self._store = store
+        self._seq = store.seq()
+        self._store_hits = 0
+        self._store_misses = 0
+
+    @property
+    def container(self):
+        return self._local.container
+
+    def key_exists(self, key):
+        self._sync()
+        return self._local.key_exists(key)
+
+    def get(self, key: Any, func: Callable[..., Any], *args, **kwargs) -> Any:
+        self._sync()
+        return self._local.get(key, self._load, key, func, args, kwargs)
+
+    async def get_async(self, key: Any, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        self._sync()
+        return await self._local.get_async(key, self._load_async, key, func, args, kwargs)
+
+    def get_many(self, keys: Iterable[Any], func: Callable[..., Dict[Any, Any]], *args, **kwargs) -> Dict[Any, Any]:
+        self._sync()
+        return self._local.get_many(keys, self._load_many, func, args, kwargs)
+
+    async def get_many_async(self, keys: Iterable[Any], func: Callable[..., Awaitable[Dict[Any, Any]]],
+                             *args, **kwargs) -> Dict[Any, Any]:
+        self._sync()
+        return await self._local.get_many_async(keys, self._load_many_async, func, args, kwargs)
+
+    def delete(self, key: Any):
+        self._local.delete(key)
+        self._store.delete(key)
+
+    def delete_many(self, keys: Iterable[Any]):
+        """
+        Пачкой, за одну блокировку общего хранилища, см. SharedStore.delete_many
+        """
+        keys = list(keys)
+        self._local.delete_many(keys)
+        self._store.delete_many(keys)
+
+    def clear(self):
+        self._local.clear()
+
+    def sweep(self) -> int:
+        """
+        Истекает только локальный уровень. Освобожденные в БД ссылки из общего хранилища удаляет
+        обслуживание БД (через delete), и остальные воркеры узнают об этом из журнала.
+        """
+        return self._local.sweep()
+
+    def items_recent(self, limit: int) -> List[Tuple[Any, Any, float]]:
+        return self._local.items_recent(limit)
+
+    def preload(self, items: Iterable[Tuple[Any, Any, Optional[float]]]) -> int:
+        """
+        Прогревается только локальный уровень, общий и так переживает перезапуск воркера
+        """
+        return self._local.preload(items)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Статистика локального уровня, плюс попадания и промахи общего (по промахам локального)
+        """
+        return {**self._local.stats(), 'store_hits': self._store_hits, 'store_misses': self._store_misses}
+
+    def _load(self, key: Any, func: Callable[..., Any], args: tuple, kwargs: dict) -> Any:
+        value = self._store.get(key)
+        if value is None:
+            self._store_misses += 1
+            seq = self._store.seq()
+            value = func(*args, **kwargs)
+            self._store.set(key, value, seq)
+        else:
+            self._store_hits += 1
+        return value
+
+    async def _load_async(self, key: Any, func: Callable[..., Awaitable[Any]], args: tuple, kwargs: dict) -> Any:
+        value = self._store.get(key)
+        if value is None:
+            self._store_misses += 1
+            seq = self._store.seq()
+            value = await func(*args, **kwargs)
+            self._store.set(key, value, seq)
+        else:
+            self._store_hits += 1
+        return value
+
+    def _load_many(self, keys: List[Any], func: Callable[..., Dict[Any, Any]], args: tuple, kwargs: dict) -> Dict[Any, Any]:
+        found, missing = self._store_lookup(keys)
+        if missing:
+            seq = self._store.seq()
+            loaded = func(missing, *args, **kwargs)
+            self._store_fill(loaded, seq)
+            found.update(loaded)
+        return found
+
+    async def _load_many_async(self, keys: List[Any], func: Callable[..., Awaitable[Dict[Any, Any]]],
+                               args: tuple, kwargs: dict) -> Dict[Any, Any]:
+        found, missing = self._store_lookup(keys)
+        if missing:
+            seq = self._store.seq()
+            loaded = await func(missing, *args, **kwargs)
+            self._store_fill(loaded, seq)
+            found.update(loaded)
+        return found
+
+    def _store_lookup(self, keys: List[Any]) -> Tuple[Dict[Any, Any], List[Any]]:
+        found = {}
+        missing = []
+        for key in keys:
+            value = self._store.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                found[key] = value
+        self._store_hits += len(found)
+        self._store_misses += len(missing)
+        return found, missing
+
+    def _store_fill(self, values: Dict[Any, Any], seq: int):
+        for key, value in values.items():
+            self._store.set(key, value, seq)
+
+    def _sync(self):
+        if self._store.seq() == self._seq:
+            return
+        self._seq, keys = self._store.invalidations_since(self._seq)
+        if keys is None:
+            self._local.clear()
+            return
+        for key in keys:
+            self._local.delete(key)
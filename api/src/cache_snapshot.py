@@ -0,0 +1,85 @@
+"""
+Снимок кэша чтения для теплого перезапуска воркера.
+
+При остановке самые свежие по обращению записи пишутся в файл, при старте файл отображается в память
+и записи возвращаются в кэш в том же порядке, так что первые запросы после перезапуска не бьют в БД разом.
+
+Раскладка файла: заголовок, затем записи от старых к новым - срок записи (время по часам системы,
+до которого она могла жить в кэше), длины ключа и значения, ключ и значение в UTF-8.
+Срок сохраняется, а не выдается заново: запись из снимка живет не дольше, чем прожила бы без перезапуска,
+так что гарантия CACHE_READ_TTL про освобожденные и занятые заново ссылки не нарушается.
+Удаленные явно, пока воркер стоял, ссылки этим не отсекаются - загруженные записи сверяет с БД датаменеджер.
+"""
+
+import mmap
+import os
+import struct
+import time
+from typing import Any, Iterable, List, Tuple
+
+MAGIC = b'SLSNAP01'
+
+_HEADER = struct.Struct('<8sIId')   # magic, количество записей, резерв, время снимка
+_RECORD = struct.Struct('<dHH')     # срок по time.time(), длина ключа, длина значения
+
+
+def dump(path: str, items: Iterable[Tuple[str, str, float]]) -> int:
+    """
+    Пишет записи (ключ, значение, сколько секунд ей осталось) во временный файл и подменяет им снимок,
+    так что читатель никогда не видит недописанный файл, даже если воркеры останавливаются разом.
+    Возвращает количество записей.
+    """
+    now = time.time()
+    chunks = []
+    for key, value, remaining in items:
+        encoded_key = key.encode()
+        encoded_value = value.encode()
+        if len(encoded_key) > 0xFFFF or len(encoded_value) > 0xFFFF:
+            continue
+        chunks.append(_RECORD.pack(now + remaining, len(encoded_key), len(encoded_value)))
+        chunks.append(encoded_key)
+        chunks.append(encoded_value)
+    count = len(chunks) // 3
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'wb') as file:
+        file.write(_HEADER.pack(MAGIC, count, 0, now))
+        file.write(b''.join(chunks))
+    os.replace(temporary, path)
+    return count
+
+
+def load(path: str) -> List[Tuple[str, str, float]]:
+    """
+    Записи снимка (ключ, значение, сколько секунд ей осталось) от старых к новым, уже истекшие пропускаются.
+    Нет файла, чужой или битый файл - пустой список, то есть снимка нет.
+    """
+    try:
+        with open(path, 'rb') as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return _parse(mm)
+    except (OSError, ValueError, struct.error, UnicodeDecodeError):
+        return []
+
+
+def _parse(mm: Any) -> List[Tuple[str, str, float]]:
+    magic, count, _, _ = _HEADER.unpack_from(mm, 0)
+    if magic != MAGIC:
+        return []
+    now = time.time()
+    items = []
+    offset = _HEADER.size
+    for _ in range(count):
+        expires, key_size, value_size = _RECORD.unpack_from(mm, offset)
+        offset += _RECORD.size
+        end = offset + key_size + value_size
+        if end > len(mm):
+            return []
+        if expires > now:
+            key = mm[offset:offset + key_size].decode()
+            value = mm[offset + key_size:end].decode()
+            items.append((key, value, expires - now))
+        offset = end
+    return items
@@ -1,11 +1,102 @@
 
-from typing import Dict, Any
-from src.cache import CacheLRU, CacheWriteback
-from src.db import DBShortlinks, NoFreeShortlinks
-from src.shortlink_generator import shortlink_hash
+import time
+from typing import Dict, Any, AsyncIterator, Iterator, List, Optional, Tuple
+from src.cache import Cache, CacheLRU, CacheNegative, CacheWritebackBatch, WritebackFlusher, AsyncWritebackFlusher
+from src.cache_shared import CacheShared, LocalSharedStore, MmapSharedStore
+from src import cache_snapshot
+from src.db import DBShortlinks, ShortlinkNotFound
+from src.db_async import AsyncDBShortlinks
+from src.expiry import ExpiryJob
+from src.export import export_chunks, export_chunks_async
+from src import metrics
+from src.reservoir import Reservoir, ReservoirRefiller, AsyncReservoirRefiller
+from src.shortlink_generator import build_shortlink_encoder
 from config import config
 
 
+_shortlink_encoder = build_shortlink_encoder(config.SHORTLINK_SCHEME, config.SHORTLINK_KEY)
+
+_links_created = metrics.REGISTRY.counter('shortlinks_created_total', 'Созданные ссылки по способу создания', 'source')
+_created_reserved = _links_created.labels('reserved')
+_created_db = _links_created.labels('db')
+_created_bulk = _links_created.labels('bulk')
+
+
+def _hits_merge(pending: Tuple[str, int, float], hit: Tuple[str, int, float]) -> Tuple[str, int, float]:
+    """
+    Переходы по ссылке, накопленные в writeback-кэше: (short, количество, time.monotonic() последнего)
+    """
+    return pending[0], pending[1] + hit[1], max(pending[2], hit[2])
+
+
+def _build_cache_read() -> Cache:
+    """
+    Кэш чтения ссылок: локальный LRU процесса, либо он же поверх общего для воркеров хранилища
+    """
+    cache = CacheLRU(maxsize=config.CACHE_READ_MAXSIZE, ttl=config.CACHE_READ_TTL)
+    if config.CACHE_SHARED_BACKEND == 'mmap':
+        store = MmapSharedStore(
+            path=config.CACHE_SHARED_PATH,
+            slots=config.CACHE_SHARED_SLOTS,
+            journal_size=config.CACHE_SHARED_JOURNAL_SIZE,
+        )
+    elif config.CACHE_SHARED_BACKEND == 'local':
+        store = LocalSharedStore(maxsize=config.CACHE_SHARED_SLOTS, journal_size=config.CACHE_SHARED_JOURNAL_SIZE)
+    else:
+        return cache
+    return CacheShared(cache, store)
+
+
+def _new_shortlink(link_id: int) -> Optional[str]:
+    """
+    Короткая ссылка для новой строки с id link_id. Если id вышел за пространство схемы, новую ссылку не выдать,
+    но создание все равно может занять свободную строку, поэтому None, а не ошибка.
+    """
+    if link_id > _shortlink_encoder.max_number:
+        return None
+    return _shortlink_encoder.encode(link_id)
+
+
+def _new_shortlinks(link_ids: List[int]) -> List[Optional[str]]:
+    """
+    То же, что и _new_shortlink, только для пачки id: id в пространстве схемы кодируются одним вызовом
+    """
+    max_number = _shortlink_encoder.max_number
+    encoded = iter(_shortlink_encoder.encode_many([link_id for link_id in link_ids if link_id <= max_number]))
+    return [next(encoded) if link_id <= max_number else None for link_id in link_ids]
+
+
+def _free_reservations(rows: List[Tuple[int, str, Any]]) -> List[Tuple[int, str, Any, float]]:
+    """
+    К резерву из БД добавляется срок, до которого процесс им пользуется
+    """
+    usable_until = time.monotonic() + config.FREE_RESERVE_MAXAGE / 2
+    return [(link_id, short, reserved_at, usable_until) for link_id, short, reserved_at in rows]
+
+
+def _snapshot_actual(items: List[Tuple[str, str, float]], origins: Dict[str, str]) -> List[Tuple[str, str, float]]:
+    """
+    Записи снимка, которые совпадают с БД. Пока воркер стоял, другие могли удалить ссылку или занять ее заново,
+    а журнал удалений общего кэша этого не покажет: его позиция берется при старте воркера.
+    """
+    return [(short, origin, remaining) for short, origin, remaining in items if origins.get(short) == origin]
+
+
+def _chunk_last_key(rows: List[tuple]) -> Optional[Tuple]:
+    """
+    Ключ (date_access, id) последней строки куска. RETURNING порядок не гарантирует, поэтому максимум.
+    """
+    if not rows:
+        return None
+    return max((row[0], row[1]) for row in rows)
+
+
+def _page(rows: List[Any], limit: int) -> Dict[str, Any]:
+    shortlinks = {short: (origin, date_access, status) for _, short, origin, date_access, status in rows}
+    cursor = rows[-1][0] if rows and len(rows) >= limit else None
+    return {'links': shortlinks, 'next': cursor}
+
+
 class DataManager:
     """
     Инструментарий работы с данными сервиса (Адаптер).
@@ -16,10 +107,36 @@ class DataManager:
     Кэш данных работает по упрощенной модели в виде поля класса, что сохраняет кэш
     при повторном создании датаменеджера (по сути Синглтон). В данном кейсе это просто и безопасно,
     но в более сложных архитектурах, потребуется другая модель.
+    Промахи по несуществующим ссылкам тоже кэшируются, на время CACHE_NEGATIVE_TTL.
+    Чтобы воркеры не грели каждый свою копию, кэшу чтения можно включить общий уровень (CACHE_SHARED_BACKEND),
+    тогда удаление и переиспользование ссылки сбрасывают её и в кэшах остальных воркеров.
+
+    Переходы по ссылкам не пишутся в БД по одному: writeback-кэш копит по каждой ссылке их количество
+    и время последнего, а сброс сливает их в БД одним запросом на пачку (счетчик hits и время доступа).
+    Пока фоновый сброс writeback-кэша не запущен (writeback_start), кэш сбрасывается
+    прямо в запросе, который его переполнил.
+
+    Свободные ссылки для переиспользования заранее резервируются за процессом пачками в фоне (free_reserve_start),
+    так что создание ссылки обычно занимает готовую строку по id, не ища свободную в БД.
+    Пока запаса нет, ссылка создается как раньше, с поиском свободной строки в том же запросе.
     """
     _db: DBShortlinks
-    _cache_lru = CacheLRU(maxsize=config.CACHE_READ_MAXSIZE)
-    _cache_writeback = CacheWriteback(maxsize=config.CACHE_WRITE_MAXSIZE)
+    _cache_lru = _build_cache_read()
+    _cache_negative = CacheNegative(
+        maxsize=config.CACHE_NEGATIVE_MAXSIZE, ttl=config.CACHE_NEGATIVE_TTL,
+        error=ShortlinkNotFound, message="Ссылка '{key}' не найдена")
+    _cache_writeback = CacheWritebackBatch(
+        maxsize=config.CACHE_WRITE_MAXSIZE,
+        batch_size=config.CACHE_WRITE_BATCHSIZE,
+        max_pending=config.CACHE_WRITE_MAXPENDING,
+        merge=_hits_merge,
+    )
+    _writeback_flusher = WritebackFlusher(_cache_writeback, max_age=config.CACHE_WRITE_MAXAGE)
+    _free_shortlinks = Reservoir(None, config.FREE_RESERVE_SIZE)
+    _free_refiller = ReservoirRefiller(
+        _free_shortlinks, low_watermark=config.FREE_RESERVE_LOW, interval=config.FREE_RESERVE_INTERVAL)
+    _deactivate_job = ExpiryJob(chunk_size=config.EXPIRY_CHUNK_SIZE, time_budget=config.EXPIRY_TIME_BUDGET)
+    _expire_job = ExpiryJob(chunk_size=config.EXPIRY_CHUNK_SIZE, time_budget=config.EXPIRY_TIME_BUDGET)
 
     def __init__(self, db: DBShortlinks):
         self._db = db
@@ -28,11 +145,23 @@ class DataManager:
         """
         Берет ссылку из базы и обновляет время доступа, если это указано в аргументах
         """
-        origin = self._cache_lru.get(short, self._db.link_select, short)
+        origin = self._cache_lru.get(short, self._cache_negative.get, short, self._db.link_select, short)
         if update_access_date:
-            self._cache_writeback.put(short, self._db.link_actualize, short)
+            self._cache_writeback.put(short, self._db.links_hit, (short, 1, time.monotonic()))
         return origin
 
+    def shortlinks_resolve(self, shorts: List[str], update_access_date: bool = True) -> Dict[str, str]:
+        """
+        То же, что и shortlink_get, только для пачки ссылок: попадания берутся из кэша,
+        все промахи читаются из базы одним запросом, переходы ставятся в кэш одной пачкой.
+        Ненайденных ссылок в результате нет.
+        """
+        origins = self._cache_lru.get_many(shorts, self._cache_negative.get_many, self._db.links_select_origins)
+        if update_access_date and origins:
+            now = time.monotonic()
+            self._cache_writeback.put_many(self._db.links_hit, {short: (short, 1, now) for short in origins})
+        return origins
+
     def shortlinks_get(self, limit: int = 100, offset: int = 0) -> Dict[str, Any]:
         """
         Получает группу ссылок из базы с дополнительной инфой (время доступа не обновляет)
@@ -41,33 +170,95 @@ class DataManager:
         shortlinks = {short: (origin, status, date_access) for short, origin, status, date_access in rows}
         return shortlinks
 
-    def shortlink_deactivate_all_expired(self):
+    def shortlinks_page(self, after: int = 0, limit: int = 100) -> Dict[str, Any]:
+        """
+        То же, что и shortlinks_get, только страница берется по ключу: ссылки после курсора after.
+        В ответе, помимо ссылок, курсор следующей страницы (None, если это последняя).
+        """
+        rows = self._db.links_select_after(after, limit)
+        return _page(rows, limit)
+
+    def shortlinks_export(self, fmt: str, after: int = 0) -> Iterator[str]:
         """
-        Деактивация неиспользуемых ссылок
+        Выгружает все ссылки после курсора after кусками текста в формате fmt ('ndjson' или 'csv')
         """
-        self._db.link_set_inactive_shortlinks(config.SHORTLINK_TTL_SOFT)
+        return export_chunks(self._db.links_stream(after), fmt)
 
-    def shortlink_delete_all_expired(self):
+    def shortlink_deactivate_all_expired(self) -> int:
         """
-        Освобождение давно неиспользуемых ссылок
+        Деактивация неиспользуемых ссылок. Идет кусками и не дольше EXPIRY_TIME_BUDGET,
+        что не успело - доделает следующий вызов. Возвращает количество деактивированных.
         """
-        self._db.link_set_expired_shortlinks(config.SHORTLINK_TTL_HARD)
+        return self._deactivate_job.run(self._deactivate_chunk)
+
+    def shortlink_delete_all_expired(self) -> int:
+        """
+        Освобождение давно неиспользуемых ссылок, так же кусками.
+        Освобожденные ссылки выкидываются из кэшей. Возвращает количество освобожденных.
+        """
+        freed = self._expire_job.run(self._expire_chunk)
+        self._db.links_release_stale_reserved(config.FREE_RESERVE_MAXAGE)
+        return freed
+
+    def _deactivate_chunk(self, after: Optional[Tuple], limit: int) -> Tuple[int, Optional[Tuple]]:
+        rows = self._db.links_deactivate_chunk(config.SHORTLINK_TTL_SOFT, after, limit)
+        return len(rows), _chunk_last_key(rows)
+
+    def _expire_chunk(self, after: Optional[Tuple], limit: int) -> Tuple[int, Optional[Tuple]]:
+        rows = self._db.links_expire_chunk(config.SHORTLINK_TTL_HARD, after, limit)
+        self._forget_freed(rows)
+        return len(rows), _chunk_last_key(rows)
+
+    def _forget_freed(self, rows: List[tuple]):
+        shorts = [short for _, _, short in rows]
+        self._cache_lru.delete_many(shorts)
+        self._cache_writeback.delete_many(shorts)
 
     def shortlink_create(self, origin: str) -> str:
         """
-        Активирует ранее освобожденную ссылку, либо создает новую.
-        """
-        try:
-            short = self._db.link_select_free()
-        except NoFreeShortlinks:
-            link_id = self._db.link_insert()
-            short = shortlink_hash(link_id)
-            self._db.link_fill(link_id, short, origin)
-            return short
-        else:
-            self._db.link_reuse(short, origin)
+        Активирует ранее освобожденную ссылку, либо создает новую, за один запрос к БД.
+        Если ссылку удалось переиспользовать, id для новой не понадобился и возвращается в резерв.
+        """
+        reserved = self._free_take()
+        if reserved is not None:
+            link_id, short, reserved_at, _ = reserved
+            if self._db.link_reuse_reserved(link_id, reserved_at, origin):
+                self._cache_lru.delete(short)
+                self._cache_negative.delete(short)
+                _created_reserved.inc()
+                return short
+        link_id = self._db.link_id_take()
+        candidate = _new_shortlink(link_id)
+        short = self._db.link_create(link_id, candidate, origin)
+        if short != candidate:
+            self._db.link_id_put_back(link_id)
             self._cache_lru.delete(short)
-            return short
+        self._cache_negative.delete(short)
+        _created_db.inc()
+        return short
+
+    def shortlinks_create(self, origins: List[str]) -> List[str]:
+        """
+        Создает пачку ссылок, возвращает короткие ссылки в порядке origins.
+        На каждые DB_CREATE_BATCHSIZE ссылок уходит два запроса: резерв id и само создание.
+        """
+        shorts = []
+        for start in range(0, len(origins), config.DB_CREATE_BATCHSIZE):
+            batch = origins[start:start + config.DB_CREATE_BATCHSIZE]
+            link_ids = self._db.link_ids_reserve(len(batch))
+            candidates = _new_shortlinks(link_ids)
+            created = self._db.links_create(link_ids, candidates, batch)
+            self._shortlinks_created(link_ids, candidates, created)
+            shorts.extend(created)
+        return shorts
+
+    def _shortlinks_created(self, link_ids: List[int], candidates: List[Optional[str]], created: List[str]):
+        for link_id, candidate, short in zip(link_ids, candidates, created):
+            if short != candidate:
+                self._db.link_id_put_back(link_id)
+                self._cache_lru.delete(short)
+            self._cache_negative.delete(short)
+        _created_bulk.inc(len(created))
 
     def shortlink_delete(self, short: str):
         """
@@ -83,8 +274,329 @@ class DataManager:
         """
         cls._cache_writeback.flush()
 
+    def writeback_start(self):
+        """
+        Запускает фоновый поток сброса кэша обновления доступа к ссылкам
+        """
+        self._writeback_flusher.start()
+
+    def writeback_stop(self):
+        """
+        Останавливает фоновый сброс, дописывая в БД всё накопленное
+        """
+        self._writeback_flusher.stop()
+
+    def free_reserve_start(self):
+        """
+        Запускает фоновое резервирование свободных ссылок
+        """
+        self._free_refiller.start(self._free_reserve)
+
+    def free_reserve_stop(self):
+        """
+        Останавливает резервирование и возвращает неизрасходованный резерв в свободные
+        """
+        self._free_refiller.stop(self._free_release)
+
+    def _free_reserve(self, count: int) -> List[Tuple[int, str, Any, float]]:
+        return _free_reservations(self._db.links_reserve_free(count))
+
+    def _free_release(self, reservations: List[Tuple[int, str, Any, float]]):
+        self._db.links_release_reserved([(link_id, reserved_at) for link_id, _, reserved_at, _ in reservations])
+
+    def _free_take(self) -> Optional[Tuple[int, str, Any, float]]:
+        """
+        Резерв, который держится дольше половины FREE_RESERVE_MAXAGE, не используется:
+        его вот-вот освободят в БД. Такие просто выкидываются, в БД их освободит обслуживание.
+        """
+        while True:
+            reserved = self._free_shortlinks.take_nowait()
+            if reserved is None or reserved[3] > time.monotonic():
+                return reserved
+
+    def db_stats(self) -> Dict[str, float]:
+        """
+        Статистика подключений к БД (занятость пула, очередь ожидающих, время ожидания)
+        """
+        return self._db.connector_stats()
+
+    def cache_sweep(self) -> int:
+        """
+        Выкидывает из кэша чтения ссылки, которые держатся в нем дольше CACHE_READ_TTL
+        """
+        return self._cache_lru.sweep()
+
+    def cache_snapshot_save(self) -> int:
+        """
+        Пишет в снимок CACHE_SNAPSHOT_SIZE самых свежих записей кэша чтения, возвращает их количество
+        """
+        if config.CACHE_SNAPSHOT_PATH is None:
+            return 0
+        items = self._cache_lru.items_recent(config.CACHE_SNAPSHOT_SIZE)
+        return cache_snapshot.dump(config.CACHE_SNAPSHOT_PATH, items)
+
+    def cache_warm(self) -> int:
+        """
+        Заполняет кэш чтения из снимка, а если его нет - ссылками, к которым последними обращались.
+        Записи снимка сверяются с БД одним запросом, попадают в кэш только те, что не изменились.
+        Возвращает количество записей.
+        """
+        if config.CACHE_SNAPSHOT_PATH is None:
+            return 0
+        items = cache_snapshot.load(config.CACHE_SNAPSHOT_PATH)
+        if items:
+            items = _snapshot_actual(items, self._db.links_select_origins([short for short, _, _ in items]))
+        if not items:
+            rows = self._db.links_select_recent(config.CACHE_SNAPSHOT_SIZE)
+            items = [(short, origin, None) for short, origin in rows]
+        return self._cache_lru.preload(items)
+
+    def cache_stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Статистика кэшей (попадания кэша чтения, глубина очереди writeback-кэша, время сброса)
+        """
+        return {
+            'read': self._cache_lru.stats(),
+            'negative': self._cache_negative.stats(),
+            'writeback': self._cache_writeback.stats(),
+        }
+
+    def expiry_stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Статистика устаревания ссылок (кусков, строк, проходов по таблице, время куска)
+        """
+        return {'deactivate': self._deactivate_job.stats(), 'expire': self._expire_job.stats()}
+
+
+class AsyncDataManager:
+    """
+    То же, что и DataManager, только поверх асинхронной БД, чтобы обработчики не блокировали event loop.
+
+    Кэши чтения и промахов общие с DataManager, так что удаление или создание ссылки через любой из них видно обоим.
+    Writeback-кэш свой, т.к. в нем лежат отложенные корутины, которые сбрасываются только через await.
+    """
+    _db: AsyncDBShortlinks
+    _cache_lru = DataManager._cache_lru
+    _cache_negative = DataManager._cache_negative
+    _cache_writeback = CacheWritebackBatch(
+        maxsize=config.CACHE_WRITE_MAXSIZE,
+        batch_size=config.CACHE_WRITE_BATCHSIZE,
+        max_pending=config.CACHE_WRITE_MAXPENDING,
+        merge=_hits_merge,
+    )
+    _writeback_flusher = AsyncWritebackFlusher(_cache_writeback, max_age=config.CACHE_WRITE_MAXAGE)
+    _free_shortlinks = Reservoir(None, config.FREE_RESERVE_SIZE)
+    _free_refiller = AsyncReservoirRefiller(
+        _free_shortlinks, low_watermark=config.FREE_RESERVE_LOW, interval=config.FREE_RESERVE_INTERVAL)
+    _deactivate_job = ExpiryJob(chunk_size=config.EXPIRY_CHUNK_SIZE, time_budget=config.EXPIRY_TIME_BUDGET)
+    _expire_job = ExpiryJob(chunk_size=config.EXPIRY_CHUNK_SIZE, time_budget=config.EXPIRY_TIME_BUDGET)
+
+    def __init__(self, db: AsyncDBShortlinks):
+        self._db = db
+
+    async def shortlink_get(self, short: str, update_access_date: bool = True) -> str:
+        """
+        Берет ссылку из базы и обновляет время доступа, если это указано в аргументах
+        """
+        origin = await self._cache_lru.get_async(short, self._cache_negative.get_async, short, self._db.link_select, short)
+        if update_access_date:
+            await self._cache_writeback.put_async(short, self._db.links_hit, (short, 1, time.monotonic()))
+        return origin
+
+    async def shortlinks_resolve(self, shorts: List[str], update_access_date: bool = True) -> Dict[str, str]:
+        """
+        То же, что и shortlink_get, только для пачки ссылок
+        """
+        origins = await self._cache_lru.get_many_async(
+            shorts, self._cache_negative.get_many_async, self._db.links_select_origins)
+        if update_access_date and origins:
+            now = time.monotonic()
+            await self._cache_writeback.put_many_async(self._db.links_hit, {short: (short, 1, now) for short in origins})
+        return origins
+
+    async def shortlinks_get(self, limit: int = 100, offset: int = 0) -> Dict[str, Any]:
+        """
+        Получает группу ссылок из базы с дополнительной инфой (время доступа не обновляет)
+        """
+        rows = await self._db.links_select(limit, offset)
+        shortlinks = {short: (origin, status, date_access) for short, origin, status, date_access in rows}
+        return shortlinks
+
+    async def shortlinks_page(self, after: int = 0, limit: int = 100) -> Dict[str, Any]:
+        """
+        То же, что и shortlinks_get, только страница берется по ключу
+        """
+        rows = await self._db.links_select_after(after, limit)
+        return _page(rows, limit)
+
+    def shortlinks_export(self, fmt: str, after: int = 0) -> AsyncIterator[str]:
+        """
+        Выгружает все ссылки после курсора after кусками текста в формате fmt ('ndjson' или 'csv')
+        """
+        return export_chunks_async(self._db.links_stream(after), fmt)
+
+    async def shortlink_deactivate_all_expired(self) -> int:
+        """
+        Деактивация неиспользуемых ссылок, кусками и не дольше EXPIRY_TIME_BUDGET
+        """
+        return await self._deactivate_job.run_async(self._deactivate_chunk)
+
+    async def shortlink_delete_all_expired(self) -> int:
+        """
+        Освобождение давно неиспользуемых ссылок, кусками, с выкидыванием освобожденных из кэшей
+        """
+        freed = await self._expire_job.run_async(self._expire_chunk)
+        await self._db.links_release_stale_reserved(config.FREE_RESERVE_MAXAGE)
+        return freed
+
+    async def _deactivate_chunk(self, after: Optional[Tuple], limit: int) -> Tuple[int, Optional[Tuple]]:
+        rows = await self._db.links_deactivate_chunk(config.SHORTLINK_TTL_SOFT, after, limit)
+        return len(rows), _chunk_last_key(rows)
+
+    async def _expire_chunk(self, after: Optional[Tuple], limit: int) -> Tuple[int, Optional[Tuple]]:
+        rows = await self._db.links_expire_chunk(config.SHORTLINK_TTL_HARD, after, limit)
+        self._forget_freed(rows)
+        return len(rows), _chunk_last_key(rows)
+
+    _forget_freed = DataManager._forget_freed
 
+    async def shortlink_create(self, origin: str) -> str:
+        """
+        Активирует ранее освобожденную ссылку, либо создает новую, за один запрос к БД.
+        Если ссылку удалось переиспользовать, id для новой не понадобился и возвращается в резерв.
+        """
+        reserved = self._free_take()
+        if reserved is not None:
+            link_id, short, reserved_at, _ = reserved
+            if await self._db.link_reuse_reserved(link_id, reserved_at, origin):
+                self._cache_lru.delete(short)
+                self._cache_negative.delete(short)
+                _created_reserved.inc()
+                return short
+        link_id = await self._db.link_id_take()
+        candidate = _new_shortlink(link_id)
+        short = await self._db.link_create(link_id, candidate, origin)
+        if short != candidate:
+            self._db.link_id_put_back(link_id)
+            self._cache_lru.delete(short)
+        self._cache_negative.delete(short)
+        _created_db.inc()
+        return short
+
+    async def shortlinks_create(self, origins: List[str]) -> List[str]:
+        """
+        Создает пачку ссылок, возвращает короткие ссылки в порядке origins
+        """
+        shorts = []
+        for start in range(0, len(origins), config.DB_CREATE_BATCHSIZE):
+            batch = origins[start:start + config.DB_CREATE_BATCHSIZE]
+            link_ids = await self._db.link_ids_reserve(len(batch))
+            candidates = _new_shortlinks(link_ids)
+            created = await self._db.links_create(link_ids, candidates, batch)
+            self._shortlinks_created(link_ids, candidates, created)
+            shorts.extend(created)
+        return shorts
 
+    _shortlinks_created = DataManager._shortlinks_created
 
+    async def shortlink_delete(self, short: str):
+        """
+        Освобождает любую ссылку безусловно
+        """
+        await self._db.link_delete(short)
+        self._cache_lru.delete(short)
+        self._cache_writeback.delete(short)
+
+    async def cache_warm(self) -> int:
+        """
+        То же, что и DataManager.cache_warm. Снимок читается прямо в event loop: это отображенный в память
+        локальный файл, а до прогрева воркер запросы все равно не принимает.
+        """
+        if config.CACHE_SNAPSHOT_PATH is None:
+            return 0
+        items = cache_snapshot.load(config.CACHE_SNAPSHOT_PATH)
+        if items:
+            items = _snapshot_actual(items, await self._db.links_select_origins([short for short, _, _ in items]))
+        if not items:
+            rows = await self._db.links_select_recent(config.CACHE_SNAPSHOT_SIZE)
+            items = [(short, origin, None) for short, origin in rows]
+        return self._cache_lru.preload(items)
+
+    async def flush_writeback_cache(self):
+        """
+        Сбрасывает кэш обновления доступа к ссылкам в БД
+        """
+        await self._cache_writeback.flush_async()
+
+    def writeback_start(self):
+        """
+        Запускает фоновую задачу сброса кэша обновления доступа, вызывается из работающего event loop
+        """
+        self._writeback_flusher.start()
+
+    async def writeback_stop(self):
+        """
+        Останавливает фоновый сброс, дописывая в БД всё накопленное
+        """
+        await self._writeback_flusher.stop()
+
+    def free_reserve_start(self):
+        """
+        Запускает фоновое резервирование свободных ссылок, вызывается из работающего event loop
+        """
+        self._free_refiller.start(self._free_reserve)
+
+    async def free_reserve_stop(self):
+        """
+        Останавливает резервирование и возвращает неизрасходованный резерв в свободные
+        """
+        await self._free_refiller.stop(self._free_release)
+
+    async def _free_reserve(self, count: int) -> List[Tuple[int, str, Any, float]]:
+        return _free_reservations(await self._db.links_reserve_free(count))
+
+    async def _free_release(self, reservations: List[Tuple[int, str, Any, float]]):
+        await self._db.links_release_reserved(
+            [(link_id, reserved_at) for link_id, _, reserved_at, _ in reservations])
+
+    _free_take = DataManager._free_take
+
+    def db_stats(self) -> Dict[str, float]:
+        """
+        Статистика подключений к БД
+        """
+        return self._db.connector_stats()
+
+    cache_sweep = DataManager.cache_sweep
+    cache_snapshot_save = DataManager.cache_snapshot_save
+    cache_stats = DataManager.cache_stats
+    expiry_stats = DataManager.expiry_stats
+
+
+def _register_metrics():
+    """
+    Статистика кэшей, запасов и устаревания выгружается в метрики как есть, опросом при выгрузке.
+    Обслуживание БД идет через синхронный DataManager, поэтому устаревание берется у него.
+    """
+    registry = metrics.REGISTRY
+    registry.register_stats(
+        'shortlinks_cache_read', 'Кэш чтения ссылок', DataManager._cache_lru.stats,
+        counters=('hits', 'misses', 'evictions', 'coalesced', 'expired', 'store_hits', 'store_misses'))
+    registry.register_stats(
+        'shortlinks_cache_negative', 'Кэш промахов', DataManager._cache_negative.stats, counters=('hits',))
+    registry.register_stats(
+        'shortlinks_cache_writeback', 'Writeback-кэш переходов по ссылкам',
+        lambda: {'sync': DataManager._cache_writeback.stats(), 'async': AsyncDataManager._cache_writeback.stats()},
+        counters=('dropped', 'errors', 'flushes', 'flushed_items', 'flush_time_total'), label='manager')
+    registry.register_stats(
+        'shortlinks_free_reserve', 'Запас свободных ссылок процесса',
+        lambda: {'sync': {'size': len(DataManager._free_shortlinks)},
+                 'async': {'size': len(AsyncDataManager._free_shortlinks)}},
+        label='manager')
+    registry.register_stats(
+        'shortlinks_expiry', 'Устаревание ссылок',
+        lambda: {'deactivate': DataManager._deactivate_job.stats(), 'expire': DataManager._expire_job.stats()},
+        counters=('chunks', 'rows', 'passes', 'errors'), label='job')
 
 
+_register_metrics()
@@ -1,21 +1,90 @@
 
+import itertools
+import re
+import threading
+import time
+from datetime import datetime
 import psycopg2
 from psycopg2 import DatabaseError
 from psycopg2.errorcodes import DUPLICATE_DATABASE
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TransactionRollbackError, connection as _psql_connection
 
-from typing import TYPE_CHECKING
+from typing import Any, Dict, Iterator, List, Sequence, Tuple, Optional, TYPE_CHECKING
 if TYPE_CHECKING:
     from psycopg2.extensions import connection as psql_connection, cursor as psql_cursor
 
 from config import config
+from src import metrics
+from src.replicas import LAG_QUERY, Replica, ReplicaSet
+from src.reservoir import Reservoir
+
+CHUNK_KEY_MIN = (datetime.min, 0) # ключ (date_access, id) меньше любого в таблице
+
+QUERY_SECONDS = metrics.REGISTRY.histogram(
+    'shortlinks_db_query_seconds', 'Время запросов к БД (с ожиданием подключения) по методам слоя БД', 'query')
+
+
+def observe_query(name: str, started: float):
+    """
+    Метка запроса name - имя метода слоя БД, который его выполнил, передается в коннектор явно
+    """
+    QUERY_SECONDS.labels(name).time_since(started)
+
+def hits_columns(hits: List[Tuple[str, int, float]]) -> Tuple[List[str], List[int], List[float]]:
+    """
+    Накопленные переходы (short, количество, time.monotonic() последнего) в столбцы для запроса:
+    short, количество и сколько секунд назад был последний переход. Возраст, а не время, передается,
+    чтобы время доступа считалось по часам БД, как и везде.
+    """
+    now = time.monotonic()
+    return [short for short, _, _ in hits], [count for _, count, _ in hits], [now - last for _, _, last in hits]
 
 class ShortlinkNotFound(Exception): pass
 class NoFreeShortlinks(Exception): pass
+class PoolTimeout(Exception): pass
+
+
+class PreparingConnection(_psql_connection):
+    """
+    Подключение, которое помнит, какие запросы на нем уже подготовлены (PREPARE живет до конца сессии)
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+_PLACEHOLDER = re.compile('%([%s])')
+
+
+def _numbered(query: str) -> str:
+    """
+    Позиционные параметры psycopg2 (%s) в нумерованные параметры PREPARE ($1, $2, ...).
+    PREPARE выполняется без параметров, так что psycopg2 не разэкранирует %% сам, это делается здесь же.
+    """
+    numbers = itertools.count(1)
+    return _PLACEHOLDER.sub(lambda match: '%' if match.group(1) == '%' else f'${next(numbers)}', query)
+
+
+def _execute_prepared(cursor: 'psql_cursor', name: str, query: str, vars: tuple):
+    """
+    Подготавливает запрос на подключении курсора при первом обращении и выполняет его по имени,
+    так что разбор и планирование запроса не повторяются на каждый вызов.
+    Подготовленный запрос не откатывается вместе с транзакцией, так что помнить его можно сразу.
+    """
+    connection = cursor.connection
+    if name not in connection.prepared:
+        cursor.execute(f'PREPARE {name} AS {_numbered(query)}')
+        connection.prepared.add(name)
+    cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(vars))})", vars)
 
 
 class _Connector:
     """
     Слой подключения к БД и выполнения запросов.
+
+    У каждого запроса есть имя name (имя метода слоя БД), по нему запрос попадает в метрики.
+    Горячие запросы выполняются через execute_prepared: запрос с именем name подготавливается
+    на подключении один раз, дальше выполняется по имени. Параметры у таких запросов только позиционные.
     """
     _connection: 'psql_connection'
     _dbname: str
@@ -31,11 +100,25 @@ class _Connector:
 
     def _connect(self):
         self._connection = psycopg2.connect(
-            dbname=self._dbname, user=self._user, password=self._password, host=self._host)
+            dbname=self._dbname, user=self._user, password=self._password, host=self._host,
+            connect_timeout=config.DB_CONNECT_TIMEOUT, connection_factory=PreparingConnection)
 
-    def execute(self, query, vars=None) -> 'psql_cursor':
-        cursor = self._get_cursor()
-        cursor.execute(query, vars)
+    def execute(self, name: str, query, vars=None) -> 'psql_cursor':
+        started = time.perf_counter()
+        try:
+            cursor = self._get_cursor()
+            cursor.execute(query, vars)
+        finally:
+            observe_query(name, started)
+        return cursor
+
+    def execute_prepared(self, name: str, query: str, vars: tuple) -> 'psql_cursor':
+        started = time.perf_counter()
+        try:
+            cursor = self._get_cursor()
+            _execute_prepared(cursor, name, query, vars)
+        finally:
+            observe_query(name, started)
         return cursor
 
     def _get_cursor(self) -> 'psql_cursor':
@@ -50,6 +133,43 @@ class _Connector:
     def autocommit_disable(self):
         self._connection.autocommit = False
 
+    def close(self):
+        self._connection.close()
+
+    def stream(self, query, vars=None, batch_size: int = 1000) -> Iterator[tuple]:
+        """
+        Выполняет запрос через серверный (именованный) курсор и отдает строки по одной,
+        подтягивая их из БД пачками по batch_size, так что память не зависит от размера результата.
+        """
+        return _stream_rows(self._connection, query, vars, batch_size)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Одиночное подключение статистики не ведет, она есть только у пула.
+        """
+        return {}
+
+
+_stream_cursor_ids = itertools.count()
+
+
+def _stream_rows(connection: 'psql_connection', query, vars, batch_size: int) -> Iterator[tuple]:
+    """
+    Именованный курсор живет только внутри транзакции, поэтому подключение в режиме autocommit
+    на время чтения из него переводится в обычный режим, а по окончании транзакция откатывается.
+    """
+    autocommit = connection.autocommit
+    connection.autocommit = False
+    try:
+        with connection.cursor(name=f'stream_{next(_stream_cursor_ids)}') as cursor:
+            cursor.itersize = batch_size
+            cursor.execute(query, vars)
+            yield from cursor
+    finally:
+        if autocommit:
+            connection.rollback()
+            connection.autocommit = True
+
 
 class _SimpleConnector(_Connector):
     def __init__(self, dbname: str, user: str, password: str, host: str):
@@ -77,6 +197,332 @@ class _LazyConnector(_Connector):
             self._connect()
         return super()._get_cursor()
 
+    def stream(self, query, vars=None, batch_size: int = 1000) -> Iterator[tuple]:
+        if not self._connected:
+            self._connect()
+        return super().stream(query, vars, batch_size)
+
+    def close(self):
+        if self._connected:
+            super().close()
+            self._connected = False
+
+
+class ConnectionPool:
+    """
+    Пул подключений к БД, общий на процесс.
+
+    Подключение выдается на время запроса и сразу возвращается обратно.
+    Всего открыто не больше maxsize подключений, из них minsize держатся открытыми всегда,
+    а простаивающие дольше idle_timeout сверх этого закрываются.
+    Подключение, пролежавшее в пуле дольше healthcheck_interval, перед выдачей проверяется запросом.
+    Если все подключения заняты, потребитель ждет освобождения не дольше timeout,
+    после чего получает PoolTimeout.
+    """
+    def __init__(self, dbname: str, user: str, password: str, host: str,
+                 minsize: int, maxsize: int, timeout: float, idle_timeout: float, healthcheck_interval: float):
+        self._dbname = dbname
+        self._user = user
+        self._password = password
+        self._host = host
+        self._minsize = minsize
+        self._maxsize = maxsize
+        self._timeout = timeout
+        self._idle_timeout = idle_timeout
+        self._healthcheck_interval = healthcheck_interval
+        self._idle: List[Tuple['psql_connection', float]] = []  # стек (подключение, время возврата)
+        self._size = 0  # все открытые подключения, и свободные, и выданные
+        self._condition = threading.Condition()
+        self._waiters = 0
+        self._wait_count = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+        self._timeouts = 0
+
+    def getconn(self) -> 'psql_connection':
+        while True:
+            connection, released_at = self._checkout()
+            if connection is None:
+                return self._open()
+            if self._is_alive(connection, released_at):
+                return connection
+            self._discard(connection)
+
+    def putconn(self, connection: 'psql_connection'):
+        if not connection.closed and connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            try:
+                connection.rollback()
+            except psycopg2.Error:
+                pass
+        if connection.closed:
+            self._discard(connection)
+            return
+        connection.autocommit = True
+        with self._condition:
+            self._idle.append((connection, time.monotonic()))
+            expired = self._reap_idle()
+            self._condition.notify()
+        for connection in expired:
+            connection.close()
+
+    def fill(self):
+        """
+        Открывает подключения до minsize, чтобы первые запросы не ждали рукопожатия с БД
+        """
+        while True:
+            with self._condition:
+                if self._size >= self._minsize:
+                    return
+                self._size += 1
+            self.putconn(self._open())
+
+    def close(self):
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for connection, _ in idle:
+            connection.close()
+
+    def stats(self) -> Dict[str, float]:
+        with self._condition:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'waiters': self._waiters,
+                'wait_count': self._wait_count,
+                'wait_time_total': self._wait_time_total,
+                'wait_time_max': self._wait_time_max,
+                'timeouts': self._timeouts,
+            }
+
+    def _checkout(self) -> Tuple[Optional['psql_connection'], float]:
+        """
+        Берет свободное подключение из пула. Если свободных нет, но лимит позволяет,
+        резервирует место под новое и возвращает None - открывать его надо уже вне блокировки.
+        """
+        with self._condition:
+            if not self._idle and self._size >= self._maxsize:
+                self._wait()
+            if self._idle:
+                return self._idle.pop()
+            self._size += 1
+            return None, 0.0
+
+    def _wait(self):
+        started = time.monotonic()
+        self._waiters += 1
+        try:
+            while not self._idle and self._size >= self._maxsize:
+                remaining = started + self._timeout - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(f'Нет свободных подключений к БД в течение {self._timeout} сек.')
+                self._condition.wait(remaining)
+        finally:
+            self._waiters -= 1
+            waited = time.monotonic() - started
+            self._wait_count += 1
+            self._wait_time_total += waited
+            self._wait_time_max = max(self._wait_time_max, waited)
+
+    def _open(self) -> 'psql_connection':
+        try:
+            connection = psycopg2.connect(
+                dbname=self._dbname, user=self._user, password=self._password, host=self._host,
+                connect_timeout=config.DB_CONNECT_TIMEOUT, connection_factory=PreparingConnection)
+        except BaseException:
+            self._discard(None)
+            raise
+        connection.autocommit = True
+        return connection
+
+    def _discard(self, connection: Optional['psql_connection']):
+        if connection is not None and not connection.closed:
+            connection.close()
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def _is_alive(self, connection: 'psql_connection', released_at: float) -> bool:
+        if connection.closed:
+            return False
+        if time.monotonic() - released_at < self._healthcheck_interval:
+            return True
+        try:
+            connection.cursor().execute('SELECT 1')
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _reap_idle(self) -> List['psql_connection']:
+        """
+        Вынимает из пула давно простаивающие подключения сверх minsize.
+        Вызывается под блокировкой, закрывать вынутое надо уже после нее.
+        """
+        expired = []
+        deadline = time.monotonic() - self._idle_timeout
+        while self._idle and self._size > self._minsize and self._idle[0][1] < deadline:
+            connection, _ = self._idle.pop(0)
+            self._size -= 1
+            expired.append(connection)
+        return expired
+
+
+class _PooledConnector(_Connector):
+    """
+    Это _Connector поверх общего на процесс пула подключений.
+
+    Подключения пула работают в режиме autocommit: запрос берет подключение из пула
+    и сразу отдает его обратно (результат к тому моменту уже лежит в курсоре),
+    поэтому commit() здесь ничего не делает, а сам коннектор можно делить между потоками.
+    Экземпляры с одинаковыми параметрами подключения используют один пул.
+    """
+    _pools: Dict[Tuple[str, str, str], ConnectionPool] = {}
+    _pools_lock = threading.Lock()
+    _pool: ConnectionPool
+
+    def __init__(self, dbname: str, user: str, password: str, host: str):
+        super().__init__(dbname, user, password, host)
+        with self._pools_lock:
+            pool_key = (dbname, user, host)
+            if pool_key not in self._pools:
+                self._pools[pool_key] = ConnectionPool(
+                    dbname=dbname, user=user, password=password, host=host,
+                    minsize=config.DB_POOL_MINSIZE,
+                    maxsize=config.DB_POOL_MAXSIZE,
+                    timeout=config.DB_POOL_TIMEOUT,
+                    idle_timeout=config.DB_POOL_IDLE_TIMEOUT,
+                    healthcheck_interval=config.DB_POOL_HEALTHCHECK_INTERVAL,
+                )
+            self._pool = self._pools[pool_key]
+
+    @property
+    def pool(self) -> ConnectionPool:
+        return self._pool
+
+    def execute(self, name: str, query, vars=None) -> 'psql_cursor':
+        started = time.perf_counter()
+        try:
+            connection = self._pool.getconn()
+            try:
+                cursor = connection.cursor()
+                cursor.execute(query, vars)
+            finally:
+                self._pool.putconn(connection)
+        finally:
+            observe_query(name, started)
+        return cursor
+
+    def execute_prepared(self, name: str, query: str, vars: tuple) -> 'psql_cursor':
+        """
+        Запрос готовится на каждом подключении пула отдельно, при первом его выполнении на этом подключении
+        """
+        started = time.perf_counter()
+        try:
+            connection = self._pool.getconn()
+            try:
+                cursor = connection.cursor()
+                _execute_prepared(cursor, name, query, vars)
+            finally:
+                self._pool.putconn(connection)
+        finally:
+            observe_query(name, started)
+        return cursor
+
+    def stream(self, query, vars=None, batch_size: int = 1000) -> Iterator[tuple]:
+        """
+        Подключение занято, пока результат не дочитан (или пока итератор не закрыт)
+        """
+        connection = self._pool.getconn()
+        try:
+            yield from _stream_rows(connection, query, vars, batch_size)
+        finally:
+            self._pool.putconn(connection)
+
+    def commit(self):
+        pass
+
+    def autocommit_enable(self):
+        pass
+
+    def autocommit_disable(self):
+        raise RuntimeError('Подключения пула работают только в режиме autocommit')
+
+    def close(self):
+        self._pool.close()
+
+    def stats(self) -> Dict[str, float]:
+        return self._pool.stats()
+
+
+# Ошибки, после которых читающий запрос повторяется на основном сервере: реплика недоступна,
+# или запрос отменен из-за конфликта с проигрыванием изменений
+_REPLICA_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, TransactionRollbackError, PoolTimeout)
+
+
+class _ReadConnector:
+    """
+    Коннектор читающих запросов: выполняет их на реплике, которую выбрал ReplicaSet,
+    а если выбрать некого или реплика не ответила - на основном сервере.
+    Отставание реплик проверяет фоновая задача (check), а не запросы: выбор реплики не ждет ни проверки,
+    ни подключения к реплике. Пока реплику ни разу не проверили, чтение идет на основной сервер.
+    Поток выгрузки на основной сервер посреди чтения не переключается.
+    """
+    def __init__(self, primary: _Connector, replicas: ReplicaSet):
+        self._primary = primary
+        self.replicas = replicas
+
+    def execute(self, name: str, query, vars=None) -> 'psql_cursor':
+        return self._read('execute', name, query, vars)
+
+    def execute_prepared(self, name: str, query: str, vars: tuple) -> 'psql_cursor':
+        return self._read('execute_prepared', name, query, vars)
+
+    def stream(self, query, vars=None, batch_size: int = 1000) -> Iterator[tuple]:
+        replica = self._route()
+        connector = replica.connector if replica is not None else self._primary
+        return connector.stream(query, vars, batch_size)
+
+    def close(self):
+        """
+        Закрывает только реплики, основной сервер закрывает его владелец
+        """
+        for replica in self.replicas.replicas:
+            replica.connector.close()
+
+    def _read(self, method: str, *args) -> 'psql_cursor':
+        replica = self._route()
+        if replica is not None:
+            started = time.perf_counter()
+            try:
+                cursor = getattr(replica.connector, method)(*args)
+            except _REPLICA_ERRORS:
+                self.replicas.failed(replica)
+            else:
+                self.replicas.observe(replica, time.perf_counter() - started)
+                return cursor
+        return getattr(self._primary, method)(*args)
+
+    def _route(self) -> Optional[Replica]:
+        return self.replicas.pick()
+
+    def check(self):
+        """
+        Проверяет отставание реплик, которым пора. Вызывается фоновой задачей раз в DB_REPLICA_CHECK_INTERVAL.
+        """
+        for replica in self.replicas.due():
+            self.replica_lag(replica)
+
+    def replica_lag(self, replica: Replica):
+        started = time.perf_counter()
+        try:
+            lag = replica.connector.execute('replica_lag', LAG_QUERY).fetchone()[0]
+        except _REPLICA_ERRORS:
+            self.replicas.failed(replica)
+            return
+        self.replicas.checked(replica, lag, time.perf_counter() - started)
+
 
 class _DBEngine:
     _connector: _Connector
@@ -89,11 +535,17 @@ class _DBEngine:
         self._host = host
         self._connector = self._CONNECTOR_FACTORY(dbname=dbname, user=user, password=password, host=host)
 
+    def close(self):
+        self._connector.close()
+
+    def connector_stats(self) -> Dict[str, float]:
+        return self._connector.stats()
+
     def _table_exists(self):
         query = """SELECT table_schema FROM information_schema.tables 
             WHERE table_schema='shortlinks' AND table_name='link'"""
         try:
-            cursor = self._connector.execute(query)
+            cursor = self._connector.execute('_table_exists', query)
         except DatabaseError:
             return False
         rows = cursor.fetchall()
@@ -103,7 +555,7 @@ class _DBEngine:
 
     def _database_exists(self):
         query = """SELECT oid FROM pg_catalog.pg_database WHERE datname='shortlinks'"""
-        cursor = self._connector.execute(query)
+        cursor = self._connector.execute('_database_exists', query)
         rows = cursor.fetchall()
         if rows:
             return True
@@ -126,11 +578,178 @@ class DBShortlinks(_DBEngine):
 
     Пока работает с одной таблицей. При росте количества таблиц
     можно распилить на категории наследованием или композицией.
+
+    Id для новых ссылок резервируются в последовательности пачками и раздаются из запаса процесса.
+    Непотраченные при остановке id просто пропадают, дыры в последовательности ни на что не влияют.
+
+    С репликами (replica_hosts) чтение ссылок и страниц идет через коннектор чтения, запись и обслуживание -
+    только на основной сервер. Ссылку, которой на реплике еще нет (только что создана), чтение дочитывает
+    с основного сервера, чтобы она не попала в кэш несуществующих.
     """
+    _link_ids: Reservoir
+    _reader: Any
+
+    def __init__(self, dbname: str, user: str, password: str, host: str, replica_hosts: Sequence[str] = ()):
+        super().__init__(dbname=dbname, user=user, password=password, host=host)
+        self._link_ids = Reservoir(self.link_ids_reserve, config.DB_ID_RESERVE_SIZE)
+        self._reader = self._connector
+        if replica_hosts:
+            replicas = [
+                Replica(replica_host, self._CONNECTOR_FACTORY(
+                    dbname=dbname, user=user, password=password, host=replica_host))
+                for replica_host in replica_hosts
+            ]
+            self._reader = _ReadConnector(self._connector, ReplicaSet(
+                replicas, config.DB_REPLICA_MAX_LAG, config.DB_REPLICA_CHECK_INTERVAL, config.DB_REPLICA_POLICY))
+
+    def close(self):
+        super().close()
+        if self._reader is not self._connector:
+            self._reader.close()
+
+    def replica_stats(self) -> Dict[str, Dict[str, float]]:
+        if self._reader is self._connector:
+            return {}
+        return self._reader.replicas.stats()
+
+    def replicas_check(self):
+        if self._reader is not self._connector:
+            self._reader.check()
+
+    def link_id_take(self) -> int:
+        return self._link_ids.take()
+
+    def link_id_put_back(self, link_id: int):
+        self._link_ids.put_back(link_id)
+
+    def link_ids_reserve(self, count: int) -> List[int]:
+        query = """SELECT nextval('shortlinks.link_id_seq') FROM generate_series(1, %s)"""
+        cursor = self._connector.execute('link_ids_reserve', query, (count,))
+        rows = cursor.fetchall()
+        self._connector.commit()
+        return [row[0] for row in rows]
+
+    def link_create(self, link_id: int, short: Optional[str], origin: str) -> str:
+        """
+        Создает ссылку одним запросом: занимает свободную строку, а если таких нет,
+        вставляет новую с переданными id и short. Возвращает итоговый short.
+        Без short (id вне пространства схемы) только занимает свободную строку, а если таких нет - NoFreeShortlinks.
+
+        Свободная строка блокируется через SKIP LOCKED, так что параллельные создания
+        не могут занять одну и ту же, а просто берут следующую или вставляют новую.
+        """
+        query = """WITH claimed AS (
+                UPDATE shortlinks.link SET origin=%(origin)s, date_access=NOW(), status='active'
+                WHERE id = (
+                    SELECT id FROM shortlinks.link WHERE status='free' LIMIT 1 FOR UPDATE SKIP LOCKED
+                )
+                RETURNING short
+            ), inserted AS (
+                INSERT INTO shortlinks.link (id, short, origin, date_access, status)
+                SELECT %(id)s, %(short)s, %(origin)s, NOW(), 'active'
+                WHERE NOT EXISTS (SELECT 1 FROM claimed) AND %(short)s IS NOT NULL
+                RETURNING short
+            )
+            SELECT short FROM claimed UNION ALL SELECT short FROM inserted"""
+        cursor = self._connector.execute('link_create', query, {'id': link_id, 'short': short, 'origin': origin})
+        row = cursor.fetchone()
+        self._connector.commit()
+        if not row:
+            raise NoFreeShortlinks(f'Нет свободных ссылок')
+        return row[0]
+
+    def links_create(self, link_ids: List[int], shorts: List[str], origins: List[str]) -> List[str]:
+        """
+        То же, что и link_create, только для пачки ссылок одним запросом (и одной транзакцией).
+        Сначала занимаются свободные строки, сколько найдется, остальные ссылки вставляются
+        с переданными id и short. Возвращает итоговые short в порядке origins.
+        Ссылкам без short (id вне пространства схемы) свободные строки достаются первыми, а если на них
+        свободных строк не хватает, не создается ничего - NoFreeShortlinks.
+        """
+        query = """WITH input AS (
+                SELECT *, row_number() OVER (ORDER BY short IS NOT NULL, position) AS turn FROM unnest(
+                    %(ids)s::bigint[], %(shorts)s::varchar[], %(origins)s::text[]
+                ) WITH ORDINALITY AS input(id, short, origin, position)
+            ), free AS (
+                SELECT id, row_number() OVER () AS turn FROM (
+                    SELECT id FROM shortlinks.link WHERE status='free' LIMIT %(count)s FOR UPDATE SKIP LOCKED
+                ) locked
+            ), enough AS (
+                SELECT (SELECT count(*) FROM input WHERE short IS NULL) <= (SELECT count(*) FROM free) AS ok
+            ), claimed AS (
+                UPDATE shortlinks.link SET origin=input.origin, date_access=NOW(), status='active'
+                FROM free JOIN input USING (turn)
+                WHERE link.id = free.id AND (SELECT ok FROM enough)
+                RETURNING input.position, link.short
+            ), inserted AS (
+                INSERT INTO shortlinks.link (id, short, origin, date_access, status)
+                SELECT id, short, origin, NOW(), 'active' FROM input
+                WHERE turn > (SELECT count(*) FROM free) AND (SELECT ok FROM enough)
+                RETURNING id, short
+            )
+            SELECT position, short FROM claimed
+            UNION ALL
+            SELECT input.position, inserted.short FROM inserted JOIN input USING (id)
+            ORDER BY position"""
+        cursor = self._connector.execute('links_create', 
+            query, {'ids': link_ids, 'shorts': shorts, 'origins': origins, 'count': len(origins)})
+        rows = cursor.fetchall()
+        self._connector.commit()
+        if len(rows) < len(origins):
+            raise NoFreeShortlinks(f'Нет свободных ссылок')
+        return [row[1] for row in rows]
+
+    def links_reserve_free(self, count: int) -> List[Tuple[int, str, 'datetime']]:
+        """
+        Резервирует до count свободных ссылок за процессом (статус 'reserved'), возвращает (id, short, reserved_at).
+        Строки, которые в этот момент резервирует кто-то другой, пропускаются (SKIP LOCKED).
+        Время резервирования служит меткой резерва: если резерв просрочили и освободили,
+        а его занял кто-то другой, по старой метке ссылку уже не занять.
+        """
+        query = """UPDATE shortlinks.link SET status='reserved', date_access=NOW()
+            WHERE id IN (
+                SELECT id FROM shortlinks.link WHERE status='free' LIMIT %s FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, short, date_access"""
+        cursor = self._connector.execute('links_reserve_free', query, (count,))
+        rows = cursor.fetchall()
+        self._connector.commit()
+        return rows
+
+    def link_reuse_reserved(self, link_id: int, reserved_at: 'datetime', origin: str) -> bool:
+        """
+        Занимает зарезервированную ссылку. False, если резерв уже не наш.
+        """
+        query = """UPDATE shortlinks.link SET origin=%s, date_access=NOW(), status='active'
+            WHERE id=%s AND status='reserved' AND date_access=%s"""
+        cursor = self._connector.execute('link_reuse_reserved', query, (origin, link_id, reserved_at))
+        self._connector.commit()
+        return cursor.rowcount == 1
+
+    def links_release_reserved(self, reservations: List[Tuple[int, 'datetime']]):
+        """
+        Возвращает неизрасходованный резерв в свободные
+        """
+        query = """UPDATE shortlinks.link SET status='free'
+            FROM unnest(%s::bigint[], %s::timestamp[]) AS released(id, reserved_at)
+            WHERE link.id = released.id AND link.status='reserved' AND link.date_access = released.reserved_at"""
+        link_ids = [link_id for link_id, _ in reservations]
+        reserved_at = [reserved for _, reserved in reservations]
+        self._connector.execute('links_release_reserved', query, (link_ids, reserved_at))
+        self._connector.commit()
+
+    def links_release_stale_reserved(self, age: int):
+        """
+        Освобождает резерв, которым дольше age секунд никто не воспользовался (например, процесс упал)
+        """
+        query = """UPDATE shortlinks.link SET status='free'
+            WHERE status='reserved' AND date_access < NOW() - %s * INTERVAL '1 SECOND'"""
+        self._connector.execute('links_release_stale_reserved', query, (age,))
+        self._connector.commit()
 
     def link_insert(self) -> int:
         query = """INSERT INTO shortlinks.link (date_access, status) VALUES (NOW(), 'active') RETURNING id"""
-        cursor = self._connector.execute(query)
+        cursor = self._connector.execute('link_insert', query)
         row = cursor.fetchone()
         self._connector.commit()
         link_id = row[0]
@@ -140,24 +759,86 @@ class DBShortlinks(_DBEngine):
         query = """SELECT origin
             FROM shortlinks.link
             WHERE short=%s AND status IN ('active', 'inactive')"""
-        cursor = self._connector.execute(query, (short,))
+        cursor = self._reader.execute_prepared('link_select', query, (short,))
         row = cursor.fetchone()
+        if not row and self._reader is not self._connector:
+            cursor = self._connector.execute_prepared('link_select', query, (short,))
+            row = cursor.fetchone()
         if not row:
             raise ShortlinkNotFound(f"Ссылка '{short}' не найдена")
         origin = row[0]
         return origin
 
+    def links_select_origins(self, shorts: List[str]) -> Dict[str, str]:
+        """
+        То же, что и link_select, только для пачки ссылок одним запросом.
+        Ненайденных ссылок в результате просто нет.
+        """
+        query = """SELECT short, origin
+            FROM shortlinks.link
+            WHERE short = ANY(%s) AND status IN ('active', 'inactive')"""
+        cursor = self._reader.execute_prepared('links_select_origins', query, (shorts,))
+        origins = dict(cursor.fetchall())
+        if len(origins) < len(shorts) and self._reader is not self._connector:
+            missing = [short for short in shorts if short not in origins]
+            cursor = self._connector.execute_prepared('links_select_origins', query, (missing,))
+            origins.update(cursor.fetchall())
+        return origins
+
+    def links_select_recent(self, limit: int) -> List[Tuple[str, str]]:
+        """
+        (short, origin) limit читаемых ссылок, к которым обращались последними, от старых к новым
+        """
+        query = """SELECT short, origin FROM (
+                SELECT id, short, origin, date_access FROM shortlinks.link
+                WHERE status IN ('active', 'inactive')
+                ORDER BY date_access DESC LIMIT %s
+            ) recent
+            ORDER BY date_access, id"""
+        cursor = self._reader.execute('links_select_recent', query, (limit,))
+        return cursor.fetchall()
+
     def links_select(self, limit: int, offset: int):
         if limit > config.SELECT_HARD_LIMIT:
             limit = config.SELECT_HARD_LIMIT
-        query = """SELECT short, origin, date_access, status FROM shortlinks.link LIMIT %s OFFSET %s"""
-        cursor = self._connector.execute(query, (limit, offset))
+        query = """SELECT short, origin, date_access, status FROM shortlinks.link ORDER BY id LIMIT %s OFFSET %s"""
+        cursor = self._reader.execute('links_select', query, (limit, offset))
+        rows = cursor.fetchall()
+        return rows
+
+    def links_select_after(self, after_id: int, limit: int):
+        """
+        Страница ссылок по ключу: следующие limit строк с id больше after_id.
+        В отличие от OFFSET, глубокие страницы стоят столько же, сколько и первая.
+        """
+        if limit > config.SELECT_HARD_LIMIT:
+            limit = config.SELECT_HARD_LIMIT
+        query = """SELECT id, short, origin, date_access, status FROM shortlinks.link
+            WHERE id > %s ORDER BY id LIMIT %s"""
+        cursor = self._reader.execute('links_select_after', query, (after_id, limit))
         rows = cursor.fetchall()
         return rows
 
+    def links_stream(self, after_id: int = 0) -> Iterator[tuple]:
+        """
+        Все ссылки с id больше after_id, без ограничения количества, через серверный курсор
+        """
+        query = """SELECT id, short, origin, date_access, status FROM shortlinks.link
+            WHERE id > %s ORDER BY id"""
+        return self._reader.stream(query, (after_id,), config.DB_STREAM_BATCHSIZE)
+
+    def links_snapshot(self, after_id: int = 0) -> Iterator[tuple]:
+        """
+        То же, что и links_stream, только строки целиком, со счетчиком переходов: (id, short, origin, date_access, status, hits).
+        Для переноса снимка таблицы во встроенную БД и обратно.
+        """
+        query = """SELECT id, short, origin, date_access, status, hits FROM shortlinks.link
+            WHERE id > %s ORDER BY id"""
+        return self._reader.stream(query, (after_id,), config.DB_STREAM_BATCHSIZE)
+
     def link_select_free(self) -> str:
         query = """SELECT short FROM shortlinks.link WHERE status='free' LIMIT 1"""
-        cursor = self._connector.execute(query)
+        cursor = self._connector.execute('link_select_free', query)
         row = cursor.fetchone()
         if not row:
             raise NoFreeShortlinks(f'Нет свободных ссылок')
@@ -166,35 +847,132 @@ class DBShortlinks(_DBEngine):
 
     def link_reuse(self, short: str, origin: str):
         query = """UPDATE shortlinks.link SET origin=%s, date_access=NOW(), status='active' WHERE short=%s"""
-        self._connector.execute(query, (origin, short))
+        self._connector.execute('link_reuse', query, (origin, short))
         self._connector.commit()
 
     def link_actualize(self, short: str):
         query = """UPDATE shortlinks.link SET date_access=NOW(), status='active' WHERE short=%s"""
-        self._connector.execute(query, (short,))
+        self._connector.execute_prepared('link_actualize', query, (short,))
+        self._connector.commit()
+
+    def links_actualize(self, shorts: List[str]):
+        """
+        То же, что и link_actualize, только для пачки ссылок одним запросом.
+        Строки блокируются в порядке id, чтобы параллельные пачки не ловили взаимоблокировку.
+        """
+        query = """WITH pending AS (
+                SELECT id FROM shortlinks.link
+                WHERE short = ANY(%s) AND status IN ('active', 'inactive')
+                ORDER BY id FOR UPDATE
+            )
+            UPDATE shortlinks.link SET date_access=NOW(), status='active'
+            FROM pending WHERE link.id = pending.id"""
+        self._connector.execute_prepared('links_actualize', query, (shorts,))
+        self._connector.commit()
+
+    def links_hit(self, hits: List[Tuple[str, int, float]]):
+        """
+        Сливает накопленные в процессе переходы по ссылкам (short, количество, time.monotonic() последнего)
+        одним запросом: прибавляет количество к счетчику hits и обновляет время доступа, как links_actualize.
+        """
+        query = """WITH hit AS (
+                SELECT * FROM unnest(%s::varchar[], %s::bigint[], %s::float8[]) AS hit(short, hits, age)
+            ), pending AS (
+                SELECT link.id, hit.hits, LOCALTIMESTAMP - hit.age * INTERVAL '1 SECOND' AS accessed
+                FROM shortlinks.link JOIN hit USING (short)
+                WHERE link.status IN ('active', 'inactive')
+                ORDER BY link.id FOR UPDATE OF link
+            )
+            UPDATE shortlinks.link
+            SET hits=link.hits + pending.hits, date_access=GREATEST(link.date_access, pending.accessed), status='active'
+            FROM pending WHERE link.id = pending.id"""
+        self._connector.execute_prepared('links_hit', query, hits_columns(hits))
         self._connector.commit()
 
     def link_delete(self, short: str):
-        query = """UPDATE shortlinks.link SET status='free', origin=NULL WHERE short=%s"""
-        self._connector.execute(query, (short,))
+        query = """UPDATE shortlinks.link SET status='free', origin=NULL, hits=0 WHERE short=%s"""
+        self._connector.execute('link_delete', query, (short,))
         self._connector.commit()
 
     def link_set_expired_shortlinks(self, age: int):
-        query = """UPDATE shortlinks.link SET status='free', origin=NULL 
+        query = """UPDATE shortlinks.link SET status='free', origin=NULL, hits=0
             WHERE date_access < NOW() - INTERVAL '%s SECONDS' AND status = 'inactive'"""
-        self._connector.execute(query, (age, ))
+        self._connector.execute('link_set_expired_shortlinks', query, (age, ))
         self._connector.commit()
 
     def link_set_inactive_shortlinks(self, age: int):
         query = """UPDATE shortlinks.link SET status='inactive' 
             WHERE date_access < NOW() - INTERVAL '%s SECONDS' AND status = 'active'"""
-        self._connector.execute(query, (age,))
+        self._connector.execute('link_set_inactive_shortlinks', query, (age,))
+        self._connector.commit()
+
+    def links_deactivate_chunk(self, age: int, after: Optional[Tuple['datetime', int]], limit: int) -> List[tuple]:
+        """
+        То же, что и link_set_inactive_shortlinks, только для куска не больше limit строк
+        с ключом (date_access, id) больше after. Возвращает (date_access, id) обработанных строк.
+        Строки, занятые в этот момент другими запросами, пропускаются (SKIP LOCKED) до следующего прохода.
+        """
+        query = """WITH chunk AS (
+                SELECT id FROM shortlinks.link
+                WHERE status='active' AND date_access < NOW() - %s * INTERVAL '1 SECOND'
+                    AND (date_access, id) > (%s, %s)
+                ORDER BY date_access, id LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE shortlinks.link SET status='inactive'
+            WHERE id = ANY(ARRAY(SELECT id FROM chunk))
+            RETURNING date_access, id"""
+        after_date, after_id = after or CHUNK_KEY_MIN
+        cursor = self._connector.execute('links_deactivate_chunk', query, (age, after_date, after_id, limit))
+        rows = cursor.fetchall()
+        self._connector.commit()
+        return rows
+
+    def links_expire_chunk(self, age: int, after: Optional[Tuple['datetime', int]], limit: int) -> List[tuple]:
+        """
+        То же, что и link_set_expired_shortlinks, только кусками, как links_deactivate_chunk.
+        Возвращает (date_access, id, short) освобожденных строк.
+        """
+        query = """WITH chunk AS (
+                SELECT id FROM shortlinks.link
+                WHERE status='inactive' AND date_access < NOW() - %s * INTERVAL '1 SECOND'
+                    AND (date_access, id) > (%s, %s)
+                ORDER BY date_access, id LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE shortlinks.link SET status='free', origin=NULL, hits=0
+            WHERE id = ANY(ARRAY(SELECT id FROM chunk))
+            RETURNING date_access, id, short"""
+        after_date, after_id = after or CHUNK_KEY_MIN
+        cursor = self._connector.execute('links_expire_chunk', query, (age, after_date, after_id, limit))
+        rows = cursor.fetchall()
         self._connector.commit()
+        return rows
 
     def link_fill(self, link_id: int, short: str, origin: str):
         query = """UPDATE shortlinks.link SET short=%s, origin=%s, date_access=NOW(), status='active'
             WHERE id=%s"""
-        self._connector.execute(query, (short, origin, link_id))
+        self._connector.execute('link_fill', query, (short, origin, link_id))
+        self._connector.commit()
+
+    def links_upsert(self, rows: List[tuple]):
+        """
+        Записывает строки (id, short, origin, date_access, status, hits) как есть, поверх строк с теми же id,
+        и сдвигает последовательность за самый большой id. Нужно для заливки снимка встроенной БД обратно.
+        """
+        query = """WITH upserted AS (
+                INSERT INTO shortlinks.link (id, short, origin, date_access, status, hits)
+                SELECT * FROM unnest(
+                    %s::bigint[], %s::varchar[], %s::text[], %s::timestamp[], %s::shortlinks.shortlink_status[],
+                    %s::bigint[])
+                ON CONFLICT (id) DO UPDATE
+                SET short=EXCLUDED.short, origin=EXCLUDED.origin, date_access=EXCLUDED.date_access,
+                    status=EXCLUDED.status, hits=EXCLUDED.hits
+                RETURNING id
+            )
+            SELECT setval('shortlinks.link_id_seq', GREATEST(max(id), (SELECT last_value FROM shortlinks.link_id_seq)))
+            FROM upserted"""
+        self._connector.execute('links_upsert', query, tuple(list(column) for column in zip(*rows)))
         self._connector.commit()
 
 
@@ -205,6 +983,78 @@ class LazyDBShortlinks(DBShortlinks):
     _CONNECTOR_FACTORY = _LazyConnector
 
 
+class PooledDBShortlinks(DBShortlinks):
+    """
+    То же, что и DBShortlinks, только поверх пула подключений.
+    Один экземпляр можно держать на весь процесс.
+    """
+    _CONNECTOR_FACTORY = _PooledConnector
+
+    def pool_fill(self):
+        self._connector.pool.fill()
+
+
+class LeaderLock:
+    """
+    Лидерство среди процессов через сессионную advisory-блокировку Postgres по ключу key.
+
+    Блокировку держит сессия, поэтому у лидера свое подключение вне пула, которое живет, пока он лидер.
+    Если лидер упал или потерял подключение, блокировка снимается сама, и её подхватит следующий,
+    кто вызовет acquire. Подключение открывается при первом acquire.
+    """
+    _connection: Optional['psql_connection']
+
+    def __init__(self, dbname: str, user: str, password: str, host: str, key: int):
+        self._dbname = dbname
+        self._user = user
+        self._password = password
+        self._host = host
+        self._key = key
+        self._connection = None
+        self._held = False
+
+    @property
+    def held(self) -> bool:
+        return self._held
+
+    def acquire(self) -> bool:
+        """
+        Пробует стать лидером, не дожидаясь блокировки, а уже лидер проверяет, что подключение живо.
+        Возвращает, является ли процесс лидером.
+        """
+        try:
+            if self._connection is None:
+                self._connection = psycopg2.connect(
+                    dbname=self._dbname, user=self._user, password=self._password, host=self._host)
+                self._connection.autocommit = True
+            cursor = self._connection.cursor()
+            if self._held:
+                cursor.execute('SELECT 1')
+            else:
+                cursor.execute('SELECT pg_try_advisory_lock(%s)', (self._key,))
+                self._held = cursor.fetchone()[0]
+        except psycopg2.Error:
+            self._disconnect()
+        return self._held
+
+    def release(self):
+        if self._connection is not None and self._held:
+            try:
+                self._connection.cursor().execute('SELECT pg_advisory_unlock(%s)', (self._key,))
+            except psycopg2.Error:
+                pass
+        self._disconnect()
+
+    def _disconnect(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except psycopg2.Error:
+                pass
+        self._connection = None
+        self._held = False
+
+
 class Installer(DBShortlinks):
     """
     Проверяет и подготоавливает структуру БД
@@ -218,13 +1068,44 @@ class Installer(DBShortlinks):
         script_file = open('src/db_init.sql', 'r')
         script = script_file.read()
         script_file.close()
-        self._connector.execute(script)
+        self._connector.execute('_schema_create', script)
+
+    def _schema_upgrade(self):
+        """
+        Догоняет схему, созданную ранними версиями, до db_init.sql. На уже новой схеме ничего не меняет.
+        Перевод id в bigint (36-битной схеме коротких ссылок не хватает integer) перезаписывает таблицу,
+        поэтому делается, только если id еще integer. Новый столбец со значением по умолчанию и новое значение
+        перечисления добавляются без перезаписи таблицы, индекс для устаревания кусками строится один раз.
+        Подключение установщика в режиме autocommit, так что значение перечисления можно использовать сразу
+        (внутри транзакции - только после ее завершения).
+        """
+        if self._column_type('id') == 'integer':
+            self._connector.execute('_schema_upgrade', """ALTER TABLE shortlinks.link ALTER COLUMN id TYPE bigint""")
+        if self._sequence_type() == 'integer':
+            self._connector.execute('_schema_upgrade', """ALTER SEQUENCE shortlinks.link_id_seq AS bigint""")
+        self._connector.execute('_schema_upgrade', """ALTER TYPE shortlinks.shortlink_status ADD VALUE IF NOT EXISTS 'reserved'""")
+        query = """ALTER TABLE shortlinks.link ADD COLUMN IF NOT EXISTS hits bigint NOT NULL DEFAULT 0"""
+        self._connector.execute('_schema_upgrade', query)
+        query = """CREATE INDEX IF NOT EXISTS status_date_access_id ON shortlinks.link USING btree (status, date_access, id)"""
+        self._connector.execute('_schema_upgrade', query)
+
+    def _column_type(self, column: str) -> Optional[str]:
+        query = """SELECT data_type FROM information_schema.columns
+            WHERE table_schema='shortlinks' AND table_name='link' AND column_name=%s"""
+        row = self._connector.execute('_column_type', query, (column,)).fetchone()
+        return row[0] if row else None
+
+    def _sequence_type(self) -> Optional[str]:
+        query = """SELECT data_type FROM information_schema.sequences
+            WHERE sequence_schema='shortlinks' AND sequence_name='link_id_seq'"""
+        row = self._connector.execute('_sequence_type', query).fetchone()
+        return row[0] if row else None
 
     def _database_create(self):
         print('Создание БД shortlinks...')
         query = """CREATE DATABASE shortlinks"""
         try:
-            self._connector.execute(query)
+            self._connector.execute('_database_create', query)
         except DatabaseError as e:
             if e.pgcode != DUPLICATE_DATABASE:
                 raise
@@ -235,4 +1116,5 @@ class Installer(DBShortlinks):
         self._reconnect_to_db_shortlinks()
         if not self._table_exists():
             self._schema_create()
+        self._schema_upgrade()
 
@@ -0,0 +1,468 @@
+import asyncio
+import time
+import asyncpg
+from contextlib import asynccontextmanager
+
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple, TYPE_CHECKING
+if TYPE_CHECKING:
+    from datetime import datetime
+    from asyncpg import Record
+    from asyncpg.pool import Pool
+
+from config import config
+from src.db import ShortlinkNotFound, NoFreeShortlinks, PoolTimeout, CHUNK_KEY_MIN, hits_columns, observe_query
+from src.replicas import LAG_QUERY, Replica, ReplicaSet
+from src.reservoir import Reservoir
+
+
+class _AsyncConnector:
+    """
+    Асинхронный слой подключения к БД поверх пула asyncpg.
+
+    Пул создается лениво при первом запросе, т.к. ему нужен уже запущенный event loop.
+    Подключение берется из пула только на время выполнения запроса.
+    Имя запроса name, как и в синхронном слое, - имя метода слоя БД для метрик.
+    """
+    _pool: Optional['Pool']
+    _pool_creating: Optional['asyncio.Task']
+
+    def __init__(self, dbname: str, user: str, password: str, host: str):
+        self._dbname = dbname
+        self._user = user
+        self._password = password
+        self._host = host
+        self._pool = None
+        self._pool_creating = None
+
+    async def _get_pool(self) -> 'Pool':
+        if self._pool is None:
+            if self._pool_creating is None:
+                self._pool_creating = asyncio.ensure_future(asyncpg.create_pool(
+                    database=self._dbname,
+                    user=self._user,
+                    password=self._password,
+                    host=self._host,
+                    min_size=config.DB_POOL_MINSIZE,
+                    max_size=config.DB_POOL_MAXSIZE,
+                    max_inactive_connection_lifetime=config.DB_POOL_IDLE_TIMEOUT,
+                    timeout=config.DB_CONNECT_TIMEOUT,
+                ))
+            creating = self._pool_creating
+            try:
+                self._pool = await creating
+            except BaseException:
+                # Неудачное создание не запоминается, следующий запрос попробует подключиться заново
+                if self._pool_creating is creating:
+                    self._pool_creating = None
+                raise
+        return self._pool
+
+    @asynccontextmanager
+    async def _acquire(self):
+        pool = await self._get_pool()
+        try:
+            connection = await pool.acquire(timeout=config.DB_POOL_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise PoolTimeout(f'Нет свободных подключений к БД в течение {config.DB_POOL_TIMEOUT} сек.')
+        try:
+            yield connection
+        finally:
+            await pool.release(connection)
+
+    async def execute(self, name: str, query: str, *args) -> str:
+        started = time.perf_counter()
+        try:
+            async with self._acquire() as connection:
+                return await connection.execute(query, *args)
+        finally:
+            observe_query(name, started)
+
+    async def fetch(self, name: str, query: str, *args) -> List['Record']:
+        started = time.perf_counter()
+        try:
+            async with self._acquire() as connection:
+                return await connection.fetch(query, *args)
+        finally:
+            observe_query(name, started)
+
+    async def fetchrow(self, name: str, query: str, *args) -> Optional['Record']:
+        started = time.perf_counter()
+        try:
+            async with self._acquire() as connection:
+                return await connection.fetchrow(query, *args)
+        finally:
+            observe_query(name, started)
+
+    async def stream(self, query: str, *args, batch_size: int = 1000) -> AsyncIterator['Record']:
+        """
+        Выполняет запрос через серверный курсор, подтягивая строки пачками по batch_size.
+        Подключение занято, пока результат не дочитан.
+        """
+        async with self._acquire() as connection:
+            async with connection.transaction():
+                async for record in connection.cursor(query, *args, prefetch=batch_size):
+                    yield record
+
+    async def open(self):
+        await self._get_pool()
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+            self._pool_creating = None
+
+    def stats(self) -> Dict[str, float]:
+        if self._pool is None:
+            return {}
+        size = self._pool.get_size()
+        idle = self._pool.get_idle_size()
+        return {
+            'size': size,
+            'idle': idle,
+            'in_use': size - idle,
+        }
+
+
+_REPLICA_ERRORS = (
+    OSError, asyncio.TimeoutError, asyncpg.InterfaceError, asyncpg.PostgresConnectionError,
+    asyncpg.CannotConnectNowError, asyncpg.TransactionRollbackError, PoolTimeout,
+)
+
+
+class _AsyncReadConnector:
+    """
+    То же, что и _ReadConnector синхронного слоя, только поверх асинхронных коннекторов
+    """
+    def __init__(self, primary: _AsyncConnector, replicas: ReplicaSet):
+        self._primary = primary
+        self.replicas = replicas
+
+    async def fetch(self, name: str, query: str, *args) -> List['Record']:
+        return await self._read('fetch', name, query, *args)
+
+    async def fetchrow(self, name: str, query: str, *args) -> Optional['Record']:
+        return await self._read('fetchrow', name, query, *args)
+
+    async def stream(self, query: str, *args, batch_size: int = 1000) -> AsyncIterator['Record']:
+        replica = self._route()
+        connector = replica.connector if replica is not None else self._primary
+        async for record in connector.stream(query, *args, batch_size=batch_size):
+            yield record
+
+    async def close(self):
+        for replica in self.replicas.replicas:
+            await replica.connector.close()
+
+    async def _read(self, method: str, name: str, query: str, *args):
+        replica = self._route()
+        if replica is not None:
+            started = time.perf_counter()
+            try:
+                result = await getattr(replica.connector, method)(name, query, *args)
+            except _REPLICA_ERRORS:
+                self.replicas.failed(replica)
+            else:
+                self.replicas.observe(replica, time.perf_counter() - started)
+                return result
+        return await getattr(self._primary, method)(name, query, *args)
+
+    def _route(self) -> Optional[Replica]:
+        return self.replicas.pick()
+
+    async def check(self):
+        """
+        Проверяет отставание реплик, которым пора, все разом
+        """
+        await asyncio.gather(*(self.replica_lag(replica) for replica in self.replicas.due()))
+
+    async def replica_lag(self, replica: Replica):
+        started = time.perf_counter()
+        try:
+            row = await replica.connector.fetchrow('replica_lag', LAG_QUERY)
+        except _REPLICA_ERRORS:
+            self.replicas.failed(replica)
+            return
+        self.replicas.checked(replica, row[0], time.perf_counter() - started)
+
+
+class AsyncDBShortlinks:
+    """
+    Асинхронный слой работы с БД shortlinks, повторяет набор методов DBShortlinks.
+
+    Используется для обслуживания запросов, чтобы медленный запрос к БД
+    не останавливал весь event loop воркера. Установка БД (Installer) остается синхронной.
+    Реплики для чтения - так же, как в DBShortlinks.
+    """
+    _connector: _AsyncConnector
+    _link_ids: Reservoir
+    _reader: Any
+
+    def __init__(self, dbname: str, user: str, password: str, host: str, replica_hosts: Sequence[str] = ()):
+        self._connector = _AsyncConnector(dbname=dbname, user=user, password=password, host=host)
+        self._link_ids = Reservoir(self.link_ids_reserve, config.DB_ID_RESERVE_SIZE)
+        self._reader = self._connector
+        if replica_hosts:
+            replicas = [
+                Replica(replica_host, _AsyncConnector(dbname=dbname, user=user, password=password, host=replica_host))
+                for replica_host in replica_hosts
+            ]
+            self._reader = _AsyncReadConnector(self._connector, ReplicaSet(
+                replicas, config.DB_REPLICA_MAX_LAG, config.DB_REPLICA_CHECK_INTERVAL, config.DB_REPLICA_POLICY))
+
+    async def pool_fill(self):
+        await self._connector.open()
+
+    async def close(self):
+        await self._connector.close()
+        if self._reader is not self._connector:
+            await self._reader.close()
+
+    def connector_stats(self) -> Dict[str, float]:
+        return self._connector.stats()
+
+    def replica_stats(self) -> Dict[str, Dict[str, float]]:
+        if self._reader is self._connector:
+            return {}
+        return self._reader.replicas.stats()
+
+    async def replicas_check(self):
+        if self._reader is not self._connector:
+            await self._reader.check()
+
+    async def link_id_take(self) -> int:
+        return await self._link_ids.take_async()
+
+    def link_id_put_back(self, link_id: int):
+        self._link_ids.put_back(link_id)
+
+    async def link_ids_reserve(self, count: int) -> List[int]:
+        query = """SELECT nextval('shortlinks.link_id_seq') FROM generate_series(1, $1::int)"""
+        rows = await self._connector.fetch('link_ids_reserve', query, count)
+        return [row[0] for row in rows]
+
+    async def link_create(self, link_id: int, short: Optional[str], origin: str) -> str:
+        query = """WITH claimed AS (
+                UPDATE shortlinks.link SET origin=$3, date_access=NOW(), status='active'
+                WHERE id = (
+                    SELECT id FROM shortlinks.link WHERE status='free' LIMIT 1 FOR UPDATE SKIP LOCKED
+                )
+                RETURNING short
+            ), inserted AS (
+                INSERT INTO shortlinks.link (id, short, origin, date_access, status)
+                SELECT $1, $2::varchar, $3, NOW(), 'active'
+                WHERE NOT EXISTS (SELECT 1 FROM claimed) AND $2::varchar IS NOT NULL
+                RETURNING short
+            )
+            SELECT short FROM claimed UNION ALL SELECT short FROM inserted"""
+        row = await self._connector.fetchrow('link_create', query, link_id, short, origin)
+        if not row:
+            raise NoFreeShortlinks(f'Нет свободных ссылок')
+        return row[0]
+
+    async def links_create(self, link_ids: List[int], shorts: List[str], origins: List[str]) -> List[str]:
+        query = """WITH input AS (
+                SELECT *, row_number() OVER (ORDER BY short IS NOT NULL, position) AS turn FROM unnest(
+                    $1::bigint[], $2::varchar[], $3::text[]
+                ) WITH ORDINALITY AS input(id, short, origin, position)
+            ), free AS (
+                SELECT id, row_number() OVER () AS turn FROM (
+                    SELECT id FROM shortlinks.link WHERE status='free' LIMIT $4 FOR UPDATE SKIP LOCKED
+                ) locked
+            ), enough AS (
+                SELECT (SELECT count(*) FROM input WHERE short IS NULL) <= (SELECT count(*) FROM free) AS ok
+            ), claimed AS (
+                UPDATE shortlinks.link SET origin=input.origin, date_access=NOW(), status='active'
+                FROM free JOIN input USING (turn)
+                WHERE link.id = free.id AND (SELECT ok FROM enough)
+                RETURNING input.position, link.short
+            ), inserted AS (
+                INSERT INTO shortlinks.link (id, short, origin, date_access, status)
+                SELECT id, short, origin, NOW(), 'active' FROM input
+                WHERE turn > (SELECT count(*) FROM free) AND (SELECT ok FROM enough)
+                RETURNING id, short
+            )
+            SELECT position, short FROM claimed
+            UNION ALL
+            SELECT input.position, inserted.short FROM inserted JOIN input USING (id)
+            ORDER BY position"""
+        rows = await self._connector.fetch('links_create', query, link_ids, shorts, origins, len(origins))
+        if len(rows) < len(origins):
+            raise NoFreeShortlinks(f'Нет свободных ссылок')
+        return [row[1] for row in rows]
+
+    async def links_reserve_free(self, count: int) -> List[Tuple[int, str, 'datetime']]:
+        query = """UPDATE shortlinks.link SET status='reserved', date_access=NOW()
+            WHERE id IN (
+                SELECT id FROM shortlinks.link WHERE status='free' LIMIT $1 FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, short, date_access"""
+        rows = await self._connector.fetch('links_reserve_free', query, count)
+        return [tuple(row) for row in rows]
+
+    async def link_reuse_reserved(self, link_id: int, reserved_at: 'datetime', origin: str) -> bool:
+        query = """UPDATE shortlinks.link SET origin=$1, date_access=NOW(), status='active'
+            WHERE id=$2 AND status='reserved' AND date_access=$3"""
+        status = await self._connector.execute('link_reuse_reserved', query, origin, link_id, reserved_at)
+        return status == 'UPDATE 1'
+
+    async def links_release_reserved(self, reservations: List[Tuple[int, 'datetime']]):
+        query = """UPDATE shortlinks.link SET status='free'
+            FROM unnest($1::bigint[], $2::timestamp[]) AS released(id, reserved_at)
+            WHERE link.id = released.id AND link.status='reserved' AND link.date_access = released.reserved_at"""
+        link_ids = [link_id for link_id, _ in reservations]
+        reserved_at = [reserved for _, reserved in reservations]
+        await self._connector.execute('links_release_reserved', query, link_ids, reserved_at)
+
+    async def links_release_stale_reserved(self, age: int):
+        query = """UPDATE shortlinks.link SET status='free'
+            WHERE status='reserved' AND date_access < NOW() - $1 * INTERVAL '1 SECOND'"""
+        await self._connector.execute('links_release_stale_reserved', query, age)
+
+    async def link_insert(self) -> int:
+        query = """INSERT INTO shortlinks.link (date_access, status) VALUES (NOW(), 'active') RETURNING id"""
+        row = await self._connector.fetchrow('link_insert', query)
+        link_id = row[0]
+        return link_id
+
+    async def link_select(self, short: str) -> str:
+        query = """SELECT origin
+            FROM shortlinks.link
+            WHERE short=$1 AND status IN ('active', 'inactive')"""
+        row = await self._reader.fetchrow('link_select', query, short)
+        if not row and self._reader is not self._connector:
+            row = await self._connector.fetchrow('link_select', query, short)
+        if not row:
+            raise ShortlinkNotFound(f"Ссылка '{short}' не найдена")
+        origin = row[0]
+        return origin
+
+    async def links_select_origins(self, shorts: List[str]) -> Dict[str, str]:
+        query = """SELECT short, origin
+            FROM shortlinks.link
+            WHERE short = ANY($1::varchar[]) AND status IN ('active', 'inactive')"""
+        rows = await self._reader.fetch('links_select_origins', query, shorts)
+        origins = {row[0]: row[1] for row in rows}
+        if len(origins) < len(shorts) and self._reader is not self._connector:
+            rows = await self._connector.fetch('links_select_origins', query, [short for short in shorts if short not in origins])
+            origins.update((row[0], row[1]) for row in rows)
+        return origins
+
+    async def links_select_recent(self, limit: int) -> List[Tuple[str, str]]:
+        query = """SELECT short, origin FROM (
+                SELECT id, short, origin, date_access FROM shortlinks.link
+                WHERE status IN ('active', 'inactive')
+                ORDER BY date_access DESC LIMIT $1
+            ) recent
+            ORDER BY date_access, id"""
+        rows = await self._reader.fetch('links_select_recent', query, limit)
+        return [(row[0], row[1]) for row in rows]
+
+    async def links_select(self, limit: int, offset: int):
+        if limit > config.SELECT_HARD_LIMIT:
+            limit = config.SELECT_HARD_LIMIT
+        query = """SELECT short, origin, date_access, status FROM shortlinks.link ORDER BY id LIMIT $1 OFFSET $2"""
+        rows = await self._reader.fetch('links_select', query, limit, offset)
+        return rows
+
+    async def links_select_after(self, after_id: int, limit: int):
+        if limit > config.SELECT_HARD_LIMIT:
+            limit = config.SELECT_HARD_LIMIT
+        query = """SELECT id, short, origin, date_access, status FROM shortlinks.link
+            WHERE id > $1 ORDER BY id LIMIT $2"""
+        rows = await self._reader.fetch('links_select_after', query, after_id, limit)
+        return rows
+
+    def links_stream(self, after_id: int = 0) -> AsyncIterator['Record']:
+        query = """SELECT id, short, origin, date_access, status FROM shortlinks.link
+            WHERE id > $1 ORDER BY id"""
+        return self._reader.stream(query, after_id, batch_size=config.DB_STREAM_BATCHSIZE)
+
+    async def link_select_free(self) -> str:
+        query = """SELECT short FROM shortlinks.link WHERE status='free' LIMIT 1"""
+        row = await self._connector.fetchrow('link_select_free', query)
+        if not row:
+            raise NoFreeShortlinks(f'Нет свободных ссылок')
+        short = row[0]
+        return short
+
+    async def link_reuse(self, short: str, origin: str):
+        query = """UPDATE shortlinks.link SET origin=$1, date_access=NOW(), status='active' WHERE short=$2"""
+        await self._connector.execute('link_reuse', query, origin, short)
+
+    async def link_actualize(self, short: str):
+        query = """UPDATE shortlinks.link SET date_access=NOW(), status='active' WHERE short=$1"""
+        await self._connector.execute('link_actualize', query, short)
+
+    async def links_actualize(self, shorts: List[str]):
+        query = """WITH pending AS (
+                SELECT id FROM shortlinks.link
+                WHERE short = ANY($1::varchar[]) AND status IN ('active', 'inactive')
+                ORDER BY id FOR UPDATE
+            )
+            UPDATE shortlinks.link SET date_access=NOW(), status='active'
+            FROM pending WHERE link.id = pending.id"""
+        await self._connector.execute('links_actualize', query, shorts)
+
+    async def links_hit(self, hits: List[Tuple[str, int, float]]):
+        query = """WITH hit AS (
+                SELECT * FROM unnest($1::varchar[], $2::bigint[], $3::float8[]) AS hit(short, hits, age)
+            ), pending AS (
+                SELECT link.id, hit.hits, LOCALTIMESTAMP - hit.age * INTERVAL '1 SECOND' AS accessed
+                FROM shortlinks.link JOIN hit USING (short)
+                WHERE link.status IN ('active', 'inactive')
+                ORDER BY link.id FOR UPDATE OF link
+            )
+            UPDATE shortlinks.link
+            SET hits=link.hits + pending.hits, date_access=GREATEST(link.date_access, pending.accessed), status='active'
+            FROM pending WHERE link.id = pending.id"""
+        await self._connector.execute('links_hit', query, *hits_columns(hits))
+
+    async def link_delete(self, short: str):
+        query = """UPDATE shortlinks.link SET status='free', origin=NULL, hits=0 WHERE short=$1"""
+        await self._connector.execute('link_delete', query, short)
+
+    async def link_set_expired_shortlinks(self, age: int):
+        query = """UPDATE shortlinks.link SET status='free', origin=NULL, hits=0
+            WHERE date_access < NOW() - $1 * INTERVAL '1 SECOND' AND status = 'inactive'"""
+        await self._connector.execute('link_set_expired_shortlinks', query, age)
+
+    async def link_set_inactive_shortlinks(self, age: int):
+        query = """UPDATE shortlinks.link SET status='inactive'
+            WHERE date_access < NOW() - $1 * INTERVAL '1 SECOND' AND status = 'active'"""
+        await self._connector.execute('link_set_inactive_shortlinks', query, age)
+
+    async def links_deactivate_chunk(self, age: int, after: Optional[Tuple['datetime', int]], limit: int) -> List[tuple]:
+        query = """WITH chunk AS (
+                SELECT id FROM shortlinks.link
+                WHERE status='active' AND date_access < NOW() - $1 * INTERVAL '1 SECOND'
+                    AND (date_access, id) > ($2, $3)
+                ORDER BY date_access, id LIMIT $4
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE shortlinks.link SET status='inactive'
+            WHERE id = ANY(ARRAY(SELECT id FROM chunk))
+            RETURNING date_access, id"""
+        after_date, after_id = after or CHUNK_KEY_MIN
+        rows = await self._connector.fetch('links_deactivate_chunk', query, age, after_date, after_id, limit)
+        return [tuple(row) for row in rows]
+
+    async def links_expire_chunk(self, age: int, after: Optional[Tuple['datetime', int]], limit: int) -> List[tuple]:
+        query = """WITH chunk AS (
+                SELECT id FROM shortlinks.link
+                WHERE status='inactive' AND date_access < NOW() - $1 * INTERVAL '1 SECOND'
+                    AND (date_access, id) > ($2, $3)
+                ORDER BY date_access, id LIMIT $4
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE shortlinks.link SET status='free', origin=NULL, hits=0
+            WHERE id = ANY(ARRAY(SELECT id FROM chunk))
+            RETURNING date_access, id, short"""
+        after_date, after_id = after or CHUNK_KEY_MIN
+        rows = await self._connector.fetch('links_expire_chunk', query, age, after_date, after_id, limit)
+        return [tuple(row) for row in rows]
+
+    async def link_fill(self, link_id: int, short: str, origin: str):
+        query = """UPDATE shortlinks.link SET short=$1, origin=$2, date_access=NOW(), status='active'
+            WHERE id=$3"""
+        await self._connector.execute('link_fill', query, short, origin, link_id)
@@ -22,7 +22,8 @@ ALTER SCHEMA shortlinks OWNER TO postgres;
 CREATE TYPE shortlinks.shortlink_status AS ENUM (
     'active',
     'inactive',
-    'free'
+    'free',
+    'reserved'
 );
 ALTER TYPE shortlinks.shortlink_status OWNER TO postgres;
 
@@ -30,16 +31,17 @@ SET default_tablespace = '';
 SET default_table_access_method = heap;
 
 CREATE TABLE shortlinks.link (
-    id integer NOT NULL,
+    id bigint NOT NULL,
     short character varying(6),
     origin text,
     date_access timestamp without time zone NOT NULL,
-    status shortlinks.shortlink_status NOT NULL
+    status shortlinks.shortlink_status NOT NULL,
+    hits bigint DEFAULT 0 NOT NULL
 );
 ALTER TABLE shortlinks.link OWNER TO postgres;
 
 CREATE SEQUENCE shortlinks.link_id_seq
-    AS integer
+    AS bigint
     START WITH 1
     INCREMENT BY 1
     NO MINVALUE
@@ -57,4 +59,5 @@ CREATE INDEX date_access_status ON shortlinks.link USING btree (date_access, sta
 CREATE UNIQUE INDEX short ON shortlinks.link USING btree (short);
 CREATE INDEX short_status ON shortlinks.link USING btree (short, status);
 CREATE INDEX status ON shortlinks.link USING btree (status);
+CREATE INDEX status_date_access_id ON shortlinks.link USING btree (status, date_access, id);
 
@@ -0,0 +1,567 @@
+"""
+Встроенное хранилище ссылок в одном файле SQLite (журнал WAL), для узлов, которые в основном отдают редиректы.
+
+Повторяет набор методов DBShortlinks, включая переиспользование свободных ссылок, резерв и устаревание кусками,
+так что DataManager работает с ним так же, как с Postgres, только без похода по сети.
+Процессы одного узла делят файл: читают параллельно, пишет в каждый момент один (BEGIN IMMEDIATE),
+поэтому SKIP LOCKED не нужен - занятая строка другим процессом уже не видна как свободная.
+
+Снимок таблицы переносится из Postgres и обратно строками (id, short, origin, date_access, status, hits),
+в том виде, в каком их отдает links_snapshot (см. snapshot.py).
+"""
+
+import asyncio
+import fcntl
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from config import config
+from src.db import ShortlinkNotFound, NoFreeShortlinks, CHUNK_KEY_MIN, hits_columns, observe_query
+from src.reservoir import Reservoir
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS link (
+    id INTEGER PRIMARY KEY,
+    short TEXT,
+    origin TEXT,
+    date_access TEXT NOT NULL,
+    status TEXT NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE UNIQUE INDEX IF NOT EXISTS short ON link (short);
+CREATE INDEX IF NOT EXISTS status_date_access_id ON link (status, date_access, id);
+CREATE TABLE IF NOT EXISTS link_id_seq (value INTEGER NOT NULL);
+INSERT INTO link_id_seq (value) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM link_id_seq);
+"""
+
+IN_LIMIT = 500 # сколько значений передавать в один IN (...), у SQLite ограничено число параметров запроса
+
+
+def _timestamp(moment: datetime) -> str:
+    """
+    Время хранится текстом фиксированной ширины, так что сравнение строк совпадает со сравнением времени
+    """
+    return moment.isoformat(sep=' ', timespec='microseconds')
+
+
+def _now() -> str:
+    return _timestamp(datetime.now())
+
+
+def _before(age: float) -> str:
+    return _timestamp(datetime.now() - timedelta(seconds=age))
+
+
+class _SQLiteConnector:
+    """
+    Подключение к файлу БД, свое на каждый поток (подключение SQLite нельзя делить между потоками).
+    Одиночные запросы идут в режиме autocommit, несколько запросов подряд - в транзакции transaction().
+    Имя запроса name, как и в слое Postgres, - имя метода слоя БД для метрик.
+    """
+    def __init__(self, path: str):
+        self._path = path
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+    def execute(self, name: str, query: str, params: Iterable[Any] = ()) -> sqlite3.Cursor:
+        started = time.perf_counter()
+        try:
+            return self._connection().execute(query, tuple(params))
+        finally:
+            observe_query(name, started)
+
+    def executemany(self, name: str, query: str, params: Iterable[Iterable[Any]]) -> sqlite3.Cursor:
+        """
+        Вся пачка - одна транзакция, а не по транзакции на строку
+        """
+        started = time.perf_counter()
+        try:
+            connection = self._connection()
+            if connection.in_transaction:
+                return connection.executemany(query, params)
+            with self._locked() as connection:
+                return connection.executemany(query, params)
+        finally:
+            observe_query(name, started)
+
+    def executescript(self, script: str):
+        self._connection().executescript(script)
+
+    @contextmanager
+    def transaction(self, name: str) -> Iterator[sqlite3.Connection]:
+        """
+        Транзакция сразу берет блокировку записи, чтобы прочитанное в ней никто не поменял до конца.
+        Запросы внутри выполняются прямо на подключении, в метрики под именем name попадает вся транзакция,
+        с ожиданием блокировки.
+        """
+        started = time.perf_counter()
+        try:
+            with self._locked() as connection:
+                yield connection
+        finally:
+            observe_query(name, started)
+
+    @contextmanager
+    def _locked(self) -> Iterator[sqlite3.Connection]:
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+        self._local = threading.local()
+
+    def stats(self) -> Dict[str, float]:
+        return {'connections': len(self._connections)}
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self._path, timeout=config.DB_POOL_TIMEOUT, isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+
+class SQLiteDBShortlinks:
+    """
+    Слой работы с БД shortlinks в файле SQLite, повторяет набор методов DBShortlinks.
+    Id новых ссылок, как и там, резервируются пачками в таблице-последовательности и раздаются из запаса процесса.
+    """
+    _connector: _SQLiteConnector
+    _link_ids: Reservoir
+
+    def __init__(self, path: str):
+        self._connector = _SQLiteConnector(path)
+        self._link_ids = Reservoir(self.link_ids_reserve, config.DB_ID_RESERVE_SIZE)
+
+    def init_database(self):
+        self._connector.executescript(SCHEMA)
+        columns = [row[1] for row in self._connector.execute('init_database', 'PRAGMA table_info(link)')]
+        if 'hits' not in columns:
+            self._connector.execute('init_database', 'ALTER TABLE link ADD COLUMN hits INTEGER NOT NULL DEFAULT 0')
+
+    def close(self):
+        self._connector.close()
+
+    def connector_stats(self) -> Dict[str, float]:
+        return self._connector.stats()
+
+    def replica_stats(self) -> Dict[str, Dict[str, float]]:
+        return {}
+
+    def replicas_check(self):
+        pass
+
+    def link_id_take(self) -> int:
+        return self._link_ids.take()
+
+    def link_id_put_back(self, link_id: int):
+        self._link_ids.put_back(link_id)
+
+    def link_ids_reserve(self, count: int) -> List[int]:
+        with self._connector.transaction('link_ids_reserve') as connection:
+            connection.execute('UPDATE link_id_seq SET value = value + ?', (count,))
+            last = connection.execute('SELECT value FROM link_id_seq').fetchone()[0]
+        return list(range(last - count + 1, last + 1))
+
+    def link_create(self, link_id: int, short: Optional[str], origin: str) -> str:
+        """
+        Занимает свободную строку, а если таких нет, вставляет новую с переданными id и short. Возвращает итоговый short.
+        Без short (id вне пространства схемы) только занимает свободную строку, а если таких нет - NoFreeShortlinks.
+        """
+        if short is not None:
+            return self.links_create([link_id], [short], [origin])[0]
+        with self._connector.transaction('link_create') as connection:
+            row = connection.execute("SELECT id, short FROM link WHERE status='free' LIMIT 1").fetchone()
+            if row is None:
+                raise NoFreeShortlinks(f'Нет свободных ссылок')
+            connection.execute("UPDATE link SET origin=?, date_access=?, status='active' WHERE id=?", (origin, _now(), row[0]))
+        return row[1]
+
+    def links_create(self, link_ids: List[int], shorts: List[str], origins: List[str]) -> List[str]:
+        """
+        Ссылкам без short свободные строки достаются первыми, а если на них не хватает, не создается ничего
+        """
+        now = _now()
+        turns = sorted(range(len(origins)), key=lambda position: shorts[position] is not None)
+        with self._connector.transaction('links_create') as connection:
+            free = connection.execute(
+                "SELECT id, short FROM link WHERE status='free' LIMIT ?", (len(origins),)).fetchall()
+            if shorts.count(None) > len(free):
+                raise NoFreeShortlinks(f'Нет свободных ссылок')
+            created = list(shorts[:len(origins)])
+            for (free_id, short), position in zip(free, turns):
+                created[position] = short
+            connection.executemany(
+                "UPDATE link SET origin=?, date_access=?, status='active' WHERE id=?",
+                [(origins[position], now, free_id) for (free_id, _), position in zip(free, turns)])
+            connection.executemany(
+                "INSERT INTO link (id, short, origin, date_access, status) VALUES (?, ?, ?, ?, 'active')",
+                [(link_ids[position], shorts[position], origins[position], now) for position in turns[len(free):]])
+        return created
+
+    def links_reserve_free(self, count: int) -> List[Tuple[int, str, datetime]]:
+        """
+        Резервирует до count свободных ссылок за процессом, возвращает (id, short, reserved_at)
+        """
+        reserved_at = datetime.now()
+        with self._connector.transaction('links_reserve_free') as connection:
+            rows = connection.execute("SELECT id, short FROM link WHERE status='free' LIMIT ?", (count,)).fetchall()
+            connection.executemany(
+                "UPDATE link SET status='reserved', date_access=? WHERE id=?",
+                [(_timestamp(reserved_at), link_id) for link_id, _ in rows])
+        return [(link_id, short, reserved_at) for link_id, short in rows]
+
+    def link_reuse_reserved(self, link_id: int, reserved_at: datetime, origin: str) -> bool:
+        cursor = self._connector.execute('link_reuse_reserved', 
+            "UPDATE link SET origin=?, date_access=?, status='active' WHERE id=? AND status='reserved' AND date_access=?",
+            (origin, _now(), link_id, _timestamp(reserved_at)))
+        return cursor.rowcount == 1
+
+    def links_release_reserved(self, reservations: List[Tuple[int, datetime]]):
+        self._connector.executemany('links_release_reserved', 
+            "UPDATE link SET status='free' WHERE id=? AND status='reserved' AND date_access=?",
+            [(link_id, _timestamp(reserved_at)) for link_id, reserved_at in reservations])
+
+    def links_release_stale_reserved(self, age: int):
+        self._connector.execute('links_release_stale_reserved', 
+            "UPDATE link SET status='free' WHERE status='reserved' AND date_access < ?", (_before(age),))
+
+    def link_insert(self) -> int:
+        link_id = self.link_ids_reserve(1)[0]
+        self._connector.execute('link_insert', "INSERT INTO link (id, date_access, status) VALUES (?, ?, 'active')", (link_id, _now()))
+        return link_id
+
+    def link_select(self, short: str) -> str:
+        row = self._connector.execute('link_select', 
+            "SELECT origin FROM link WHERE short=? AND status IN ('active', 'inactive')", (short,)).fetchone()
+        if not row:
+            raise ShortlinkNotFound(f"Ссылка '{short}' не найдена")
+        return row[0]
+
+    def links_select_origins(self, shorts: List[str]) -> Dict[str, str]:
+        origins = {}
+        for start in range(0, len(shorts), IN_LIMIT):
+            batch = shorts[start:start + IN_LIMIT]
+            query = f"""SELECT short, origin FROM link
+                WHERE short IN ({', '.join('?' * len(batch))}) AND status IN ('active', 'inactive')"""
+            origins.update(self._connector.execute('links_select_origins', query, batch).fetchall())
+        return origins
+
+    def links_select_recent(self, limit: int) -> List[Tuple[str, str]]:
+        rows = self._connector.execute('links_select_recent', 
+            """SELECT short, origin FROM (
+                SELECT id, short, origin, date_access FROM link
+                WHERE status IN ('active', 'inactive')
+                ORDER BY date_access DESC LIMIT ?
+            )
+            ORDER BY date_access, id""", (limit,))
+        return rows.fetchall()
+
+    def links_select(self, limit: int, offset: int):
+        limit = min(limit, config.SELECT_HARD_LIMIT)
+        rows = self._connector.execute('links_select', 
+            'SELECT short, origin, date_access, status FROM link ORDER BY id LIMIT ? OFFSET ?', (limit, offset))
+        return [(short, origin, datetime.fromisoformat(date_access), status) for short, origin, date_access, status in rows]
+
+    def links_select_after(self, after_id: int, limit: int):
+        limit = min(limit, config.SELECT_HARD_LIMIT)
+        rows = self._connector.execute('links_select_after', 
+            'SELECT id, short, origin, date_access, status FROM link WHERE id > ? ORDER BY id LIMIT ?', (after_id, limit))
+        return [_link_row(row) for row in rows]
+
+    def links_stream(self, after_id: int = 0) -> Iterator[tuple]:
+        cursor = self._connector.execute('links_stream', 
+            'SELECT id, short, origin, date_access, status FROM link WHERE id > ? ORDER BY id', (after_id,))
+        while True:
+            rows = cursor.fetchmany(config.DB_STREAM_BATCHSIZE)
+            if not rows:
+                return
+            for row in rows:
+                yield _link_row(row)
+
+    def links_snapshot(self, after_id: int = 0) -> Iterator[tuple]:
+        cursor = self._connector.execute('links_snapshot', 
+            'SELECT id, short, origin, date_access, status, hits FROM link WHERE id > ? ORDER BY id', (after_id,))
+        while True:
+            rows = cursor.fetchmany(config.DB_STREAM_BATCHSIZE)
+            if not rows:
+                return
+            for row in rows:
+                yield (*_link_row(row[:5]), row[5])
+
+    def link_select_free(self) -> str:
+        row = self._connector.execute('link_select_free', "SELECT short FROM link WHERE status='free' LIMIT 1").fetchone()
+        if not row:
+            raise NoFreeShortlinks(f'Нет свободных ссылок')
+        return row[0]
+
+    def link_reuse(self, short: str, origin: str):
+        self._connector.execute('link_reuse', 
+            "UPDATE link SET origin=?, date_access=?, status='active' WHERE short=?", (origin, _now(), short))
+
+    def link_actualize(self, short: str):
+        self._connector.execute('link_actualize', "UPDATE link SET date_access=?, status='active' WHERE short=?", (_now(), short))
+
+    def links_actualize(self, shorts: List[str]):
+        now = _now()
+        self._connector.executemany('links_actualize', 
+            "UPDATE link SET date_access=?, status='active' WHERE short=? AND status IN ('active', 'inactive')",
+            [(now, short) for short in shorts])
+
+    def links_hit(self, hits: List[Tuple[str, int, float]]):
+        shorts, counts, ages = hits_columns(hits)
+        self._connector.executemany('links_hit', 
+            """UPDATE link SET hits=hits + ?, date_access=max(date_access, ?), status='active'
+            WHERE short=? AND status IN ('active', 'inactive')""",
+            [(count, _before(age), short) for short, count, age in zip(shorts, counts, ages)])
+
+    def link_delete(self, short: str):
+        self._connector.execute('link_delete', "UPDATE link SET status='free', origin=NULL, hits=0 WHERE short=?", (short,))
+
+    def link_set_expired_shortlinks(self, age: int):
+        self._connector.execute('link_set_expired_shortlinks', 
+            "UPDATE link SET status='free', origin=NULL, hits=0 WHERE date_access < ? AND status='inactive'", (_before(age),))
+
+    def link_set_inactive_shortlinks(self, age: int):
+        self._connector.execute('link_set_inactive_shortlinks', 
+            "UPDATE link SET status='inactive' WHERE date_access < ? AND status='active'", (_before(age),))
+
+    def links_deactivate_chunk(self, age: int, after: Optional[Tuple[datetime, int]], limit: int) -> List[tuple]:
+        """
+        Как и в DBShortlinks: не больше limit строк с ключом (date_access, id) больше after,
+        возвращает (date_access, id) обработанных строк
+        """
+        with self._connector.transaction('links_deactivate_chunk') as connection:
+            rows = self._chunk(connection, 'active', age, after, limit)
+            connection.executemany("UPDATE link SET status='inactive' WHERE id=?", [(link_id,) for _, link_id, _ in rows])
+        return [(date_access, link_id) for date_access, link_id, _ in rows]
+
+    def links_expire_chunk(self, age: int, after: Optional[Tuple[datetime, int]], limit: int) -> List[tuple]:
+        """
+        Возвращает (date_access, id, short) освобожденных строк
+        """
+        with self._connector.transaction('links_expire_chunk') as connection:
+            rows = self._chunk(connection, 'inactive', age, after, limit)
+            connection.executemany(
+                "UPDATE link SET status='free', origin=NULL, hits=0 WHERE id=?", [(link_id,) for _, link_id, _ in rows])
+        return rows
+
+    def link_fill(self, link_id: int, short: str, origin: str):
+        self._connector.execute('link_fill', 
+            "UPDATE link SET short=?, origin=?, date_access=?, status='active' WHERE id=?", (short, origin, _now(), link_id))
+
+    def snapshot_import(self, rows: Iterable[tuple]) -> int:
+        """
+        Заменяет всю таблицу строками (id, short, origin, date_access, status, hits), например, из links_snapshot Postgres.
+        Последовательность id сдвигается за самый большой из них. Возвращает количество строк.
+        """
+        count = 0
+        batch = []
+        with self._connector.transaction('snapshot_import') as connection:
+            connection.execute('DELETE FROM link')
+            for link_id, short, origin, date_access, status, hits in rows:
+                batch.append((link_id, short, origin, _timestamp(date_access), status, hits))
+                if len(batch) >= config.DB_STREAM_BATCHSIZE:
+                    count += self._snapshot_insert(connection, batch)
+                    batch = []
+            count += self._snapshot_insert(connection, batch)
+            connection.execute('UPDATE link_id_seq SET value = max(value, (SELECT coalesce(max(id), 0) FROM link))')
+        return count
+
+    def _snapshot_insert(self, connection: sqlite3.Connection, batch: List[tuple]) -> int:
+        connection.executemany(
+            'INSERT INTO link (id, short, origin, date_access, status, hits) VALUES (?, ?, ?, ?, ?, ?)', batch)
+        return len(batch)
+
+    def _chunk(self, connection: sqlite3.Connection, status: str, age: int,
+               after: Optional[Tuple[datetime, int]], limit: int) -> List[Tuple[datetime, int, str]]:
+        after_date, after_id = after or CHUNK_KEY_MIN
+        rows = connection.execute(
+            """SELECT date_access, id, short FROM link
+            WHERE status=? AND date_access < ? AND (date_access, id) > (?, ?)
+            ORDER BY date_access, id LIMIT ?""",
+            (status, _before(age), _timestamp(after_date), after_id, limit))
+        return [(datetime.fromisoformat(date_access), link_id, short) for date_access, link_id, short in rows]
+
+
+def _link_row(row: tuple) -> tuple:
+    link_id, short, origin, date_access, status = row
+    return link_id, short, origin, datetime.fromisoformat(date_access), status
+
+
+class AsyncSQLiteDBShortlinks:
+    """
+    Асинхронный интерфейс AsyncDBShortlinks поверх SQLiteDBShortlinks.
+
+    Поиск ссылок идет прямо в event loop: это чтение по индексу из локального файла за микросекунды,
+    дольше передачи задачи в поток, а читателей WAL писатели не блокируют.
+    Остальное уходит в свой пул потоков: запись ждет блокировку, пока пишет другой процесс узла
+    (например, устаревание у лидера), до DB_POOL_TIMEOUT, и это ожидание не должно останавливать event loop.
+    Страницы и выгрузка тоже в пуле, т.к. читают до тысяч строк.
+    """
+    def __init__(self, db: SQLiteDBShortlinks):
+        self._db = db
+        self._executor = ThreadPoolExecutor(max_workers=config.DB_POOL_MAXSIZE, thread_name_prefix='sqlite')
+
+    async def _run(self, func: Callable[..., Any], *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def pool_fill(self):
+        pass
+
+    async def close(self):
+        self._executor.shutdown(wait=True)
+        self._db.close()
+
+    def connector_stats(self) -> Dict[str, float]:
+        return self._db.connector_stats()
+
+    def replica_stats(self) -> Dict[str, Dict[str, float]]:
+        return {}
+
+    async def replicas_check(self):
+        pass
+
+    async def link_id_take(self) -> int:
+        return await self._run(self._db.link_id_take)
+
+    def link_id_put_back(self, link_id: int):
+        self._db.link_id_put_back(link_id)
+
+    async def link_ids_reserve(self, count: int) -> List[int]:
+        return await self._run(self._db.link_ids_reserve, count)
+
+    async def link_create(self, link_id: int, short: Optional[str], origin: str) -> str:
+        return await self._run(self._db.link_create, link_id, short, origin)
+
+    async def links_create(self, link_ids: List[int], shorts: List[str], origins: List[str]) -> List[str]:
+        return await self._run(self._db.links_create, link_ids, shorts, origins)
+
+    async def links_reserve_free(self, count: int) -> List[Tuple[int, str, datetime]]:
+        return await self._run(self._db.links_reserve_free, count)
+
+    async def link_reuse_reserved(self, link_id: int, reserved_at: datetime, origin: str) -> bool:
+        return await self._run(self._db.link_reuse_reserved, link_id, reserved_at, origin)
+
+    async def links_release_reserved(self, reservations: List[Tuple[int, datetime]]):
+        await self._run(self._db.links_release_reserved, reservations)
+
+    async def links_release_stale_reserved(self, age: int):
+        await self._run(self._db.links_release_stale_reserved, age)
+
+    async def link_insert(self) -> int:
+        return await self._run(self._db.link_insert)
+
+    async def link_select(self, short: str) -> str:
+        return self._db.link_select(short)
+
+    async def links_select_origins(self, shorts: List[str]) -> Dict[str, str]:
+        return self._db.links_select_origins(shorts)
+
+    async def links_select_recent(self, limit: int) -> List[Tuple[str, str]]:
+        return await self._run(self._db.links_select_recent, limit)
+
+    async def links_select(self, limit: int, offset: int):
+        return await self._run(self._db.links_select, limit, offset)
+
+    async def links_select_after(self, after_id: int, limit: int):
+        return await self._run(self._db.links_select_after, after_id, limit)
+
+    async def links_stream(self, after_id: int = 0) -> AsyncIterator[tuple]:
+        """
+        Страницами по SELECT_HARD_LIMIT строк по ключу id, каждая страница - отдельный запрос в пуле потоков.
+        В отличие от серверного курсора Postgres, выгрузка не снимок: строки, измененные по ходу, видны как есть.
+        """
+        while True:
+            rows = await self._run(self._db.links_select_after, after_id, config.SELECT_HARD_LIMIT)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+            after_id = rows[-1][0]
+
+    async def link_select_free(self) -> str:
+        return self._db.link_select_free()
+
+    async def link_reuse(self, short: str, origin: str):
+        await self._run(self._db.link_reuse, short, origin)
+
+    async def link_actualize(self, short: str):
+        await self._run(self._db.link_actualize, short)
+
+    async def links_actualize(self, shorts: List[str]):
+        await self._run(self._db.links_actualize, shorts)
+
+    async def links_hit(self, hits: List[Tuple[str, int, float]]):
+        await self._run(self._db.links_hit, hits)
+
+    async def link_delete(self, short: str):
+        await self._run(self._db.link_delete, short)
+
+    async def link_set_expired_shortlinks(self, age: int):
+        await self._run(self._db.link_set_expired_shortlinks, age)
+
+    async def link_set_inactive_shortlinks(self, age: int):
+        await self._run(self._db.link_set_inactive_shortlinks, age)
+
+    async def links_deactivate_chunk(self, age: int, after: Optional[Tuple[datetime, int]], limit: int) -> List[tuple]:
+        return await self._run(self._db.links_deactivate_chunk, age, after, limit)
+
+    async def links_expire_chunk(self, age: int, after: Optional[Tuple[datetime, int]], limit: int) -> List[tuple]:
+        return await self._run(self._db.links_expire_chunk, age, after, limit)
+
+    async def link_fill(self, link_id: int, short: str, origin: str):
+        await self._run(self._db.link_fill, link_id, short, origin)
+
+
+class FileLeaderLock:
+    """
+    То же, что и LeaderLock, только для процессов одного узла: лидер держит flock на файле path.
+    Блокировка снимается сама, когда процесс лидера завершается.
+    """
+    def __init__(self, path: str):
+        self._path = path
+        self._fd: Optional[int] = None
+
+    @property
+    def held(self) -> bool:
+        return self._fd is not None
+
+    def acquire(self) -> bool:
+        if self._fd is not None:
+            return True
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,102 @@
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+ChunkKey = Tuple[Any, ...]
+
+
+class ExpiryJob:
+    """
+    Обслуживание таблицы ограниченными кусками вместо одного UPDATE на всю таблицу.
+
+    chunk(after, limit) обрабатывает не больше limit строк с ключом больше after (keyset, в порядке ключа)
+    и возвращает (сколько строк обработано, ключ последней из них). Каждый кусок - отдельная короткая транзакция,
+    так что блокировки строк держатся недолго и не мешают обновлению времени доступа.
+
+    За один запуск (run) куски идут, пока не кончится time_budget секунд. Позиция запоминается,
+    и следующий запуск продолжает с неё. Кусок меньше limit означает, что проход по таблице закончен,
+    и следующий начнется сначала.
+    """
+    def __init__(self, chunk_size: int, time_budget: float):
+        self._chunk_size = chunk_size
+        self._time_budget = time_budget
+        self._cursor: Optional[ChunkKey] = None
+        self._chunks = 0
+        self._rows = 0
+        self._passes = 0
+        self._errors = 0
+        self._chunk_rows_last = 0
+        self._chunk_time_last = 0.0
+        self._chunk_time_max = 0.0
+        self._run_time_last = 0.0
+
+    def run(self, chunk: Callable[[Optional[ChunkKey], int], Tuple[int, Optional[ChunkKey]]]) -> int:
+        """
+        Возвращает, сколько строк обработано за запуск
+        """
+        started = time.monotonic()
+        processed = 0
+        try:
+            while True:
+                chunk_started = time.monotonic()
+                try:
+                    rows, last_key = chunk(self._cursor, self._chunk_size)
+                except Exception:
+                    self._errors += 1
+                    raise
+                processed += rows
+                if self._advance(rows, last_key, chunk_started) or time.monotonic() - started >= self._time_budget:
+                    break
+        finally:
+            self._run_time_last = time.monotonic() - started
+        return processed
+
+    async def run_async(self, chunk: Callable[[Optional[ChunkKey], int], Awaitable[Tuple[int, Optional[ChunkKey]]]]) -> int:
+        """
+        То же, что и run, только для асинхронной БД
+        """
+        started = time.monotonic()
+        processed = 0
+        try:
+            while True:
+                chunk_started = time.monotonic()
+                try:
+                    rows, last_key = await chunk(self._cursor, self._chunk_size)
+                except Exception:
+                    self._errors += 1
+                    raise
+                processed += rows
+                if self._advance(rows, last_key, chunk_started) or time.monotonic() - started >= self._time_budget:
+                    break
+        finally:
+            self._run_time_last = time.monotonic() - started
+        return processed
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'chunks': self._chunks,
+            'rows': self._rows,
+            'passes': self._passes,
+            'errors': self._errors,
+            'in_pass': self._cursor is not None,
+            'chunk_rows_last': self._chunk_rows_last,
+            'chunk_time_last': self._chunk_time_last,
+            'chunk_time_max': self._chunk_time_max,
+            'run_time_last': self._run_time_last,
+        }
+
+    def _advance(self, rows: int, last_key: Optional[ChunkKey], chunk_started: float) -> bool:
+        """
+        Учитывает кусок и сдвигает позицию. Возвращает True, если проход закончен.
+        """
+        elapsed = time.monotonic() - chunk_started
+        self._chunks += 1
+        self._rows += rows
+        self._chunk_rows_last = rows
+        self._chunk_time_last = elapsed
+        self._chunk_time_max = max(self._chunk_time_max, elapsed)
+        if rows < self._chunk_size or last_key is None:
+            self._cursor = None
+            self._passes += 1
+            return True
+        self._cursor = last_key
+        return False
@@ -0,0 +1,79 @@
+"""
+Выгрузка ссылок в текстовые форматы для потоковой отдачи (NDJSON и CSV).
+
+Строки кодируются кусками по CHUNK_ROWS, чтобы не отдавать клиенту по строчке на каждую запись,
+но и не держать в памяти больше одного куска.
+"""
+
+import csv
+import io
+import json
+from typing import Any, AsyncIterable, AsyncIterator, Iterable, Iterator, List, Sequence
+
+FIELDS = ('id', 'short', 'origin', 'date_access', 'status')
+CHUNK_ROWS = 1000
+
+MEDIA_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def encode_ndjson(rows: List[Sequence[Any]]) -> str:
+    lines = []
+    for row in rows:
+        record = dict(zip(FIELDS, row))
+        record['date_access'] = record['date_access'].isoformat()
+        lines.append(json.dumps(record, ensure_ascii=False))
+    lines.append('')
+    return '\n'.join(lines)
+
+
+def encode_csv(rows: List[Sequence[Any]]) -> str:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([value.isoformat() if field == 'date_access' else value for field, value in zip(FIELDS, row)])
+    return buffer.getvalue()
+
+
+def _encoder(fmt: str):
+    if fmt == 'ndjson':
+        return encode_ndjson
+    if fmt == 'csv':
+        return encode_csv
+    raise ValueError(f'Неизвестный формат выгрузки: {fmt}')
+
+
+def _header(fmt: str) -> str:
+    return ','.join(FIELDS) + '\r\n' if fmt == 'csv' else ''
+
+
+def export_chunks(rows: Iterable[Sequence[Any]], fmt: str) -> Iterator[str]:
+    encode = _encoder(fmt)
+    header = _header(fmt)
+    if header:
+        yield header
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= CHUNK_ROWS:
+            yield encode(chunk)
+            chunk = []
+    if chunk:
+        yield encode(chunk)
+
+
+async def export_chunks_async(rows: AsyncIterable[Sequence[Any]], fmt: str) -> AsyncIterator[str]:
+    encode = _encoder(fmt)
+    header = _header(fmt)
+    if header:
+        yield header
+    chunk = []
+    async for row in rows:
+        chunk.append(row)
+        if len(chunk) >= CHUNK_ROWS:
+            yield encode(chunk)
+            chunk = []
+    if chunk:
+        yield encode(chunk)
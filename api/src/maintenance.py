@@ -0,0 +1,45 @@
+from typing import Dict, Optional
+
+from src.data_manager import DataManager
+from src.db import LeaderLock
+
+
+class Maintenance:
+    """
+    Периодическое обслуживание БД: деактивация и освобождение устаревших ссылок.
+
+    На всю БД обслуживанием занимается один процесс - лидер, который держит advisory-блокировку (LeaderLock).
+    Остальные на каждом тике только пробуют стать лидером, так что место упавшего лидера займет следующий.
+    Работает синхронно, поэтому из event loop вызывается в пуле потоков, а не в самом loop.
+    """
+    def __init__(self, data_manager: DataManager, leader: LeaderLock):
+        self._data_manager = data_manager
+        self._leader = leader
+        self._ticks = 0
+        self._ticks_as_leader = 0
+
+    def tick(self) -> Optional[Dict[str, int]]:
+        """
+        Возвращает, сколько ссылок деактивировано и освобождено, или None, если процесс не лидер
+        """
+        self._ticks += 1
+        if not self._leader.acquire():
+            return None
+        self._ticks_as_leader += 1
+        deactivated = self._data_manager.shortlink_deactivate_all_expired()
+        freed = self._data_manager.shortlink_delete_all_expired()
+        return {'deactivated': deactivated, 'freed': freed}
+
+    def close(self):
+        """
+        Отпускает лидерство, чтобы следующий процесс подхватил его сразу, а не после обрыва подключения
+        """
+        self._leader.release()
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            'leader': self._leader.held,
+            'ticks': self._ticks,
+            'ticks_as_leader': self._ticks_as_leader,
+            **self._data_manager.expiry_stats(),
+        }
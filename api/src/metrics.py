@@ -0,0 +1,258 @@
+"""
+Метрики процесса в текстовом формате Prometheus (для эндпоинта /metrics).
+
+Счетчики и гистограммы обновляются без блокировок: прибавление к полю под GIL стоит десятки наносекунд,
+а при гонке потоков может потеряться разве что отдельное наблюдение, для метрик это приемлемо.
+Блокировка берется только при появлении нового набора меток.
+
+Для того, что и так считается внутри компонентов (кэши, пул подключений, обслуживание), отдельных метрик
+не заводится: Registry.register_stats опрашивает их stats() в момент выгрузки, так что горячий путь не меняется.
+"""
+
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+class _Metric(ABC):
+    """
+    Метрика с метками. Без меток значения копятся в самой метрике, с метками - в дочерних,
+    которые создаются при первом обращении к labels(...) и дальше берутся из словаря.
+    """
+    TYPE = ''
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self._labelnames = labelnames
+        self._children: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values: str):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._child())
+        return child
+
+    @abstractmethod
+    def _child(self) -> '_Metric':
+        ...
+
+    @abstractmethod
+    def _samples(self, name: str, labelnames: Tuple[str, ...], values: Tuple[str, ...]) -> List[str]:
+        ...
+
+    def _series(self) -> Iterator[Tuple[Tuple[str, ...], Any]]:
+        if self._labelnames:
+            yield from list(self._children.items())
+        else:
+            yield (), self
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.TYPE}']
+        for values, child in self._series():
+            lines.extend(child._samples(self.name, self._labelnames, values))
+        return lines
+
+
+class Counter(_Metric):
+    TYPE = 'counter'
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def _child(self) -> 'Counter':
+        return Counter(self.name, self.help)
+
+    def _samples(self, name: str, labelnames: Tuple[str, ...], values: Tuple[str, ...]) -> List[str]:
+        return [f'{name}{_format_labels(labelnames, values)} {_format_value(self.value)}']
+
+
+class Histogram(_Metric):
+    """
+    Гистограмма с фиксированными границами корзин. Наблюдение - поиск корзины делением пополам
+    и два прибавления, накопительные суммы по корзинам считаются только при выгрузке.
+    """
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self._bounds = tuple(sorted(buckets))
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._sum = 0.0
+
+    def observe(self, value: float):
+        self._counts[bisect_left(self._bounds, value)] += 1
+        self._sum += value
+
+    def time_since(self, started: float):
+        """
+        Наблюдение длительности от started (по time.perf_counter) до текущего момента
+        """
+        self.observe(time.perf_counter() - started)
+
+    def total_count(self) -> int:
+        """
+        Наблюдений всего, по всем наборам меток
+        """
+        return sum(sum(child._counts) for _, child in self._series())
+
+    def _child(self) -> 'Histogram':
+        return Histogram(self.name, self.help, buckets=self._bounds)
+
+    def _samples(self, name: str, labelnames: Tuple[str, ...], values: Tuple[str, ...]) -> List[str]:
+        counts = list(self._counts)
+        lines = []
+        total = 0
+        for bound, count in zip(self._bounds + (float('inf'),), counts):
+            total += count
+            le = 'le="' + _format_value(float(bound)) + '"'
+            lines.append(f'{name}_bucket{_format_labels(labelnames, values, le)} {total}')
+        lines.append(f'{name}_sum{_format_labels(labelnames, values)} {_format_value(self._sum)}')
+        lines.append(f'{name}_count{_format_labels(labelnames, values)} {total}')
+        return lines
+
+
+class _StatsCollector:
+    """
+    Выгружает словарь stats() компонента: каждый ключ - отдельная метрика с именем prefix_ключ.
+    Ключи из counters - накопительные счетчики, остальные - текущие значения (gauge).
+    Если stats() возвращает вложенные словари, ключи верхнего уровня становятся значением метки label.
+    """
+    def __init__(self, prefix: str, help: str, stats: Callable[[], Dict[str, Any]],
+                 counters: Iterable[str], label: Optional[str]):
+        self._prefix = prefix
+        self._help = help
+        self._stats = stats
+        self._counters = frozenset(counters)
+        self._label = label
+
+    def render(self) -> List[str]:
+        stats = self._stats()
+        if self._label is None:
+            groups = [((), stats)]
+        else:
+            groups = [((group,), values) for group, values in stats.items()]
+        samples: Dict[str, List[str]] = {}
+        labelnames = (self._label,) if self._label else ()
+        for values, group_stats in groups:
+            for key, value in group_stats.items():
+                if not isinstance(value, (int, float)):
+                    continue
+                samples.setdefault(key, []).append(
+                    f'{self._name(key)}{_format_labels(labelnames, values)} {_format_value(value)}')
+        lines = []
+        for key, key_samples in samples.items():
+            kind = 'counter' if key in self._counters else 'gauge'
+            lines.append(f'# HELP {self._name(key)} {self._help}: {key}')
+            lines.append(f'# TYPE {self._name(key)} {kind}')
+            lines.extend(key_samples)
+        return lines
+
+    def _name(self, key: str) -> str:
+        name = f'{self._prefix}_{key}'
+        if key in self._counters and not name.endswith('_total'):
+            name += '_total'
+        return name
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[Any] = []
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help: str, *labelnames: str) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, *labelnames: str, buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def register_stats(self, prefix: str, help: str, stats: Callable[[], Dict[str, Any]],
+                       counters: Iterable[str] = (), label: Optional[str] = None):
+        self._register(_StatsCollector(prefix, help, stats, counters, label))
+
+    def render(self) -> str:
+        """
+        Все метрики в текстовом формате Prometheus. Ошибка одного stats() не мешает выгрузить остальные.
+        """
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics)
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                continue
+        lines.append('')
+        return '\n'.join(lines)
+
+    def _register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+
+REGISTRY = Registry()
+
+
+class MetricsMiddleware:
+    """
+    ASGI-прослойка, которая считает запросы и время их обработки по методу и обработчику.
+    Обработчик определяется по endpoint, который роутер кладет в scope, так что число меток
+    не зависит от путей запросов. Время считается до отправки последнего куска тела ответа,
+    то есть для потоковой выгрузки - вся выгрузка.
+    """
+    def __init__(self, app, registry: Registry = REGISTRY):
+        self._app = app
+        self._requests = registry.counter(
+            'shortlinks_http_requests_total', 'Обработанные HTTP-запросы', 'method', 'handler', 'status')
+        self._seconds = registry.histogram(
+            'shortlinks_http_request_seconds', 'Время обработки HTTP-запросов', 'method', 'handler')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self._app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_status(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        try:
+            await self._app(scope, receive, send_status)
+        finally:
+            endpoint = scope.get('endpoint')
+            handler = getattr(endpoint, '__name__', 'unmatched')
+            self._seconds.labels(scope['method'], handler).time_since(started)
+            self._requests.labels(scope['method'], handler, str(status[0])).inc()
@@ -0,0 +1,118 @@
+"""
+Выбор реплики БД для читающих запросов.
+
+Здесь только политика, без запросов к БД: какую реплику взять, какие пора проверить на отставание,
+какие временно выключить после ошибки. Сами запросы и проверки делают коннекторы слоя БД
+(синхронный и асинхронный), так что политика у них общая.
+"""
+
+import itertools
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+# Отставание реплики в секундах. Если реплика проиграла все полученные изменения, отставание нулевое,
+# даже когда основной сервер давно ничего не писал и время последней транзакции старое.
+LAG_QUERY = """SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0)
+    END::float8"""
+
+LATENCY_WEIGHT = 0.2 # вес нового замера в скользящем среднем времени запроса
+
+
+class Replica:
+    """
+    Реплика и то, что о ней известно: отставание с последней проверки, среднее время запроса,
+    до какого момента она выключена после ошибки. Пока реплику ни разу не проверили, она не выбирается.
+    """
+    __slots__ = ('name', 'connector', 'lag', 'latency', 'checked_at', 'down_until', 'reads', 'errors')
+
+    def __init__(self, name: str, connector: Any):
+        self.name = name
+        self.connector = connector
+        self.lag: Optional[float] = None
+        self.latency = 0.0
+        self.checked_at = float('-inf')
+        self.down_until = 0.0
+        self.reads = 0
+        self.errors = 0
+
+
+class ReplicaSet:
+    """
+    Реплики для чтения. Из тех, что проверены, не выключены и отстают не больше max_lag секунд,
+    pick() выбирает по очереди ('round_robin') или с наименьшим средним временем запроса ('latency').
+    Время запроса замеряется и при проверке отставания, так что медленная реплика, которую не выбирают,
+    все равно получает свежие замеры и может снова стать лучшей.
+    Если подходящих реплик нет, pick() возвращает None, и запрос идет на основной сервер.
+    """
+    def __init__(self, replicas: List[Replica], max_lag: float, check_interval: float, policy: str = 'latency'):
+        if policy not in ('latency', 'round_robin'):
+            raise ValueError(f'Неизвестная политика выбора реплики: {policy}')
+        self.replicas = replicas
+        self._max_lag = max_lag
+        self._check_interval = check_interval
+        self._policy = policy
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+        self._fallbacks = 0
+
+    def due(self) -> List[Replica]:
+        """
+        Реплики, которые пора проверить на отставание. Проверку берет на себя вызвавший,
+        остальные до следующего интервала их не получат.
+        """
+        now = time.monotonic()
+        with self._lock:
+            due = [replica for replica in self.replicas if replica.checked_at + self._check_interval <= now]
+            for replica in due:
+                replica.checked_at = now
+        return due
+
+    def checked(self, replica: Replica, lag: float, seconds: float):
+        replica.lag = lag
+        self.observe(replica, seconds)
+
+    def observe(self, replica: Replica, seconds: float):
+        replica.reads += 1
+        replica.latency += (seconds - replica.latency) * LATENCY_WEIGHT if replica.latency else seconds
+
+    def failed(self, replica: Replica):
+        """
+        Реплика не ответила: выключается до следующей проверки
+        """
+        replica.errors += 1
+        replica.down_until = time.monotonic() + self._check_interval
+        replica.checked_at = time.monotonic()
+
+    def pick(self) -> Optional[Replica]:
+        now = time.monotonic()
+        candidates = [
+            replica for replica in self.replicas
+            if replica.down_until <= now and replica.lag is not None and replica.lag <= self._max_lag
+        ]
+        if not candidates:
+            self._fallbacks += 1
+            return None
+        if self._policy == 'round_robin':
+            return candidates[next(self._turn) % len(candidates)]
+        return min(candidates, key=lambda replica: replica.latency)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        По репликам, плюс fallbacks - сколько раз чтение ушло на основной сервер, т.к. выбрать было некого
+        """
+        now = time.monotonic()
+        stats = {
+            replica.name: {
+                'lag': replica.lag if replica.lag is not None else -1,
+                'latency': replica.latency,
+                'down': int(replica.down_until > now),
+                'reads': replica.reads,
+                'errors': replica.errors,
+            }
+            for replica in self.replicas
+        }
+        stats['primary'] = {'fallbacks': self._fallbacks}
+        return stats
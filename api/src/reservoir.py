@@ -0,0 +1,208 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Iterable, List, Optional
+
+
+class ReservoirEmpty(Exception): pass
+
+
+class Reservoir:
+    """
+    Запас значений, заранее полученных из источника пачкой (id из последовательности и т.п.),
+    чтобы не ходить в источник за каждым значением по отдельности.
+
+    take() отдает значение из запаса, а когда он пуст, пополняет его пачкой через refill(batch_size).
+    Если источник ничего не дал, бросается ReservoirEmpty.
+    Значение, которое взяли, но не потратили, возвращается через put_back и будет выдано первым.
+
+    Запас можно пополнять и в фоне (см. ReservoirRefiller), тогда refill не нужен, а значения берутся
+    через take_nowait, который никогда не ходит в источник.
+    """
+    def __init__(self, refill: Optional[Callable[[int], Iterable[Any]]], batch_size: int):
+        self._refill = refill
+        self._batch_size = batch_size
+        self._items: deque = deque()
+        self._lock = threading.Lock()
+        self._notify: Optional[Callable[[], None]] = None
+        self._low_watermark = 0
+
+    @property
+    def batch_size(self) -> int:
+        return self._batch_size
+
+    def take(self) -> Any:
+        with self._lock:
+            if not self._items and self._refill is not None:
+                self._items.extend(self._refill(self._batch_size))
+            if not self._items:
+                raise ReservoirEmpty('Источник не выдал ни одного значения')
+            return self._items.popleft()
+
+    async def take_async(self) -> Any:
+        """
+        То же, что и take, только refill - корутина
+        """
+        if not self._items and self._refill is not None:
+            refilled = await self._refill(self._batch_size)
+            self._items.extend(refilled)
+        if not self._items:
+            raise ReservoirEmpty('Источник не выдал ни одного значения')
+        return self._items.popleft()
+
+    def take_nowait(self) -> Optional[Any]:
+        """
+        Значение из запаса или None, если он пуст. Когда запаса остается меньше low_watermark,
+        будит фоновое пополнение.
+        """
+        try:
+            item = self._items.popleft()
+        except IndexError:
+            item = None
+        if self._notify is not None and len(self._items) < self._low_watermark:
+            self._notify()
+        return item
+
+    def put_back(self, item: Any):
+        self._items.appendleft(item)
+
+    def extend(self, items: Iterable[Any]):
+        self._items.extend(items)
+
+    def drain(self) -> List[Any]:
+        """
+        Забирает весь запас, например, чтобы вернуть неизрасходованное в источник
+        """
+        items = []
+        while self._items:
+            items.append(self._items.popleft())
+        return items
+
+    def set_notify(self, notify: Optional[Callable[[], None]], low_watermark: int = 0):
+        self._notify = notify
+        self._low_watermark = low_watermark
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class ReservoirRefiller:
+    """
+    Фоновый поток, который пополняет Reservoir пачками до batch_size через refill(count).
+
+    Пополнение запускается, когда в запасе осталось меньше low_watermark, и раз в interval секунд.
+    Если источник отдал меньше, чем просили (значений у него пока нет), или упал,
+    следующая попытка будет не раньше чем через interval, как бы часто запас ни опустошали.
+    При остановке весь запас забирается и отдается в release, чтобы вернуть его в источник.
+    """
+    def __init__(self, reservoir: Reservoir, low_watermark: int, interval: float):
+        self._reservoir = reservoir
+        self._low_watermark = low_watermark
+        self._interval = interval
+        self._refill: Optional[Callable[[int], List[Any]]] = None
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, refill: Callable[[int], List[Any]]):
+        self._refill = refill
+        self._stopping = False
+        self._reservoir.set_notify(self._wakeup.set, self._low_watermark)
+        self._thread = threading.Thread(target=self._run, name='reservoir-refiller', daemon=True)
+        self._thread.start()
+
+    def stop(self, release: Callable[[List[Any]], Any]):
+        if self._thread is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+        self._reservoir.set_notify(None)
+        items = self._reservoir.drain()
+        if items:
+            release(items)
+
+    def _run(self):
+        retry_at = 0.0
+        while not self._stopping:
+            if time.monotonic() >= retry_at and self._refill_once():
+                retry_at = time.monotonic() + self._interval
+            self._wakeup.wait(self._interval)
+            self._wakeup.clear()
+
+    def _refill_once(self) -> bool:
+        """
+        Возвращает True, если источник исчерпан или упал и надо выждать
+        """
+        wanted = self._reservoir.batch_size - len(self._reservoir)
+        if wanted <= 0 or len(self._reservoir) >= self._low_watermark:
+            return False
+        try:
+            items = self._refill(wanted)
+        except Exception:
+            return True
+        self._reservoir.extend(items)
+        return len(items) < wanted
+
+
+class AsyncReservoirRefiller:
+    """
+    То же, что и ReservoirRefiller, только в виде задачи event loop и для асинхронного источника.
+    """
+    def __init__(self, reservoir: Reservoir, low_watermark: int, interval: float):
+        self._reservoir = reservoir
+        self._low_watermark = low_watermark
+        self._interval = interval
+        self._refill: Optional[Callable[[int], Awaitable[List[Any]]]] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, refill: Callable[[int], Awaitable[List[Any]]]):
+        """
+        Вызывается из уже запущенного event loop
+        """
+        self._refill = refill
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._reservoir.set_notify(self._wakeup.set, self._low_watermark)
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self, release: Callable[[List[Any]], Awaitable[Any]]):
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+        self._reservoir.set_notify(None)
+        items = self._reservoir.drain()
+        if items:
+            await release(items)
+
+    async def _run(self):
+        retry_at = 0.0
+        while not self._stopping:
+            if time.monotonic() >= retry_at and await self._refill_once():
+                retry_at = time.monotonic() + self._interval
+            await self._sleep(self._interval)
+
+    async def _refill_once(self) -> bool:
+        wanted = self._reservoir.batch_size - len(self._reservoir)
+        if wanted <= 0 or len(self._reservoir) >= self._low_watermark:
+            return False
+        try:
+            items = await self._refill(wanted)
+        except Exception:
+            return True
+        self._reservoir.extend(items)
+        return len(items) < wanted
+
+    async def _sleep(self, timeout: float):
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
@@ -1,5 +1,9 @@
+from abc import ABC, abstractmethod
 from binascii import crc32
-from typing import Callable
+from hashlib import blake2b
+from typing import Callable, List, Sequence
+
+import numpy as np
 
 BASE_62_ALPHABET = '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
 BASE_64_ALPHABET = BASE_62_ALPHABET + '-_'
@@ -59,4 +63,160 @@ def shortlink_hash(number: int) -> str:
     return number_to_base64(crc32(number.to_bytes(4, 'big')) + padding)
 
 
+def _crc32_table() -> np.ndarray:
+    """
+    Таблица побайтового CRC32 (тот же полином, что и в binascii.crc32)
+    """
+    table = np.arange(256, dtype=np.uint32)
+    for _ in range(8):
+        table = np.where(table & 1, (table >> 1) ^ np.uint32(0xEDB88320), table >> 1).astype(np.uint32)
+    return table
+
+
+_CRC32_TABLE = _crc32_table()
+_BASE_64_BYTES = np.frombuffer(BASE_64_ALPHABET.encode(), dtype=np.uint8)
+
+
+def _to_base64_fixed(values: np.ndarray, width: int) -> List[str]:
+    """
+    То же, что и number_to_base64 для массива чисел, только результат всегда ровно width символов
+    (короткие дополняются нулями слева). Цифры вынимаются сдвигами сразу из всего массива.
+    """
+    values = values.astype(np.uint64)
+    digits = np.empty((len(values), width), dtype=np.uint8)
+    for position in range(width - 1, -1, -1):
+        digits[:, position] = _BASE_64_BYTES[values & np.uint64(63)]
+        values = values >> np.uint64(6)
+    return digits.view(f'S{width}').ravel().astype(f'U{width}').tolist()
+
+
+def shortlink_hash_many(numbers: Sequence[int]) -> List[str]:
+    """
+    То же, что и shortlink_hash, только сразу для массива чисел, без цикла по элементам на Python.
+    Результат совпадает с shortlink_hash поэлементно.
+    """
+    numbers = np.asarray(numbers, dtype=np.int64)
+    if numbers.size and not ((numbers > 0) & (numbers < 10_000_000)).all():
+        raise ValueError('Argument "numbers" out of range (0, 10_000_000)')
+    return _to_base64_fixed(crc32_many(numbers).astype(np.uint64) + np.uint64(10 ** CRC32_PADDING_SIZE), 6)
+
+
+def crc32_many(numbers: np.ndarray) -> np.ndarray:
+    """
+    crc32(number.to_bytes(4, 'big')) для массива чисел: CRC32 считается по таблице для всего массива за 4 прохода
+    """
+    numbers = numbers.astype(np.uint32)
+    crc = np.full(numbers.shape, 0xFFFFFFFF, dtype=np.uint32)
+    for shift in (24, 16, 8, 0):
+        byte = (numbers >> np.uint32(shift)) & np.uint32(0xFF)
+        crc = _CRC32_TABLE[(crc ^ byte) & np.uint32(0xFF)] ^ (crc >> np.uint32(8))
+    return crc ^ np.uint32(0xFFFFFFFF)
+
 
+class ShortlinkEncoder(ABC):
+    """
+    Схема получения короткой ссылки из id. Схема выбирается один раз на всю БД (SHORTLINK_SCHEME):
+    короткие ссылки разных схем друг с другом не согласованы и могут совпасть.
+    """
+    max_number: int
+
+    @abstractmethod
+    def encode(self, number: int) -> str:
+        ...
+
+    @abstractmethod
+    def encode_many(self, numbers: Sequence[int]) -> List[str]:
+        ...
+
+
+class Crc32Encoder(ShortlinkEncoder):
+    """
+    Исходная схема: shortlink_hash, id до 10 млн.
+    """
+    max_number = 10_000_000 - 1
+
+    def encode(self, number: int) -> str:
+        return shortlink_hash(number)
+
+    def encode_many(self, numbers: Sequence[int]) -> List[str]:
+        return shortlink_hash_many(numbers)
+
+
+class FeistelEncoder(ShortlinkEncoder):
+    """
+    Ключевая перестановка пространства id из 2 * half_bits бит (по умолчанию 36 бит, это ~68.7 млрд. id),
+    построенная сетью Фейстеля. Перестановка взаимно однозначна по построению (у неё есть обратная, decode),
+    так что коллизий нет на всём пространстве. Результат - число той же разрядности,
+    записанное в base64 фиксированной длины: 36 бит - ровно 6 символов.
+
+    Соседние id дают непохожие ссылки, а без ключа порядок выдачи не восстановить.
+    Ключ менять нельзя, пока в БД есть ссылки, выданные по старому ключу.
+    """
+    def __init__(self, key: int, half_bits: int = 18, rounds: int = 4):
+        if (2 * half_bits) % 6:
+            raise ValueError('2 * half_bits must be a multiple of 6')
+        self._half_bits = half_bits
+        self._mask = (1 << half_bits) - 1
+        self._width = 2 * half_bits // 6
+        self.max_number = (1 << (2 * half_bits)) - 1
+        self._round_keys = [
+            int.from_bytes(blake2b(f'{key}:{i}'.encode(), digest_size=4).digest(), 'big')
+            for i in range(rounds)
+        ]
+
+    def encode(self, number: int) -> str:
+        if not 0 < number <= self.max_number:
+            raise ValueError(f'Argument "number" out of range (0, {self.max_number}]')
+        encoded = number_to_base64(self.permute(number))
+        return BASE_64_ALPHABET[0] * (self._width - len(encoded)) + encoded
+
+    def encode_many(self, numbers: Sequence[int]) -> List[str]:
+        numbers = np.asarray(numbers, dtype=np.int64)
+        if numbers.size and not ((numbers > 0) & (numbers <= self.max_number)).all():
+            raise ValueError(f'Argument "numbers" out of range (0, {self.max_number}]')
+        return _to_base64_fixed(self.permute_many(numbers.astype(np.uint64)), self._width)
+
+    def permute(self, number: int) -> int:
+        left, right = number >> self._half_bits, number & self._mask
+        for round_key in self._round_keys:
+            left, right = right, left ^ self._round(right, round_key)
+        return (left << self._half_bits) | right
+
+    def decode(self, value: int) -> int:
+        left, right = value >> self._half_bits, value & self._mask
+        for round_key in reversed(self._round_keys):
+            left, right = right ^ self._round(left, round_key), left
+        return (left << self._half_bits) | right
+
+    def permute_many(self, numbers: np.ndarray) -> np.ndarray:
+        half_bits = np.uint64(self._half_bits)
+        left, right = numbers >> half_bits, numbers & np.uint64(self._mask)
+        for round_key in self._round_keys:
+            left, right = right, left ^ self._round(right, np.uint64(round_key))
+        return (left << half_bits) | right
+
+    def decode_many(self, values: np.ndarray) -> np.ndarray:
+        half_bits = np.uint64(self._half_bits)
+        left, right = values >> half_bits, values & np.uint64(self._mask)
+        for round_key in reversed(self._round_keys):
+            left, right = right ^ self._round(left, np.uint64(round_key)), left
+        return (left << half_bits) | right
+
+    def _round(self, half, round_key):
+        """
+        Раундовая функция: перемешивание половины с ключом раунда умножениями и сдвигами (как в murmur3),
+        от результата берутся старшие half_bits бит. Одинаково работает и с int, и с массивами uint64.
+        """
+        x = ((half ^ round_key) * 0x85EBCA6B) & 0xFFFFFFFF
+        x ^= x >> 13
+        x = (x * 0xC2B2AE35) & 0xFFFFFFFF
+        x ^= x >> 16
+        return x >> (32 - self._half_bits)
+
+
+def build_shortlink_encoder(scheme: str, key: int) -> ShortlinkEncoder:
+    if scheme == 'crc32':
+        return Crc32Encoder()
+    if scheme == 'feistel':
+        return FeistelEncoder(key)
+    raise ValueError(f'Неизвестная схема коротких ссылок: {scheme}')
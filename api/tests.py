@@ -3,9 +3,33 @@
 которые при рефакторинге легко сломать, и использование которых без тестов неочевидно.
 """
 
-from unittest import TestCase
-from src.shortlink_generator import build_base_x_encoder, shortlink_hash, number_to_base64
-from src.cache import CacheLRU, CacheWriteback
+from unittest import SkipTest, TestCase
+from unittest.mock import patch
+import asyncio
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from config import config
+
+from src.shortlink_generator import build_base_x_encoder, shortlink_hash, number_to_base64, shortlink_hash_many, FeistelEncoder
+from src.cache import CacheLRU, CacheNegative, CacheWriteback, CacheWritebackBatch, WritebackFlusher, AsyncWritebackFlusher
+from src.cache_shared import CacheShared, LocalSharedStore, MmapSharedStore
+from src.reservoir import Reservoir, ReservoirEmpty, ReservoirRefiller, AsyncReservoirRefiller
+from src.expiry import ExpiryJob
+from src import cache_snapshot, export
+from src.maintenance import Maintenance
+from src.metrics import Registry
+from src.db import ShortlinkNotFound, NoFreeShortlinks, DBShortlinks, Installer, ConnectionPool, PoolTimeout, QUERY_SECONDS, _PooledConnector, _ReadConnector, _numbered
+from src.db_async import AsyncDBShortlinks, _AsyncConnector
+from src.db_sqlite import SQLiteDBShortlinks, AsyncSQLiteDBShortlinks, FileLeaderLock
+from src.replicas import Replica, ReplicaSet
+from src.data_manager import DataManager
 
 class TestShortlinkGenerator(TestCase):
     def test_number_to_base64(self):
@@ -49,6 +73,31 @@ class TestShortlinkGenerator(TestCase):
         with self.assertRaises(ValueError):
             shortlink_hash(10_000_000)
 
+    def test_shortlink_hash_many(self):
+        numbers = [1, 2, 64, 65, 9_999_999] + list(range(1000, 2000))
+        self.assertEqual(shortlink_hash_many(numbers), [shortlink_hash(number) for number in numbers])
+        self.assertEqual(shortlink_hash_many([]), [])
+        with self.assertRaises(ValueError):
+            shortlink_hash_many([1, 10_000_000])
+
+    def test_feistel_encoder(self):
+        """
+        Методика тестирования: на уменьшенном (18 бит) пространстве id перебираем его целиком,
+        контролируя отсутствие коллизий, фиксированную длину, совпадение пакетного и поштучного
+        кодирования и обратимость. На 36 битах то же самое проверяет benchmarks.shortlink_collisions.
+        """
+        encoder = FeistelEncoder(key=42, half_bits=9)
+        numbers = list(range(1, encoder.max_number + 1))
+        codes = encoder.encode_many(numbers)
+        self.assertEqual(len(set(codes)), len(numbers))
+        self.assertEqual({len(code) for code in codes}, {3})
+        self.assertEqual([encoder.encode(number) for number in numbers[:1000]], codes[:1000])
+        self.assertEqual([encoder.decode(encoder.permute(number)) for number in numbers[:1000]], numbers[:1000])
+        self.assertNotEqual(FeistelEncoder(key=43, half_bits=9).encode_many(numbers[:100]), codes[:100])
+        self.assertEqual(len(FeistelEncoder(key=42).encode(2 ** 36 - 1)), 6)
+        with self.assertRaises(ValueError):
+            encoder.encode(encoder.max_number + 1)
+
 
 class TestCacheLRU(TestCase):
     def setUp(self):
@@ -91,6 +140,242 @@ class TestCacheLRU(TestCase):
         self.assertEqual(len(self.cache.container), 10)
         self.assertNotIn(1, self.cache.container)
 
+    def test_eviction_order(self):
+        """
+        Методика тестирования: без гистерезиса кэш держит ровно maxsize записей
+        и вытесняет ту, к которой дольше всего не обращались, а не самую раннюю по добавлению.
+        """
+        cache = CacheLRU(maxsize=3)
+        def func(x):
+            return x * 2
+        for i in range(1, 4):
+            cache.get(i, func, i)
+        cache.get(1, func, 1)
+        cache.get(4, func, 4)
+        self.assertEqual(len(cache.container), 3)
+        self.assertTrue(cache.key_exists(1))
+        self.assertFalse(cache.key_exists(2))
+        self.assertTrue(cache.key_exists(4))
+
+    def test_get_many(self):
+        """
+        Методика тестирования: читаем пачку ключей, часть из которых уже в кэше,
+        контролируя, что промахи читаются одним вызовом, а отсутствующие в источнике в результат не попадают.
+        """
+        calls = []
+        def func(keys):
+            calls.append(keys)
+            return {key: key * 2 for key in keys if key < 100}
+        self.cache.get(1, lambda x: x * 2, 1)
+        result = self.cache.get_many([1, 2, 3, 2, 100], func)
+        self.assertEqual(result, {1: 2, 2: 4, 3: 6})
+        self.assertEqual(calls, [[2, 3, 100]])
+        self.assertEqual(self.cache.get_many([2, 3], func), {2: 4, 3: 6})
+        self.assertEqual(len(calls), 1)
+        self.assertFalse(self.cache.key_exists(100))
+
+    def test_ttl(self):
+        """
+        Методика тестирования: читаем ключи через кэш с коротким ttl, контролируя, что после срока
+        обращение снова идет в источник, а sweep выкидывает истекшие записи без обращений к ним.
+        Очередь истечения не разрастается и остается в порядке сроков, а кэш без ttl на попадании часы не читает.
+        """
+        cache = CacheLRU(maxsize=10, ttl=0.05)
+        calls = []
+        def func(x):
+            calls.append(x)
+            return x * 2
+        for key in (1, 2, 3):
+            cache.get(key, func, key)
+        self.assertEqual(cache.get(1, func, 1), 2)
+        self.assertEqual(cache.get_many([2, 3], lambda keys: {key: func(key) for key in keys}), {2: 4, 3: 6})
+        self.assertEqual(calls, [1, 2, 3])
+        self.assertEqual(cache.sweep(), 0)
+        time.sleep(0.06)
+        self.assertFalse(cache.key_exists(2))
+        self.assertEqual(cache.get(1, func, 1), 2)
+        self.assertEqual(calls, [1, 2, 3, 1])
+        self.assertEqual(cache.sweep(), 2)
+        self.assertEqual(list(cache.container), [1])
+        self.assertEqual(cache.stats()['expired'], 3)
+        for i in range(100):
+            cache.get(i, func, i)
+        self.assertLessEqual(len(cache._expiry), 2 * 11)
+        expires = [cached.expires for cached, _ in cache._expiry]
+        self.assertEqual(expires, sorted(expires))
+        self.assertTrue(all(cache.container[key] is cached for cached, key in list(cache._expiry)[-10:]))
+
+        cache = CacheLRU(maxsize=10, ttl=60)
+        for i in range(10):
+            cache.get(i, func, i)
+        for _ in range(30):
+            cache.delete(5)
+            cache.get(5, func, 5)
+        self.assertEqual(len(cache._expiry), 40)
+        self.assertEqual(cache.sweep(), 0)
+        self.assertEqual([key for _, key in cache._expiry], [0, 1, 2, 3, 4, 6, 7, 8, 9, 5])
+
+        endless = CacheLRU(maxsize=10)
+        endless.get(1, func, 1)
+        with patch('src.cache._now', side_effect=AssertionError('часы без ttl не нужны')):
+            self.assertEqual(endless.get(1, func, 1), 2)
+
+    def test_snapshot(self):
+        """
+        Методика тестирования: снимаем самые свежие записи кэша в файл и прогреваем из него новый кэш,
+        контролируя порядок вытеснения, сохранение срока записей и то, что битый файл считается отсутствующим.
+        """
+        cache = CacheLRU(maxsize=10, ttl=60)
+        for key in ('a', 'b', 'c', 'd'):
+            cache.get(key, str.upper, key)
+        cache.get('a', str.upper, 'a')
+        items = cache.items_recent(3)
+        self.assertEqual([key for key, _, _ in items], ['c', 'd', 'a'])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache.snapshot')
+            self.assertEqual(cache_snapshot.dump(path, items + [('gone', 'GONE', -1)]), 4)
+            loaded = cache_snapshot.load(path)
+            self.assertEqual([(key, value) for key, value, _ in loaded], [('c', 'C'), ('d', 'D'), ('a', 'A')])
+            self.assertTrue(all(55 < remaining <= 60 for _, _, remaining in loaded))
+
+            warm = CacheLRU(maxsize=3, ttl=30)
+            self.assertEqual(warm.preload(loaded), 3)
+            self.assertEqual(warm.get('a', lambda key: self.fail('прочитано из источника')), 'A')
+            self.assertTrue(all(cached.expires - time.monotonic() <= 30 for cached in warm.container.values()))
+            warm.get('e', str.upper, 'e')
+            self.assertEqual(list(warm.container), ['d', 'a', 'e'])
+
+            with open(path, 'r+b') as file:
+                file.truncate(os.path.getsize(path) - 1)
+            self.assertEqual(cache_snapshot.load(path), [])
+            self.assertEqual(cache_snapshot.load(os.path.join(directory, 'missing')), [])
+
+    def test_single_flight(self):
+        """
+        Методика тестирования: много потоков одновременно промахиваются по одному ключу,
+        контролируя, что источник прочитан один раз, все получили его результат, а ошибка источника досталась всем.
+        """
+        calls = []
+        release = threading.Event()
+        def func(x):
+            calls.append(x)
+            release.wait()
+            if x < 0:
+                raise KeyError(x)
+            return x * 2
+        for key, expected in ((1, 2), (-1, KeyError)):
+            results = []
+            def worker():
+                try:
+                    results.append(self.cache.get(key, func, key))
+                except KeyError:
+                    results.append(KeyError)
+            threads = [threading.Thread(target=worker) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.05)
+            release.set()
+            for thread in threads:
+                thread.join()
+            release.clear()
+            self.assertEqual(results, [expected] * 8)
+        self.assertEqual(calls, [1, -1])
+        self.assertEqual(self.cache.stats()['coalesced'], 14)
+
+    def test_single_flight_async(self):
+        """
+        Методика тестирования: то же для корутин, плюс отмена первой корутины не отменяет остальные,
+        а одна из них читает источник сама.
+        """
+        calls = []
+        async def func(x):
+            calls.append(x)
+            await asyncio.sleep(0.01)
+            return x * 2
+
+        async def scenario():
+            results = await asyncio.gather(*(self.cache.get_async(1, func, 1) for _ in range(8)))
+            self.assertEqual(results, [2] * 8)
+            leader = asyncio.ensure_future(self.cache.get_async(2, func, 2))
+            await asyncio.sleep(0)
+            followers = [asyncio.ensure_future(self.cache.get_async(2, func, 2)) for _ in range(3)]
+            await asyncio.sleep(0)
+            leader.cancel()
+            self.assertEqual(await asyncio.gather(*followers), [4] * 3)
+
+        asyncio.run(scenario())
+        self.assertEqual(calls, [1, 2, 2])
+
+
+class TestCacheNegative(TestCase):
+    def setUp(self):
+        self.cache = CacheNegative(maxsize=2, ttl=0.05, error=KeyError)
+        self.cache_lru = CacheLRU(maxsize=10)
+
+    def test_caching(self):
+        """
+        Методика тестирования: читаем отсутствующий ключ через LRU-кэш с кэшем промахов за ним,
+        контролируя количество прямых вызовов, сброс по delete и истечение времени жизни.
+        """
+        direct_call_counter = 0
+        data = {}
+        def func(x):
+            nonlocal direct_call_counter
+            direct_call_counter += 1
+            return data[x]
+        for _ in range(3):
+            with self.assertRaises(KeyError):
+                self.cache_lru.get('a', self.cache.get, 'a', func, 'a')
+        self.assertEqual(direct_call_counter, 1)
+        self.assertTrue(self.cache.key_exists('a'))
+
+        data['a'] = 1
+        self.cache.delete('a')
+        self.assertEqual(self.cache_lru.get('a', self.cache.get, 'a', func, 'a'), 1)
+        self.assertEqual(direct_call_counter, 2)
+
+        with self.assertRaises(KeyError):
+            self.cache.get('b', func, 'b')
+        data['b'] = 2
+        time.sleep(0.1)
+        self.assertEqual(self.cache.get('b', func, 'b'), 2)
+
+    def test_get_many(self):
+        """
+        Методика тестирования: читаем пачку ключей через LRU-кэш с кэшем промахов за ним,
+        контролируя, что отсутствующие ключи запоминаются и больше не уходят в источник,
+        а одиночное чтение такого ключа бросает исключение.
+        """
+        cache = CacheNegative(maxsize=10, ttl=10, error=KeyError, message='{key} not found')
+        calls = []
+        def func(keys):
+            calls.append(keys)
+            return {key: key.upper() for key in keys if key != 'x'}
+        self.assertEqual(self.cache_lru.get_many(['a', 'x'], cache.get_many, func), {'a': 'A'})
+        self.assertEqual(self.cache_lru.get_many(['a', 'x', 'b'], cache.get_many, func), {'a': 'A', 'b': 'B'})
+        self.assertEqual(calls, [['a', 'x'], ['b']])
+        with self.assertRaises(KeyError) as raised:
+            cache.get('x', func, ['x'])
+        self.assertEqual(raised.exception.args, ('x not found',))
+
+    def test_flushing(self):
+        """
+        Методика тестирования: кэшируем промахов больше предела, контролируя вытеснение старых,
+        а также то, что другие исключения не кэшируются.
+        """
+        def func(x):
+            raise KeyError(x)
+        def broken_func(x):
+            raise RuntimeError(x)
+        for key in ['a', 'b', 'c']:
+            with self.assertRaises(KeyError):
+                self.cache.get(key, func, key)
+        self.assertEqual(len(self.cache.container), 2)
+        self.assertFalse(self.cache.key_exists('a'))
+        with self.assertRaises(RuntimeError):
+            self.cache.get('d', broken_func, 'd')
+        self.assertFalse(self.cache.key_exists('d'))
+
 
 class TestCacheWriteback(TestCase):
     def setUp(self):
@@ -131,3 +416,1073 @@ class TestCacheWriteback(TestCase):
         self.assertEqual(len(real_data_container), 10)
 
 
+class TestCacheWritebackBatch(TestCase):
+    def setUp(self):
+        self.cache = CacheWritebackBatch(maxsize=10, batch_size=3)
+
+    def test_batching(self):
+        """
+        Методика тестирования: складываем в кэш данные с повторами ключей,
+        контролируя схлопывание повторов и нарезку на пачки при сбросе.
+        """
+        batches = []
+        def func(items):
+            batches.append(list(items))
+        for i in [1, 2, 3, 2, 4, 1, 5]:
+            self.cache.put(i, func, i * 2)
+        self.assertEqual(len(self.cache.container), 5)
+        self.assertEqual(batches, [])
+        self.cache.flush()
+        self.assertEqual(batches, [[2, 4, 6], [8, 10]])
+        self.assertEqual(len(self.cache.container), 0)
+
+        self.cache.put(1, func, 1)
+        self.cache.put_many(func, {1: 10, 2: 20})
+        self.assertEqual(len(self.cache.container), 2)
+        self.cache.flush()
+        self.assertEqual(batches[-1], [10, 20])
+
+    def test_flushing(self):
+        """
+        Методика тестирования: набиваем кэш до предела, контролируя срабатывание флуш-триггера,
+        а также возврат данных в кэш при ошибке записи.
+        """
+        real_data_container = []
+        def func(items):
+            real_data_container.extend(items)
+        def broken_func(items):
+            raise RuntimeError
+        for i in range(1, 10):
+            self.cache.put(i, func, i)
+        self.assertEqual(len(real_data_container), 0)
+        self.cache.put(10, func, 10)
+        self.assertEqual(len(self.cache.container), 0)
+        self.assertEqual(sorted(real_data_container), list(range(1, 11)))
+
+        self.cache.put(1, broken_func, 1)
+        with self.assertRaises(RuntimeError):
+            self.cache.flush()
+        self.assertTrue(self.cache.key_exists(1))
+
+    def test_merge(self):
+        """
+        Методика тестирования: с merge повторы ключа не затирают, а складывают аргументы,
+        в том числе несброшенное при ошибке записи с пришедшим после нее.
+        """
+        cache = CacheWritebackBatch(maxsize=10, batch_size=10, merge=lambda pending, item: pending + item)
+        flushed = []
+        failing = [True]
+        def func(items):
+            if failing[0]:
+                raise RuntimeError
+            flushed.extend(items)
+        for key in ['a', 'b', 'a', 'a']:
+            cache.put(key, func, 1)
+        with self.assertRaises(RuntimeError):
+            cache.flush()
+        cache.put_many(func, {'a': 1, 'c': 1})
+        failing[0] = False
+        cache.flush()
+        self.assertEqual(sorted(flushed), [1, 1, 4])
+
+
+class TestWritebackFlusher(TestCase):
+    def setUp(self):
+        self.cache = CacheWritebackBatch(maxsize=5, batch_size=100, max_pending=8)
+        self.flusher = WritebackFlusher(self.cache, max_age=0.05)
+        self.flusher.start()
+
+    def tearDown(self):
+        self.flusher.stop()
+
+    def test_flushing(self):
+        """
+        Методика тестирования: пишем через кэш с запущенным фоновым сбросом,
+        контролируя, что put сам ничего не пишет, а фоновый поток сбрасывает буфер
+        по заполнению и по возрасту.
+        """
+        real_data_container = []
+        def func(items):
+            real_data_container.extend(items)
+        self.cache.put(1, func, 1)
+        self.assertEqual(real_data_container, [])
+        time.sleep(0.2)
+        self.assertEqual(real_data_container, [1])
+        for i in range(2, 7):
+            self.cache.put(i, func, i)
+        time.sleep(0.02)
+        self.assertEqual(sorted(real_data_container), [1, 2, 3, 4, 5, 6])
+        self.assertEqual(self.cache.stats()['pending'], 0)
+
+    def test_stop_without_start(self):
+        """
+        Методика тестирования: остановка сброса, который не запускали (старт сервиса упал),
+        и повторная остановка проходят без ошибок.
+        """
+        WritebackFlusher(CacheWritebackBatch(maxsize=5, batch_size=100), max_age=0.05).stop()
+
+        async def scenario():
+            flusher = AsyncWritebackFlusher(CacheWritebackBatch(maxsize=5, batch_size=100), max_age=0.05)
+            await flusher.stop()
+            flusher.start()
+            await flusher.stop()
+            await flusher.stop()
+        asyncio.run(scenario())
+
+    def test_backpressure(self):
+        """
+        Методика тестирования: блокируем запись в БД и набиваем буфер сверх max_pending,
+        контролируя отбрасывание новых ключей и дозапись остального при остановке.
+        """
+        real_data_container = []
+        def func(items):
+            time.sleep(0.1)
+            real_data_container.extend(items)
+        for i in range(5):
+            self.cache.put(i, func, i)
+        time.sleep(0.02)
+        for i in range(5, 20):
+            self.cache.put(i, func, i)
+        self.assertEqual(self.cache.stats()['pending'], 8)
+        self.assertEqual(self.cache.stats()['dropped'], 7)
+        self.flusher.stop()
+        self.assertEqual(sorted(real_data_container), list(range(13)))
+        self.flusher.start()
+
+
+class TestCacheShared(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(self.directory.name, 'cache')
+        # два экземпляра хранилища на одном файле - как два процесса-воркера
+        self.stores = [MmapSharedStore(path, slots=64, journal_size=4) for _ in range(2)]
+        self.caches = [CacheShared(CacheLRU(maxsize=10), store) for store in self.stores]
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        self.directory.cleanup()
+
+    def test_sharing(self):
+        """
+        Методика тестирования: читаем ключ через кэш одного воркера, потом через кэш другого,
+        контролируя, что в источник сходил только первый.
+        """
+        direct_call_counter = 0
+        def func(x):
+            nonlocal direct_call_counter
+            direct_call_counter += 1
+            return f'origin-{x}'
+        first, second = self.caches
+        self.assertEqual(first.get('abc', func, 'abc'), 'origin-abc')
+        self.assertEqual(second.get('abc', func, 'abc'), 'origin-abc')
+        self.assertEqual(direct_call_counter, 1)
+        self.assertTrue(second.key_exists('abc'))
+
+    def test_invalidation(self):
+        """
+        Методика тестирования: удаляем ключ через кэш одного воркера,
+        контролируя, что он пропал из локального уровня другого, в том числе при переполнении журнала.
+        """
+        first, second = self.caches
+        values = {'abc': 'old'}
+        def func(x):
+            return values[x]
+        first.get('abc', func, 'abc')
+        second.get('abc', func, 'abc')
+        values['abc'] = 'new'
+        first.delete('abc')
+        self.assertEqual(second.get('abc', func, 'abc'), 'new')
+
+        second.get('xyz', lambda: 'xyz')
+        for i in range(10):
+            first.delete(f'key{i}')
+        self.assertFalse(second.key_exists('xyz'))
+
+    def test_delete_many(self):
+        """
+        Методика тестирования: удаляем пачку ключей, из которых в общем уровне лежит только один,
+        контролируя, что в журнал попал только он, так что другой воркер не чистит локальный уровень целиком,
+        а выкидывает только этот ключ.
+        """
+        first, second = self.caches
+        second.get('abc', lambda: 'old')
+        second.get('keep', lambda: 'keep')
+        seq = self.stores[0].seq()
+        first.delete_many(['abc'] + [f'key{i}' for i in range(10)])
+        self.assertEqual(self.stores[0].seq(), seq + 1)
+        self.assertIsNone(self.stores[0].get('abc'))
+        self.assertFalse(second.key_exists('abc'))
+        self.assertTrue(second.key_exists('keep'))
+
+    def test_stale_load(self):
+        """
+        Методика тестирования: удаляем ключ, пока другой воркер читает его из источника,
+        контролируя, что прочитанное старое значение не попало в общий уровень.
+        """
+        first, second = self.caches
+        def func(x):
+            second.delete(x)
+            return 'stale'
+        self.assertEqual(first.get('abc', func, 'abc'), 'stale')
+        self.assertIsNone(self.stores[1].get('abc'))
+        self.assertFalse(first.key_exists('abc'))
+
+    def test_local_store(self):
+        """
+        Методика тестирования: то же, что и для общего файла, но на заглушке в памяти процесса.
+        """
+        store = LocalSharedStore(maxsize=2, journal_size=4)
+        first, second = CacheShared(CacheLRU(maxsize=10), store), CacheShared(CacheLRU(maxsize=10), store)
+        first.get('abc', lambda: 'old')
+        self.assertEqual(second.get('abc', lambda: 'other'), 'old')
+        first.delete('abc')
+        self.assertEqual(second.get('abc', lambda: 'new'), 'new')
+
+
+class TestReservoir(TestCase):
+    def test_refill(self):
+        """
+        Методика тестирования: берем значения из запаса, контролируя количество обращений к источнику,
+        выдачу возвращенных значений первыми и ошибку, когда источник пуст.
+        """
+        refills = []
+        source = iter(range(1, 6))
+        def refill(count):
+            refills.append(count)
+            return [value for _, value in zip(range(count), source)]
+        reservoir = Reservoir(refill, batch_size=3)
+        self.assertEqual([reservoir.take(), reservoir.take()], [1, 2])
+        self.assertEqual(refills, [3])
+        reservoir.put_back(2)
+        self.assertEqual([reservoir.take(), reservoir.take(), reservoir.take()], [2, 3, 4])
+        self.assertEqual(refills, [3, 3])
+        self.assertEqual(reservoir.take(), 5)
+        with self.assertRaises(ReservoirEmpty):
+            reservoir.take()
+
+
+class TestReservoirRefiller(TestCase):
+    def test_refilling(self):
+        """
+        Методика тестирования: пополняем запас в фоне из конечного источника,
+        контролируя пополнение ниже порога, то, что исчерпанный источник не дергается на каждый take_nowait,
+        и возврат остатка запаса при остановке.
+        """
+        source = list(range(1, 8))
+        calls = []
+        def refill(count):
+            calls.append(count)
+            items = source[:count]
+            del source[:count]
+            return items
+        released = []
+        reservoir = Reservoir(None, batch_size=4)
+        refiller = ReservoirRefiller(reservoir, low_watermark=2, interval=0.2)
+        refiller.start(refill)
+        time.sleep(0.05)
+        self.assertEqual(len(reservoir), 4)
+        self.assertEqual([reservoir.take_nowait() for _ in range(3)], [1, 2, 3])
+        time.sleep(0.05)
+        self.assertEqual(len(reservoir), 4)
+        self.assertEqual(calls, [4, 3])
+        self.assertEqual([reservoir.take_nowait() for _ in range(4)], [4, 5, 6, 7])
+        time.sleep(0.05)
+        self.assertEqual(calls, [4, 3, 4])
+        self.assertIsNone(reservoir.take_nowait())
+        time.sleep(0.05)
+        self.assertEqual(len(calls), 3)
+        source.extend([10, 11])
+        time.sleep(0.3)
+        self.assertEqual(len(reservoir), 2)
+        refiller.stop(released.extend)
+        self.assertEqual(released, [10, 11])
+        self.assertEqual(len(reservoir), 0)
+
+    def test_stop_without_start(self):
+        """
+        Методика тестирования: остановка пополнения, которое не запускали (старт сервиса упал),
+        проходит без ошибок и ничего не возвращает.
+        """
+        released = []
+        reservoir = Reservoir(None, batch_size=4)
+        ReservoirRefiller(reservoir, low_watermark=2, interval=0.2).stop(released.extend)
+
+        async def release(items):
+            released.extend(items)
+        asyncio.run(AsyncReservoirRefiller(reservoir, low_watermark=2, interval=0.2).stop(release))
+        self.assertEqual(released, [])
+
+class TestExpiryJob(TestCase):
+    def test_chunking(self):
+        """
+        Методика тестирования: обрабатываем "таблицу" кусками с бюджетом времени на запуск,
+        контролируя размер кусков, продолжение с места остановки и начало нового прохода.
+        """
+        table = list(range(1, 26))
+        calls = []
+        def chunk(after, limit):
+            calls.append(after)
+            start = 0 if after is None else after[0]
+            rows = [key for key in table if key > start][:limit]
+            time.sleep(0.01)
+            return len(rows), (rows[-1],) if rows else None
+        job = ExpiryJob(chunk_size=10, time_budget=0.005)
+        self.assertEqual(job.run(chunk), 10)
+        self.assertEqual(job.run(chunk), 10)
+        self.assertTrue(job.stats()['in_pass'])
+        self.assertEqual(job.run(chunk), 5)
+        self.assertEqual(calls, [None, (10,), (20,)])
+        self.assertEqual(job.stats()['passes'], 1)
+        self.assertFalse(job.stats()['in_pass'])
+        job = ExpiryJob(chunk_size=10, time_budget=10)
+        self.assertEqual(job.run(chunk), 25)
+        self.assertEqual(job.stats()['chunks'], 3)
+
+class TestExport(TestCase):
+    def test_export_chunks(self):
+        """
+        Методика тестирования: выгружаем строк больше, чем влезает в один кусок,
+        контролируя нарезку на куски, заголовок CSV и разбор результата обратно.
+        """
+        date_access = datetime(2021, 1, 2, 3, 4, 5)
+        rows = [(i, f's{i}', f'http://e/{i},x', date_access, 'active') for i in range(export.CHUNK_ROWS + 1)]
+        chunks = list(export.export_chunks(iter(rows), 'ndjson'))
+        self.assertEqual(len(chunks), 2)
+        records = [json.loads(line) for line in ''.join(chunks).splitlines()]
+        self.assertEqual(len(records), len(rows))
+        self.assertEqual(records[1], {
+            'id': 1, 'short': 's1', 'origin': 'http://e/1,x', 'date_access': '2021-01-02T03:04:05', 'status': 'active'})
+        csv_lines = ''.join(export.export_chunks(rows[:2], 'csv')).splitlines()
+        self.assertEqual(csv_lines, [
+            'id,short,origin,date_access,status',
+            '0,s0,"http://e/0,x",2021-01-02T03:04:05,active',
+            '1,s1,"http://e/1,x",2021-01-02T03:04:05,active',
+        ])
+        with self.assertRaises(ValueError):
+            list(export.export_chunks(rows, 'xml'))
+
+
+class TestMaintenance(TestCase):
+    def test_tick_only_leader(self):
+        """
+        Методика тестирования: два процесса делят одну блокировку лидера,
+        обслуживание на тике выполняет только тот, кто ее держит, а после close лидерство переходит.
+        """
+        class FakeLock:
+            owner = None
+
+            def __init__(self):
+                self.held = False
+
+            def acquire(self):
+                if FakeLock.owner in (None, self):
+                    FakeLock.owner = self
+                    self.held = True
+                return self.held
+
+            def release(self):
+                if FakeLock.owner is self:
+                    FakeLock.owner = None
+                self.held = False
+
+        class FakeDataManager:
+            def __init__(self):
+                self.calls = 0
+
+            def shortlink_deactivate_all_expired(self):
+                self.calls += 1
+                return 2
+
+            def shortlink_delete_all_expired(self):
+                return 1
+
+            def expiry_stats(self):
+                return {}
+
+        first, second = FakeDataManager(), FakeDataManager()
+        first_maintenance = Maintenance(first, FakeLock())
+        second_maintenance = Maintenance(second, FakeLock())
+        self.assertEqual(first_maintenance.tick(), {'deactivated': 2, 'freed': 1})
+        self.assertIsNone(second_maintenance.tick())
+        self.assertEqual(first_maintenance.tick(), {'deactivated': 2, 'freed': 1})
+        self.assertEqual((first.calls, second.calls), (2, 0))
+        first_maintenance.close()
+        self.assertEqual(second_maintenance.tick(), {'deactivated': 2, 'freed': 1})
+        self.assertIsNone(first_maintenance.tick())
+        self.assertEqual(second_maintenance.stats(), {'leader': True, 'ticks': 2, 'ticks_as_leader': 1})
+
+
+class FakePoolConnection:
+    """
+    Подключение для пула без сервера: проверочный запрос падает, если подключение "умерло"
+    """
+    def __init__(self):
+        self.closed = 0
+        self.alive = True
+        self.autocommit = False
+        self.prepared = set()
+        self.queries = []
+        self.connection = self
+
+    def get_transaction_status(self):
+        return TRANSACTION_STATUS_IDLE
+
+    def rollback(self):
+        pass
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, vars=None):
+        if not self.alive:
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+        self.queries.append(query)
+
+    def close(self):
+        self.closed = 1
+
+
+class TestConnectionPool(TestCase):
+    def setUp(self):
+        self.opened = []
+        def connect(**kwargs):
+            self.opened.append(FakePoolConnection())
+            return self.opened[-1]
+        patcher = patch('psycopg2.connect', connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def pool(self, **kwargs) -> ConnectionPool:
+        options = dict(minsize=1, maxsize=2, timeout=1, idle_timeout=300, healthcheck_interval=300)
+        options.update(kwargs)
+        return ConnectionPool(dbname='shortlinks', user='postgres', password='', host='localhost', **options)
+
+    def test_checkout(self):
+        """
+        Методика тестирования: разбираем все подключения пула, контролируя открытие новых только до maxsize,
+        PoolTimeout при ожидании сверх timeout и повторную выдачу возвращенного подключения.
+        """
+        pool = self.pool(timeout=0.05)
+        first, second = pool.getconn(), pool.getconn()
+        self.assertEqual(self.opened, [first, second])
+        self.assertTrue(first.autocommit)
+        with self.assertRaises(PoolTimeout):
+            pool.getconn()
+        pool.putconn(second)
+        self.assertIs(pool.getconn(), second)
+        self.assertEqual(len(self.opened), 2)
+        stats = pool.stats()
+        self.assertEqual((stats['size'], stats['in_use'], stats['timeouts']), (2, 2, 1))
+
+    def test_waiter_wakeup(self):
+        """
+        Методика тестирования: все подключения заняты, ожидающий получает то, что вернул другой поток,
+        не дожидаясь timeout и не открывая нового.
+        """
+        pool = self.pool(maxsize=1, timeout=5)
+        connection = pool.getconn()
+        threading.Timer(0.05, pool.putconn, (connection,)).start()
+        started = time.monotonic()
+        self.assertIs(pool.getconn(), connection)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(len(self.opened), 1)
+        self.assertEqual(pool.stats()['wait_count'], 1)
+
+    def test_idle_reaping(self):
+        """
+        Методика тестирования: подключения, простоявшие дольше idle_timeout, закрываются при возврате
+        следующего, но не меньше minsize. Первыми закрываются самые давние.
+        """
+        pool = self.pool(maxsize=3, idle_timeout=0.05)
+        first, second, third = pool.getconn(), pool.getconn(), pool.getconn()
+        for connection in (first, second, third):
+            pool.putconn(connection)
+        time.sleep(0.1)
+        self.assertIs(pool.getconn(), third)
+        pool.putconn(third)
+        self.assertEqual([connection.closed for connection in (first, second, third)], [1, 1, 0])
+        self.assertEqual(pool.stats()['size'], 1)
+
+    def test_healthcheck(self):
+        """
+        Методика тестирования: подключение, пролежавшее в пуле дольше healthcheck_interval, проверяется
+        перед выдачей, мертвое закрывается и заменяется новым.
+        """
+        pool = self.pool(healthcheck_interval=0)
+        connection = pool.getconn()
+        pool.putconn(connection)
+        connection.alive = False
+        replacement = pool.getconn()
+        self.assertIsNot(replacement, connection)
+        self.assertTrue(connection.closed)
+        self.assertEqual(pool.stats()['size'], 1)
+
+    def test_prepared_reconnect(self):
+        """
+        Методика тестирования: запрос готовится на подключении пула один раз, а когда подключение
+        закрылось и пул заменил его новым, на новом запрос готовится заново.
+        """
+        connector = _PooledConnector('prepared_test', 'postgres', '', 'localhost')
+        self.addCleanup(_PooledConnector._pools.pop, ('prepared_test', 'postgres', 'localhost'))
+        for _ in range(2):
+            connector.execute_prepared('select_short', 'SELECT origin FROM link WHERE short=%s', ('a',))
+        [first] = self.opened
+        self.assertEqual(first.queries, [
+            'PREPARE select_short AS SELECT origin FROM link WHERE short=$1',
+            'EXECUTE select_short (%s)',
+            'EXECUTE select_short (%s)',
+        ])
+        first.closed = 1
+        connector.execute_prepared('select_short', 'SELECT origin FROM link WHERE short=%s', ('b',))
+        [_, second] = self.opened
+        self.assertEqual(second.queries, [
+            'PREPARE select_short AS SELECT origin FROM link WHERE short=$1',
+            'EXECUTE select_short (%s)',
+        ])
+
+
+class TestPreparedStatements(TestCase):
+    def test_numbered(self):
+        """
+        Методика тестирования: параметры %s нумеруются по порядку, в том числе повторяющиеся,
+        экранированный %% становится обычным процентом и не путается с параметром.
+        """
+        self.assertEqual(_numbered('SELECT 1'), 'SELECT 1')
+        self.assertEqual(_numbered('SELECT %s, %s'), 'SELECT $1, $2')
+        self.assertEqual(_numbered('WHERE a=%s OR b=%s OR c=%s'), 'WHERE a=$1 OR b=$2 OR c=$3')
+        self.assertEqual(_numbered("WHERE origin LIKE 'http%%' AND short=%s"), "WHERE origin LIKE 'http%' AND short=$1")
+        self.assertEqual(_numbered("SELECT '%%s', %s"), "SELECT '%s', $1")
+        self.assertEqual(_numbered('SELECT %s::int %% 2'), 'SELECT $1::int % 2')
+
+
+class TestAsyncConnector(TestCase):
+    def test_pool_retry(self):
+        """
+        Методика тестирования: первое создание пула падает (БД недоступна), контролируем,
+        что ошибка не запоминается и следующий запрос создает пул заново, а дальше пул уже не создается.
+        """
+        pool = object()
+        calls = []
+        async def create_pool(**kwargs):
+            calls.append(kwargs['host'])
+            await asyncio.sleep(0)
+            if len(calls) == 1:
+                raise OSError('Connection refused')
+            return pool
+
+        async def scenario():
+            connector = _AsyncConnector('shortlinks', 'postgres', '', 'localhost')
+            results = await asyncio.gather(*(connector._get_pool() for _ in range(3)), return_exceptions=True)
+            self.assertEqual([type(result) for result in results], [OSError] * 3)
+            self.assertIs(await connector._get_pool(), pool)
+            self.assertIs(await connector._get_pool(), pool)
+
+        with patch('asyncpg.create_pool', create_pool):
+            asyncio.run(scenario())
+        self.assertEqual(calls, ['localhost', 'localhost'])
+
+
+class PostgresTestCase(TestCase):
+    """
+    Тесты слоя БД на живом Postgres (хост из SHORTLINKS_DB_HOST, иначе из конфига) в отдельной БД shortlinks_test.
+    Схема создается заново перед каждым тестом. Если сервер недоступен, тесты пропускаются.
+    """
+    dbname = 'shortlinks_test'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.host = os.environ.get('SHORTLINKS_DB_HOST', config.DB_HOST)
+        try:
+            connection = psycopg2.connect(
+                dbname='postgres', user=config.DB_USER, password=config.DB_PASSWORD, host=cls.host, connect_timeout=1)
+        except psycopg2.OperationalError:
+            raise SkipTest(f'Postgres на {cls.host} недоступен')
+        connection.autocommit = True
+        cursor = connection.cursor()
+        cursor.execute('SELECT 1 FROM pg_catalog.pg_database WHERE datname=%s', (cls.dbname,))
+        if not cursor.fetchone():
+            cursor.execute(f'CREATE DATABASE {cls.dbname}')
+        connection.close()
+
+    def setUp(self):
+        self.installer = Installer(dbname=self.dbname, user=config.DB_USER, password=config.DB_PASSWORD, host=self.host)
+        self.addCleanup(self.installer.close)
+        self.installer._connector.execute('drop_schema', 'DROP SCHEMA IF EXISTS shortlinks CASCADE')
+        self.installer._schema_create()
+
+    def connect(self) -> DBShortlinks:
+        db = DBShortlinks(dbname=self.dbname, user=config.DB_USER, password=config.DB_PASSWORD, host=self.host)
+        self.addCleanup(db.close)
+        return db
+
+    def run_async(self, scenario):
+        """
+        Выполняет scenario(db) с асинхронным слоем БД, закрывая его пул в том же event loop
+        """
+        async def run():
+            db = AsyncDBShortlinks(dbname=self.dbname, user=config.DB_USER, password=config.DB_PASSWORD, host=self.host)
+            try:
+                return await scenario(db)
+            finally:
+                await db.close()
+        return asyncio.run(run())
+
+
+class TestDBShortlinks(PostgresTestCase):
+    def test_link_create(self):
+        """
+        Методика тестирования: без свободных строк ссылка вставляется с переданными id и short,
+        освобожденную строку следующее создание занимает вместо вставки, а без short (id вне пространства схемы)
+        создание только занимает свободную строку, а если таких нет - NoFreeShortlinks. То же для асинхронного слоя.
+        """
+        db = self.connect()
+        self.assertEqual(db.link_create(5, 'e', 'E'), 'e')
+        self.assertEqual(db.link_create(6, 'f', 'F'), 'f')
+        db.link_delete('e')
+        self.assertEqual(db.link_create(7, 'g', 'G'), 'e')
+        self.assertEqual(db.link_select('e'), 'G')
+        db.link_delete('f')
+        self.assertEqual(db.link_create(8, None, 'H'), 'f')
+        with self.assertRaises(NoFreeShortlinks):
+            db.link_create(9, None, 'I')
+        self.assertEqual([row[:3] for row in db.links_select_after(0, 10)], [(5, 'e', 'G'), (6, 'f', 'H')])
+
+        async def scenario(adb):
+            self.assertEqual(await adb.link_create(10, 'j', 'J'), 'j')
+            await adb.link_delete('j')
+            self.assertEqual(await adb.link_create(11, 'k', 'K'), 'j')
+            await adb.link_delete('j')
+            self.assertEqual(await adb.link_create(12, None, 'L'), 'j')
+            with self.assertRaises(NoFreeShortlinks):
+                await adb.link_create(13, None, 'M')
+            return await adb.links_select_after(6, 10)
+        self.assertEqual([tuple(row)[:3] for row in self.run_async(scenario)], [(10, 'j', 'L')])
+
+    def test_links_create(self):
+        """
+        Методика тестирования: пачка сначала занимает свободные строки по порядку origins, остальное вставляет
+        с переданными id и short. Свободная строка, заблокированная другой транзакцией, пропускается,
+        и на ее место вставляется новая. Результат всегда в порядке origins. То же для асинхронного слоя.
+        """
+        db = self.connect()
+        self.assertEqual(db.links_create([1, 2, 3], ['a', 'b', 'c'], ['A', 'B', 'C']), ['a', 'b', 'c'])
+        db.link_delete('a')
+        db.link_delete('c')
+        locker = self.connect()
+        locker._connector.execute('lock', "SELECT id FROM shortlinks.link WHERE short='a' FOR UPDATE")
+        self.assertEqual(db.links_create([4, 5, 6], ['d', 'e', 'f'], ['D', 'E', 'F']), ['c', 'e', 'f'])
+        locker._connector.commit()
+        self.assertEqual(db.links_create([7, 8], ['g', 'h'], ['G', 'H']), ['a', 'h'])
+        self.assertEqual(
+            db.links_select_origins(['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h']),
+            {'a': 'G', 'b': 'B', 'c': 'D', 'e': 'E', 'f': 'F', 'h': 'H'})
+
+        async def scenario(adb):
+            await adb.link_delete('b')
+            await adb.link_delete('e')
+            return await adb.links_create([9, 10, 11], ['i', 'j', 'k'], ['I', 'J', 'K'])
+        self.assertEqual(sorted(self.run_async(scenario)[:2]), ['b', 'e'])
+        self.assertEqual(db.links_select_origins(['i', 'j', 'k']), {'k': 'K'})
+
+    def test_links_create_without_short(self):
+        """
+        Методика тестирования: ссылкам без short (id вне пространства схемы) свободные строки достаются первыми,
+        остальные вставляются, а если свободных строк на них не хватает, пачка не создается - NoFreeShortlinks.
+        То же для асинхронного слоя.
+        """
+        db = self.connect()
+        db.links_create([1, 2, 3], ['a', 'b', 'c'], ['A', 'B', 'C'])
+        db.link_delete('b')
+        self.assertEqual(db.links_create([4, 5], ['d', None], ['D', 'E']), ['d', 'b'])
+        with self.assertRaises(NoFreeShortlinks):
+            db.links_create([6, 7], ['f', None], ['F', 'G'])
+        self.assertEqual(db.links_select_origins(['b', 'd', 'f']), {'b': 'E', 'd': 'D'})
+
+        async def scenario(adb):
+            await adb.link_delete('a')
+            with self.assertRaises(NoFreeShortlinks):
+                await adb.links_create([8, 9], [None, None], ['H', 'I'])
+            return await adb.links_create([10, 11], [None, 'k'], ['J', 'K'])
+        self.assertEqual(self.run_async(scenario), ['a', 'k'])
+        self.assertEqual(db.links_select_origins(['a', 'k']), {'a': 'J', 'k': 'K'})
+
+    def test_links_upsert(self):
+        """
+        Методика тестирования: строки снимка записываются поверх строк с теми же id вместе со счетчиком переходов,
+        отдаются links_snapshot как есть, а новые id выдаются после самого большого id снимка.
+        """
+        db = self.connect()
+        db.links_create([1], ['a'], ['A'])
+        db.links_hit([('a', 3, time.monotonic())])
+        moment = datetime(2020, 1, 2, 3, 4, 5, 6)
+        rows = [(1, 'a', 'B', moment, 'active', 7), (5, 'e', None, moment, 'free', 0)]
+        db.links_upsert(rows)
+        self.assertEqual(list(db.links_snapshot()), rows)
+        self.assertEqual(db.link_ids_reserve(1), [6])
+
+
+# Схема первой версии сервиса, до обновлений Installer._schema_upgrade
+SCHEMA_V1 = """
+CREATE SCHEMA shortlinks;
+CREATE TYPE shortlinks.shortlink_status AS ENUM ('active', 'inactive', 'free');
+CREATE TABLE shortlinks.link (
+    id integer NOT NULL,
+    short character varying(6),
+    origin text,
+    date_access timestamp without time zone NOT NULL,
+    status shortlinks.shortlink_status NOT NULL
+);
+CREATE SEQUENCE shortlinks.link_id_seq AS integer START WITH 1 INCREMENT BY 1 NO MINVALUE NO MAXVALUE CACHE 1;
+ALTER SEQUENCE shortlinks.link_id_seq OWNED BY shortlinks.link.id;
+ALTER TABLE ONLY shortlinks.link ALTER COLUMN id SET DEFAULT nextval('shortlinks.link_id_seq'::regclass);
+ALTER TABLE ONLY shortlinks.link ADD CONSTRAINT link_pkey PRIMARY KEY (id);
+CREATE INDEX date_access_status ON shortlinks.link USING btree (date_access, status);
+CREATE UNIQUE INDEX short ON shortlinks.link USING btree (short);
+CREATE INDEX short_status ON shortlinks.link USING btree (short, status);
+CREATE INDEX status ON shortlinks.link USING btree (status);
+"""
+
+
+class TestInstaller(PostgresTestCase):
+    def test_schema_upgrade(self):
+        """
+        Методика тестирования: схему первой версии со ссылками обновляем дважды, контролируя типы id
+        и последовательности, сохранность ссылок, работу слоя БД с id за пределами integer
+        резерв свободных ссылок (статус 'reserved') и индекс для устаревания кусками.
+        """
+        connector = self.installer._connector
+        connector.execute('drop_schema', 'DROP SCHEMA shortlinks CASCADE')
+        connector.execute('schema_v1', SCHEMA_V1)
+        connector.execute('insert', """INSERT INTO shortlinks.link (short, origin, date_access, status)
+            VALUES ('a', 'A', NOW(), 'active'), ('b', NULL, NOW(), 'free')""")
+        self.installer._schema_upgrade()
+        self.installer._schema_upgrade()
+        self.assertEqual(self.installer._column_type('id'), 'bigint')
+        self.assertEqual(self.installer._sequence_type(), 'bigint')
+        indexes = connector.execute('indexes', "SELECT indexname FROM pg_catalog.pg_indexes WHERE schemaname='shortlinks'")
+        self.assertIn(('status_date_access_id',), indexes.fetchall())
+
+        db = self.connect()
+        connector.execute('setval', "SELECT setval('shortlinks.link_id_seq', 2147483647)")
+        link_ids = db.link_ids_reserve(2)
+        self.assertEqual(link_ids, [2147483648, 2147483649])
+        self.assertEqual(db.links_create(link_ids, ['c', 'd'], ['C', 'D']), ['b', 'd'])
+        self.assertEqual(db.links_select_origins(['a', 'b', 'd']), {'a': 'A', 'b': 'C', 'd': 'D'})
+
+        db.link_delete('a')
+        [(link_id, short, reserved_at)] = db.links_reserve_free(10)
+        self.assertEqual(short, 'a')
+        db.links_release_stale_reserved(-1)
+        self.assertEqual(db.link_select_free(), 'a')
+        [(link_id, _, reserved_at)] = db.links_reserve_free(10)
+        self.assertTrue(db.link_reuse_reserved(link_id, reserved_at, 'E'))
+        self.assertEqual(db.link_select('a'), 'E')
+
+
+class TestSQLiteDB(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db = SQLiteDBShortlinks(os.path.join(self.directory.name, 'shortlinks.sqlite'))
+        self.db.init_database()
+
+    def tearDown(self):
+        self.db.close()
+        self.directory.cleanup()
+
+    def test_create_and_reuse(self):
+        """
+        Методика тестирования: созданные ссылки читаются, удаленная ссылка не читается,
+        а следующее создание занимает ее строку вместо вставки новой, в том числе через резерв.
+        """
+        shorts = self.db.links_create(self.db.link_ids_reserve(3), ['a', 'b', 'c'], ['A', 'B', 'C'])
+        self.assertEqual(shorts, ['a', 'b', 'c'])
+        self.assertEqual(self.db.link_select('b'), 'B')
+        self.assertEqual(self.db.links_select_origins(['a', 'c', 'x']), {'a': 'A', 'c': 'C'})
+        self.db.link_delete('b')
+        with self.assertRaises(ShortlinkNotFound):
+            self.db.link_select('b')
+        self.assertEqual(self.db.link_create(self.db.link_id_take(), 'd', 'D'), 'b')
+        self.assertEqual(self.db.link_select('b'), 'D')
+        self.db.link_delete('a')
+        [(link_id, short, reserved_at)] = self.db.links_reserve_free(10)
+        self.assertEqual(short, 'a')
+        self.assertTrue(self.db.link_reuse_reserved(link_id, reserved_at, 'E'))
+        self.assertFalse(self.db.link_reuse_reserved(link_id, reserved_at, 'F'))
+        self.assertEqual(self.db.link_select('a'), 'E')
+
+    def test_bulk_create(self):
+        """
+        Методика тестирования: пачка создается кусками по DB_CREATE_BATCHSIZE, освобожденная ссылка
+        переиспользуется и перестает числиться в кэше несуществующих, а id, который ей не понадобился,
+        возвращается в резерв.
+        """
+        manager = DataManager(self.db)
+        with patch.object(config, 'DB_CREATE_BATCHSIZE', 2):
+            shorts = manager.shortlinks_create(['A', 'B', 'C'])
+            self.assertEqual(shorts, [shortlink_hash(1), shortlink_hash(2), shortlink_hash(3)])
+            manager.shortlink_delete(shorts[1])
+            with self.assertRaises(ShortlinkNotFound):
+                manager.shortlink_get(shorts[1], update_access_date=False)
+            self.assertEqual(manager.shortlinks_create(['D', 'E']), [shorts[1], shortlink_hash(5)])
+        self.assertEqual(manager.shortlink_get(shorts[1], update_access_date=False), 'D')
+        self.assertEqual(self.db.link_id_take(), 4)
+
+    def test_create_beyond_scheme(self):
+        """
+        Методика тестирования: id из последовательности вышли за пространство схемы crc32,
+        создание ссылки все равно занимает свободную строку, а без свободных - NoFreeShortlinks.
+        """
+        manager = DataManager(self.db)
+        self.db.links_create(self.db.link_ids_reserve(2), ['a', 'b'], ['A', 'B'])
+        self.db._connector.execute('setval', 'UPDATE link_id_seq SET value = 10000000')
+        self.db._link_ids = Reservoir(self.db.link_ids_reserve, 1)
+        self.db.link_delete('a')
+        self.assertEqual(manager.shortlink_create('C'), 'a')
+        self.assertEqual(self.db.link_select('a'), 'C')
+        with self.assertRaises(NoFreeShortlinks):
+            manager.shortlink_create('D')
+
+    def test_bulk_create_beyond_scheme(self):
+        """
+        Методика тестирования: то же, что и test_create_beyond_scheme, только пачкой: ссылки занимают
+        свободные строки, а если свободных на всю пачку не хватает, не создается ни одна - NoFreeShortlinks.
+        """
+        manager = DataManager(self.db)
+        self.db.links_create(self.db.link_ids_reserve(3), ['a', 'b', 'c'], ['A', 'B', 'C'])
+        self.db._connector.execute('setval', 'UPDATE link_id_seq SET value = 10000000')
+        self.db.link_delete('a')
+        self.db.link_delete('c')
+        self.assertEqual(manager.shortlinks_create(['D', 'E']), ['a', 'c'])
+        self.assertEqual(self.db.links_select_origins(['a', 'c']), {'a': 'D', 'c': 'E'})
+        self.db.link_delete('b')
+        with self.assertRaises(NoFreeShortlinks):
+            manager.shortlinks_create(['F', 'G'])
+        self.assertEqual(self.db.link_select_free(), 'b')
+        self.assertEqual(self.db.links_create([20, 21], [None, 'x'], ['H', 'X']), ['b', 'x'])
+
+    def test_query_metrics(self):
+        """
+        Методика тестирования: время запроса попадает в гистограмму с меткой - именем метода слоя БД.
+        """
+        observed = QUERY_SECONDS.labels('links_select_origins')
+        count = sum(observed._counts)
+        self.db.links_select_origins(['a', 'b'])
+        self.assertEqual(sum(observed._counts), count + 1)
+        observed = QUERY_SECONDS.labels('links_create')
+        count = sum(observed._counts)
+        self.db.links_create(self.db.link_ids_reserve(1), ['a'], ['A'])
+        self.assertEqual(sum(observed._counts), count + 1)
+
+    def test_async_write_off_loop(self):
+        """
+        Методика тестирования: пока другой процесс держит блокировку записи, асинхронная запись ждет ее
+        в пуле потоков, а event loop тем временем обслуживает чтение. После снятия блокировки запись проходит.
+        """
+        self.db.links_create(self.db.link_ids_reserve(1), ['a'], ['A'])
+        link_id = self.db.link_id_take()
+        db = AsyncSQLiteDBShortlinks(self.db)
+        locker = sqlite3.connect(
+            os.path.join(self.directory.name, 'shortlinks.sqlite'), isolation_level=None, check_same_thread=False)
+        locker.execute('BEGIN IMMEDIATE')
+
+        async def scenario():
+            creating = asyncio.ensure_future(db.link_create(link_id, 'b', 'B'))
+            await asyncio.sleep(0.2)
+            self.assertFalse(creating.done())
+            self.assertEqual(await db.link_select('a'), 'A')
+            locker.execute('COMMIT')
+            self.assertEqual(await creating, 'b')
+            self.assertEqual(await db.link_select('b'), 'B')
+            self.assertEqual([row[1] for row in [row async for row in db.links_stream()]], ['a', 'b'])
+
+        try:
+            asyncio.run(scenario())
+        finally:
+            locker.close()
+            db._executor.shutdown(wait=True)
+
+    def test_expiry_chunks(self):
+        """
+        Методика тестирования: при возрасте -1 под устаревание попадают все строки,
+        куски идут по ключу (date_access, id) без повторов, освобожденные строки перестают читаться.
+        """
+        shorts = [f's{number}' for number in range(5)]
+        self.db.links_create(self.db.link_ids_reserve(5), shorts, shorts)
+        first = self.db.links_deactivate_chunk(-1, None, 3)
+        second = self.db.links_deactivate_chunk(-1, first[-1], 3)
+        self.assertEqual([link_id for _, link_id in first + second], [1, 2, 3, 4, 5])
+        self.assertEqual(self.db.links_select_origins(shorts), dict(zip(shorts, shorts)))
+        expired = self.db.links_expire_chunk(-1, None, 10)
+        self.assertEqual([short for _, _, short in expired], shorts)
+        self.assertEqual(self.db.links_select_origins(shorts), {})
+        self.assertEqual([row[4] for row in self.db.links_stream()], ['free'] * 5)
+
+    def test_hits(self):
+        """
+        Методика тестирования: накопленные переходы прибавляются к счетчику и двигают время доступа назад
+        не дальше уже записанного, освобождение ссылки обнуляет счетчик.
+        """
+        self.db.links_create(self.db.link_ids_reserve(2), ['a', 'b'], ['A', 'B'])
+        [(_, _, _, created, _)] = list(self.db.links_stream(1))
+        now = time.monotonic()
+        self.db.links_hit([('a', 3, now), ('b', 1, now - 3600), ('x', 5, now)])
+        self.db.links_hit([('a', 2, now)])
+        hits = dict(self.db._connector.execute('hits', 'SELECT short, hits FROM link').fetchall())
+        self.assertEqual(hits, {'a': 5, 'b': 1})
+        [(_, _, _, accessed, _)] = list(self.db.links_stream(1))
+        self.assertEqual(accessed, created)
+        self.db.link_delete('a')
+        self.assertEqual(self.db._connector.execute('hits', "SELECT hits FROM link WHERE short='a'").fetchone(), (0,))
+
+    def test_select_recent(self):
+        """
+        Методика тестирования: для прогрева кэша берутся читаемые ссылки, к которым обращались последними,
+        от старых к новым.
+        """
+        self.db.links_create(self.db.link_ids_reserve(4), ['a', 'b', 'c', 'd'], ['A', 'B', 'C', 'D'])
+        self.db.link_delete('c')
+        self.db.link_actualize('a')
+        self.assertEqual(self.db.links_select_recent(2), [('d', 'D'), ('a', 'A')])
+
+    def test_snapshot_import(self):
+        """
+        Методика тестирования: снимок заменяет содержимое таблицы, время доступа и счетчик переходов сохраняются,
+        а новые id выдаются после самого большого id снимка.
+        """
+        self.db.links_create(self.db.link_ids_reserve(1), ['old'], ['OLD'])
+        moment = datetime(2020, 1, 2, 3, 4, 5, 6)
+        rows = [(7, 'a', 'A', moment, 'active', 5), (9, 'b', None, moment, 'free', 0)]
+        count = self.db.snapshot_import(rows)
+        self.assertEqual(count, 2)
+        self.assertEqual(list(self.db.links_snapshot()), rows)
+        self.assertEqual(list(self.db.links_stream()), [(7, 'a', 'A', moment, 'active'), (9, 'b', None, moment, 'free')])
+        self.assertEqual(self.db.link_ids_reserve(2), [10, 11])
+
+    def test_cache_warm(self):
+        """
+        Методика тестирования: пока воркер стоял, одну ссылку из снимка удалили, другую удалили и заняли заново.
+        Прогрев кладет в кэш только запись, совпадающую с БД, а измененные читаются из БД.
+        """
+        manager = DataManager(self.db)
+        self.db.links_create(self.db.link_ids_reserve(3), ['a', 'b', 'c'], ['A', 'B', 'C'])
+        path = os.path.join(self.directory.name, 'cache.snapshot')
+        cache_snapshot.dump(path, [('a', 'A', 60), ('b', 'B', 60), ('c', 'C', 60)])
+        self.db.link_delete('b')
+        self.db.link_delete('c')
+        self.assertEqual(self.db.link_create(self.db.link_id_take(), 'd', 'D'), 'b')
+        with patch.object(config, 'CACHE_SNAPSHOT_PATH', path), \
+                patch.object(DataManager, '_cache_lru', CacheLRU(maxsize=10, ttl=60)):
+            self.assertEqual(manager.cache_warm(), 1)
+            self.assertEqual(list(manager._cache_lru.container), ['a'])
+            self.assertEqual(manager.shortlink_get('b', update_access_date=False), 'D')
+            with self.assertRaises(ShortlinkNotFound):
+                manager.shortlink_get('c', update_access_date=False)
+
+    def test_leader_lock(self):
+        """
+        Методика тестирования: блокировку файла держит только один, после release ее берет другой.
+        """
+        path = os.path.join(self.directory.name, 'leader')
+        first, second = FileLeaderLock(path), FileLeaderLock(path)
+        self.assertTrue(first.acquire())
+        self.assertFalse(second.acquire())
+        first.release()
+        self.assertTrue(second.acquire())
+        self.assertTrue(second.held)
+        second.release()
+
+
+class TestReplicaSet(TestCase):
+    def test_pick(self):
+        """
+        Методика тестирования: непроверенная, отстающая и упавшая реплики не выбираются,
+        из остальных 'latency' берет самую быструю, 'round_robin' - по очереди,
+        проверку каждой реплики получает только один вызвавший за интервал.
+        """
+        fast, slow, lagging = Replica('fast', None), Replica('slow', None), Replica('lagging', None)
+        replicas = ReplicaSet([fast, slow, lagging], max_lag=5, check_interval=60)
+        self.assertIsNone(replicas.pick())
+        self.assertEqual(replicas.due(), [fast, slow, lagging])
+        self.assertEqual(replicas.due(), [])
+        replicas.checked(fast, 0, 0.001)
+        replicas.checked(slow, 1, 0.005)
+        replicas.checked(lagging, 30, 0.0001)
+        self.assertIs(replicas.pick(), fast)
+        replicas.failed(fast)
+        self.assertIs(replicas.pick(), slow)
+        self.assertEqual(replicas.stats()['fast']['down'], 1)
+        self.assertEqual(replicas.stats()['primary']['fallbacks'], 1)
+
+        first, second = Replica('first', None), Replica('second', None)
+        replicas = ReplicaSet([first, second], max_lag=5, check_interval=60, policy='round_robin')
+        for replica in replicas.due():
+            replicas.checked(replica, 0, 0.001)
+        self.assertEqual([replicas.pick().name for _ in range(4)], ['first', 'second', 'first', 'second'])
+
+    def test_fallback(self):
+        """
+        Методика тестирования: до первой проверки отставания запрос идет на основной сервер и реплику не трогает,
+        после проверки - на реплику, а когда она не отвечает - на основной сервер,
+        реплика при этом выключается до следующей проверки.
+        """
+        class FakeConnector:
+            def __init__(self, name, broken=False):
+                self.name = name
+                self.broken = broken
+                self.queries = []
+
+            def execute(self, name, query, vars=None):
+                if self.broken:
+                    raise psycopg2.OperationalError
+                self.queries.append(query)
+                return self
+
+            def fetchone(self):
+                return (0.0,)
+
+        primary, replica = FakeConnector('primary'), FakeConnector('replica')
+        replicas = ReplicaSet([Replica('replica', replica)], max_lag=5, check_interval=60)
+        reader = _ReadConnector(primary, replicas)
+        self.assertIs(reader.execute('select', 'SELECT 0'), primary)
+        self.assertEqual(replica.queries, [])
+        reader.check()
+        self.assertIs(reader.execute('select', 'SELECT 1'), replica)
+        replica.broken = True
+        self.assertIs(reader.execute('select', 'SELECT 2'), primary)
+        self.assertIs(reader.execute('select', 'SELECT 3'), primary)
+        self.assertEqual(primary.queries, ['SELECT 0', 'SELECT 2', 'SELECT 3'])
+        self.assertEqual(replicas.stats()['replica']['errors'], 1)
+
+
+class TestMetrics(TestCase):
+    def test_render(self):
+        """
+        Методика тестирования: заводим счетчик с метками, гистограмму и опрос stats() компонента,
+        контролируя текстовую выгрузку: накопительные корзины, суффикс _total у счетчиков, метки вложенных stats.
+        """
+        registry = Registry()
+        requests = registry.counter('requests_total', 'Запросы', 'handler')
+        requests.labels('get').inc()
+        requests.labels('get').inc(2)
+        seconds = registry.histogram('seconds', 'Время', buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.5, 5):
+            seconds.observe(value)
+        cache = CacheLRU(maxsize=2)
+        for key in ('a', 'a', 'b', 'c'):
+            cache.get(key, lambda: key)
+        registry.register_stats('cache', 'Кэш', lambda: {'lru': cache.stats()}, counters=('hits', 'misses', 'evictions'), label='name')
+        lines = registry.render().splitlines()
+        self.assertIn('requests_total{handler="get"} 3', lines)
+        self.assertIn('# TYPE seconds histogram', lines)
+        self.assertIn('seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('seconds_bucket{le="1.0"} 3', lines)
+        self.assertIn('seconds_bucket{le="+Inf"} 4', lines)
+        self.assertIn('seconds_count 4', lines)
+        self.assertIn('seconds_sum 6.05', lines)
+        self.assertIn('# TYPE cache_hits_total counter', lines)
+        self.assertIn('cache_hits_total{name="lru"} 1', lines)
+        self.assertIn('cache_misses_total{name="lru"} 3', lines)
+        self.assertIn('cache_evictions_total{name="lru"} 1', lines)
+        self.assertIn('# TYPE cache_size gauge', lines)
+        self.assertIn('cache_size{name="lru"} 2', lines)